@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive transect spacing along the smoothed centreline
+
+GenerateTransectsAlongLines places the transects at a fixed interval. Here
+they start at a coarse spacing and transects are inserted where the planform
+changes quickly, up to a total budget:
+
+    Each interval between neighbouring transects is scored by its length
+    times one plus the change over it of the centreline curvature and, when
+    a channel mask of a year is given, of the width and of the number of
+    threads (a cheap braiding index proxy) from width_profile. The interval
+    with the highest score is split at its middle until the budget is spent
+    or the intervals reach the minimum spacing.
+
+Each transect carries a Weight, the length of centreline it stands for over
+the coarse spacing, so weighted rolling means over the transects (as in
+planform_metric_extraction_V4.py) are not biased towards the densely
+sampled reaches. Distance numbers the transects from the start point as for
+the fixed spacing tool, and Chainage is their position along the
+centreline.
+"""
+
+import heapq
+
+import numpy as np
+
+
+def tangents(reference, chainage, half_window):
+    """Unit tangents of the centreline over chainage +/- half_window."""
+    a = reference.point_at(np.asarray(chainage) - half_window)
+    b = reference.point_at(np.asarray(chainage) + half_window)
+    d = b - a
+    return d / np.maximum(np.hypot(*d.T), 1e-12)[:, None]
+
+
+def curvature(reference, chainage, half_window):
+    """Change of direction per unit length around each chainage."""
+    chainage = np.asarray(chainage, np.float64)
+    before = tangents(reference, chainage - half_window, half_window)
+    after = tangents(reference, chainage + half_window, half_window)
+    cross = before[:, 0] * after[:, 1] - before[:, 1] * after[:, 0]
+    dot = (before * after).sum(axis=1)
+    return np.arctan2(cross, dot) / (2.0 * half_window)
+
+
+class Signals(object):
+    """Planform signals along the chainage, each scaled to unit spread."""
+
+    def __init__(self, reference, spacing, profile=None):
+        import width_profile
+        self.reference = reference
+        self.half = float(spacing) / 2
+        self.profile = profile
+        self._sample = width_profile.sample
+        # Scales from a regular sampling at the coarse spacing
+        probe = np.arange(self.half, max(reference.length, spacing), self.half)
+        values = self(probe, scale=False)
+        self.scale = [max(float(np.std(v)), 1e-12) for v in values]
+
+    def __call__(self, chainage, scale=True):
+        chainage = np.atleast_1d(np.asarray(chainage, np.float64))
+        values = [curvature(self.reference, chainage, self.half)]
+        if self.profile is not None:
+            width, threads = self._sample(self.profile, chainage, 2 * self.half)
+            values += [width, threads]
+        if scale:
+            values = [v / s for v, s in zip(values, self.scale)]
+        return values
+
+
+def adaptive_stations(reference, spacing, min_spacing, budget, signals=None, base=0.1):
+    """Chainages of the transects, coarse spacing refined where signals change.
+
+    An interval scores its length times base plus the change of the signals
+    between its ends and their departure from a straight line at its middle.
+    """
+    length = reference.length
+    count = max(min(int(round(length / float(spacing))), int(budget)), 1)
+    stations = list((np.arange(count) + 0.5) * (length / count))
+    if signals is None or len(stations) >= budget:
+        return np.array(stations)
+    values = list(np.column_stack(signals(stations)))
+
+    def interval(i, j):
+        a, b = stations[i], stations[j]
+        middle = np.column_stack(signals([(a + b) / 2]))[0]
+        change = (np.abs(values[j] - values[i]).sum() +
+                  2 * np.abs(middle - (values[i] + values[j]) / 2).sum())
+        return (-(b - a) * (base + change), i, j, middle)
+
+    heap = [interval(i, i + 1) for i in range(len(stations) - 1)]
+    heapq.heapify(heap)
+    while heap and len(stations) < budget:
+        _, i, j, middle = heapq.heappop(heap)
+        if stations[j] - stations[i] < 2 * float(min_spacing):
+            continue
+        stations.append((stations[i] + stations[j]) / 2)
+        values.append(middle)
+        k = len(stations) - 1
+        heapq.heappush(heap, interval(i, k))
+        heapq.heappush(heap, interval(k, j))
+    return np.sort(np.array(stations))
+
+
+def weights(stations, length, spacing):
+    """Centreline length each station stands for, over the coarse spacing."""
+    edges = np.r_[0.0, (stations[1:] + stations[:-1]) / 2, length]
+    return np.diff(edges) / float(spacing)
+
+
+def transect_lines(reference, stations, transect_length, half_window):
+    """(N, 2, 2) transects across the centreline at the stations."""
+    centre = reference.point_at(stations)
+    t = tangents(reference, stations, half_window)
+    normal = np.column_stack((-t[:, 1], t[:, 0])) * (float(transect_length) / 2)
+    return np.stack((centre + normal, centre - normal), axis=1)
+
+
+if __name__ == '__main__':
+
+    import arcpy
+
+    import linear_reference
+    import raster_io
+    import width_profile
+
+    envelope = arcpy.GetParameterAsText(0)
+    startPoint = arcpy.GetParameterAsText(1)
+    Out_Space = arcpy.GetParameterAsText(2)
+    spacing = float(arcpy.GetParameterAsText(3) or 1000)
+    min_spacing = float(arcpy.GetParameterAsText(4) or 250)
+    budget = int(arcpy.GetParameterAsText(5) or 0)
+    transect_length = float(arcpy.GetParameterAsText(6) or 2000)
+    # Optional channel polygons of a year (e.g. activeChannel_2018) for the
+    # width and thread signals, rasterized at the cell size
+    channel = arcpy.GetParameterAsText(7)
+    cell_size = float(arcpy.GetParameterAsText(8) or 30)
+
+    arcpy.env.workspace = Out_Space
+    arcpy.env.overwriteOutput = True
+    arcpy.env.extent = arcpy.Describe(envelope).Extent
+    arcpy.env.outputCoordinateSystem = arcpy.Describe(envelope).spatialReference
+
+    dsets = []
+
+    arcpy.AddMessage("Generating adaptive transects")
+    centerLine = "centerLine"
+    arcpy.topographic.PolygonToCenterline(
+        in_features = envelope,
+        out_feature_class = centerLine)
+
+    centerLineSmooth = "centerLineSmooth"
+    arcpy.cartography.SmoothLine(
+        in_features = centerLine,
+        out_feature_class = centerLineSmooth,
+        algorithm = "PAEK",
+        tolerance = "500 Meters")
+
+    reference = linear_reference.from_centerline(centerLineSmooth, startPoint)
+    if not budget:
+        budget = int(2 * reference.length / spacing) + 1
+
+    profile = None
+    if channel:
+        ext = arcpy.Describe(envelope).extent
+        grid = raster_io.snap_grid((ext.XMin, ext.YMin, ext.XMax, ext.YMax),
+                                   cell_size, ext.XMin, ext.YMax)
+        mask = raster_io.rasterize_rings(raster_io.feature_rings(channel), grid)
+        profile = width_profile.profile(mask, grid.cell, (grid.x0, grid.y0), reference)
+
+    signals = Signals(reference, spacing, profile)
+    stations = adaptive_stations(reference, spacing, min_spacing, budget, signals)
+    lines = transect_lines(reference, stations, transect_length, spacing / 2)
+    weight = weights(stations, reference.length, spacing)
+
+    sr = arcpy.Describe(envelope).spatialReference
+    transects = arcpy.management.CreateFeatureclass(
+        Out_Space, "transects_adaptive", "POLYLINE", spatial_reference=sr)
+    for name, kind in (("Transect_Id", "LONG"), ("Distance", "LONG"),
+                       ("Chainage", "DOUBLE"), ("Weight", "DOUBLE")):
+        arcpy.management.AddField(transects, name, kind, 9, "", "", name, "NULLABLE")
+    with arcpy.da.InsertCursor(transects, ["SHAPE@", "Transect_Id", "Distance",
+                                           "Chainage", "Weight"]) as cursor:
+        for k, (line, s, w) in enumerate(zip(lines, stations, weight), 1):
+            shape = arcpy.Polyline(arcpy.Array([arcpy.Point(*p) for p in line]), sr)
+            cursor.insertRow((shape, k, k, float(s), float(w)))
+    arcpy.AddMessage("{0} transects, spacing {1:.0f} to {2:.0f} m".format(
+        len(stations), np.diff(stations).min(initial=spacing), np.diff(stations).max(initial=spacing)))
+
+    dsets.extend((centerLine, centerLineSmooth))
+    for dset in dsets:
+        arcpy.management.Delete(dset)
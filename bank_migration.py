@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Bank-line migration between years from distance transforms
+
+The channel masks of two years on the same grid, rasterized from
+wetChannelBoundary_<year> or activeChannel_<year>, are compared without
+differencing polygons:
+
+    Erosion: pixels in the channel of the later year but not of the earlier
+    one, at the distance of the earlier channel
+    Deposition: pixels in the channel of the earlier year only, at the
+    distance of the later channel
+
+The distances come from the exact Euclidean distance transforms of the
+complements of the masks, which scipy computes in linear time, so the
+migration raster holds for every pixel the distance the bank moved to reach
+it: positive where the channel eroded, negative where it deposited.
+
+Per transect the largest erosion and deposition distances are sampled along
+it and divided by the years between the images for the rates, and the eroded
+and accreted areas are summed over the pixels nearest to its samples. The
+areas of the transects add up per reach between the given Distance breaks.
+Results are record arrays keyed by the Distance of the transects.
+"""
+
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from transect_intersect import sample_transects, transect_points
+
+
+def migration_distance(earlier, later, cell_size):
+    """Signed bank migration distance of each pixel in map units.
+
+    Positive on eroded pixels, negative on deposited ones and zero elsewhere.
+    """
+    earlier = np.asarray(earlier, bool)
+    later = np.asarray(later, bool)
+    out = np.zeros(earlier.shape, np.float32)
+    eroded = later & ~earlier
+    deposited = earlier & ~later
+    if eroded.any() and earlier.any():
+        out[eroded] = ndimage.distance_transform_edt(~earlier)[eroded] * cell_size
+    if deposited.any() and later.any():
+        out[deposited] = -ndimage.distance_transform_edt(~later)[deposited] * cell_size
+    return out
+
+
+def nearest_transect(xy, rows, cols, origin, cell):
+    """Index of the transect nearest to each pixel centre."""
+    tr, points, _ = transect_points(xy, cell)
+    pixels = np.column_stack((origin[0] + (cols + 0.5) * cell, origin[1] - (rows + 0.5) * cell))
+    if not len(pixels):
+        return np.zeros(0, np.int64)
+    return tr[cKDTree(points).query(pixels)[1]]
+
+
+def transect_migration(migration, keys, xy, origin, cell, years=1.0, max_distance=None):
+    """Migration per transect as a record array sorted by Distance.
+
+    Fields: Distance, Erosion and Deposition (largest distances along the
+    transect), ErosionRate and DepositionRate (per year), ErodedArea and
+    AccretedArea (pixels nearest the transect, within max_distance).
+    """
+    xy = np.asarray(xy, np.float64).reshape(-1, 2, 2)
+    n = len(xy)
+    tr, row, col, _ = sample_transects(xy, origin, cell, migration.shape)
+    valid = row >= 0
+    values = np.zeros(len(tr), np.float64)
+    values[valid] = migration[row[valid], col[valid]]
+    erosion = np.zeros(n)
+    deposition = np.zeros(n)
+    np.maximum.at(erosion, tr, np.maximum(values, 0))
+    np.maximum.at(deposition, tr, np.maximum(-values, 0))
+
+    r, c = np.nonzero(migration)
+    owner = nearest_transect(xy, r, c, origin, cell)
+    if max_distance is not None and len(owner):
+        # Changes away from every transect are left out
+        mid = xy.mean(axis=1)
+        px = np.column_stack((origin[0] + (c + 0.5) * cell, origin[1] - (r + 0.5) * cell))
+        half = np.hypot(*(xy[:, 1] - xy[:, 0]).T) / 2
+        keep = np.hypot(*(px - mid[owner]).T) <= half[owner] + max_distance
+        r, c, owner = r[keep], c[keep], owner[keep]
+    pixel_area = float(cell) ** 2
+    change = migration[r, c]
+    eroded = np.bincount(owner, weights=change > 0, minlength=n) * pixel_area
+    accreted = np.bincount(owner, weights=change < 0, minlength=n) * pixel_area
+
+    out = np.zeros(n, dtype=[("Distance", np.float64), ("Erosion", np.float64),
+                             ("Deposition", np.float64), ("ErosionRate", np.float64),
+                             ("DepositionRate", np.float64), ("ErodedArea", np.float64),
+                             ("AccretedArea", np.float64)])
+    out["Distance"] = keys
+    out["Erosion"] = erosion
+    out["Deposition"] = deposition
+    out["ErosionRate"] = erosion / float(years)
+    out["DepositionRate"] = deposition / float(years)
+    out["ErodedArea"] = eroded
+    out["AccretedArea"] = accreted
+    return np.sort(out, order="Distance")
+
+
+def reach_migration(transects, breaks):
+    """Eroded and accreted areas summed per reach between Distance breaks.
+
+    transects is the result of transect_migration; reach k holds the
+    transects with breaks[k - 1] <= Distance < breaks[k].
+    """
+    breaks = np.sort(np.asarray(breaks, np.float64))
+    reach = np.searchsorted(breaks, transects["Distance"], side="right")
+    n = len(breaks) + 1
+    out = np.zeros(n, dtype=[("Reach", np.int32), ("Start", np.float64), ("End", np.float64),
+                             ("ErodedArea", np.float64), ("AccretedArea", np.float64),
+                             ("NetArea", np.float64)])
+    out["Reach"] = np.arange(1, n + 1)
+    out["Start"] = np.r_[transects["Distance"].min(initial=0), breaks]
+    out["End"] = np.r_[breaks, transects["Distance"].max(initial=0)]
+    out["ErodedArea"] = np.bincount(reach, weights=transects["ErodedArea"], minlength=n)
+    out["AccretedArea"] = np.bincount(reach, weights=transects["AccretedArea"], minlength=n)
+    out["NetArea"] = out["ErodedArea"] - out["AccretedArea"]
+    return out
+
+
+if __name__ == '__main__':
+
+    import arcpy
+
+    import raster_io
+    import transect_intersect
+
+    envelope = arcpy.GetParameterAsText(0)
+    transects = arcpy.GetParameterAsText(1)
+    input_space = arcpy.GetParameterAsText(2)
+    # Years separated by ";", compared in consecutive pairs
+    years = [y.strip() for y in arcpy.GetParameterAsText(3).split(";") if y.strip()]
+    product = arcpy.GetParameterAsText(4) or "wetChannelBoundary"
+    cell_size = float(arcpy.GetParameterAsText(5) or 10)
+    # Optional reach breaks as Distance values separated by ";"
+    breaks = [float(b) for b in arcpy.GetParameterAsText(6).split(";") if b.strip()]
+
+    arcpy.env.workspace = input_space
+    arcpy.env.overwriteOutput = True
+
+    ext = arcpy.Describe(envelope).extent
+    grid = raster_io.snap_grid((ext.XMin, ext.YMin, ext.XMax, ext.YMax),
+                               cell_size, ext.XMin, ext.YMax)
+    origin = (grid.x0, grid.y0)
+    keys, xy = transect_intersect.read_transects(transects, "Distance")
+
+    earlier = None
+    for year in years:
+        arcpy.AddMessage("Rasterizing " + product + "_" + year)
+        mask = raster_io.rasterize_rings(raster_io.feature_rings(product + "_" + year), grid)
+        if earlier is not None:
+            year0, mask0 = earlier
+            migration = migration_distance(mask0, mask, grid.cell)
+            result = transect_migration(migration, keys, xy, origin, grid.cell,
+                                        years=max(int(year) - int(year0), 1))
+            tables = [("bankMigration_" + year0 + "_" + year, result)]
+            if breaks:
+                tables.append(("reachMigration_" + year0 + "_" + year,
+                               reach_migration(result, breaks)))
+            for table, rows in tables:
+                if arcpy.Exists(table):
+                    arcpy.management.Delete(table)
+                arcpy.da.NumPyArrayToTable(rows, table)
+            arcpy.AddMessage("{0}-{1}: eroded {2:.0f} m2, accreted {3:.0f} m2, largest erosion {4:.0f} m".format(
+                year0, year, result["ErodedArea"].sum(), result["AccretedArea"].sum(),
+                result["Erosion"].max(initial=0)))
+        earlier = (year, mask)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Batch runner for a catalog of rivers and scenes
+
+It takes a CSV manifest with one row per (river, scene) job, at most one
+scene per river and year:
+
+    river, envelope, start_point, scene, year
+    and the thresholds of channel_planform_from_satellite.py:
+    green_band, red_band, nir_band, swir_band, ndvi_threshold,
+    mndwi_threshold, waterArea_threshold, barArea_threshold,
+    smooth_tolerance, spacing_length, cross_length
+    and optionally memory_mb, the expected peak memory of the job
+
+Each job runs channel_planform_from_satellite.py in its own process with a
+scratch geodatabase. Finished products are copied into the store of the
+river, <out_root>/<river>/<river>.gdb, as landClass_<year>,
+wetChannelBoundary_<year>, activeChannel_<year> and channelUnit_<year>,
+which is the naming planform_metric_extraction_V4.py reads. With --metrics
+the metric extraction is run for every river once all its scenes are done.
+
+The state of every job is kept in <manifest>.state.json and rewritten after
+every change, so an interrupted batch started again skips finished jobs.
+Jobs start while both the worker count and the memory budget allow it.
+
+Usage:
+    python batch_runner.py manifest.csv out_root [--workers 4]
+        [--memory-mb 16000] [--stage-workers 1] [--metrics]
+"""
+
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PARAMETERS = ("green_band", "red_band", "nir_band", "swir_band",
+              "ndvi_threshold", "mndwi_threshold", "waterArea_threshold",
+              "barArea_threshold", "smooth_tolerance", "spacing_length",
+              "cross_length")
+PRODUCTS = ("landClass", "wetChannelBoundary", "activeChannel", "channelUnit")
+
+Job = namedtuple("Job", ["job_id", "river", "year", "command", "workspace", "memory_mb"])
+
+
+def read_manifest(path):
+    """Rows of the manifest; a river may have only one scene per year.
+
+    The products, the scratch workspace and the job state of a scene are
+    keyed by river and year, so two rows with the same pair are rejected.
+    """
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    seen = {}
+    duplicates = []
+    for line, row in enumerate(rows, 2):
+        key = (row["river"], str(row["year"]))
+        if key in seen:
+            duplicates.append("%s %s (lines %d and %d)" % (key + (seen[key], line)))
+        else:
+            seen[key] = line
+    if duplicates:
+        raise ValueError("more than one scene for a river and year: " + ", ".join(duplicates))
+    return rows
+
+
+def python_executable():
+    """python.exe of the ArcGIS environment, also when run from ArcGISPro.exe."""
+    exe = sys.executable
+    if os.name == "nt" and os.path.basename(exe).lower() not in ("python.exe", "pythonw.exe"):
+        exe = os.path.join(sys.exec_prefix, "python.exe")
+    return exe
+
+
+class JobState(object):
+    """Per-job state stored as JSON, written atomically after every update."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.jobs = json.load(f)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id, {}).get("state")
+
+    def set(self, job_id, state, **info):
+        with self.lock:
+            entry = self.jobs.setdefault(job_id, {})
+            entry.update(info, state=state, time=time.strftime("%Y-%m-%d %H:%M:%S"))
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.jobs, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+
+
+def river_store(out_root, river):
+    return os.path.join(out_root, river, river + ".gdb")
+
+
+def ensure_gdb(path):
+    import arcpy
+    if not arcpy.Exists(path):
+        folder, name = os.path.split(path)
+        os.makedirs(folder, exist_ok=True)
+        arcpy.management.CreateFileGDB(folder, name)
+    return path
+
+
+def scene_jobs(rows, out_root, default_memory_mb, stage_workers=1):
+    script = os.path.join(HERE, "channel_planform_from_satellite.py")
+    jobs = []
+    for row in rows:
+        river = row["river"]
+        year = str(row["year"])
+        workspace = os.path.join(out_root, river, "jobs", year + ".gdb")
+        command = [python_executable(), script, row["scene"], row["envelope"],
+                   row["start_point"], workspace]
+        command.extend(str(row[p]) for p in PARAMETERS)
+        # The jobs already run in parallel, and memory_mb has to cover the
+        # stage worker processes of a job
+        command.append(str(stage_workers))
+        memory = float(row.get("memory_mb") or default_memory_mb)
+        jobs.append(Job(river + "_" + year, river, year, command, workspace, memory))
+    return jobs
+
+
+def metrics_job(river, rows, out_root, default_memory_mb):
+    store = river_store(out_root, river)
+    years = ";".join(sorted(str(r["year"]) for r in rows))
+    command = [python_executable(), os.path.join(HERE, "planform_metric_extraction_V4.py"),
+               rows[0]["envelope"], os.path.join(store, "transects"), store, years]
+    return Job(river + "_metrics", river, years, command, store, default_memory_mb)
+
+
+def run_job(job):
+    """Run one job in its own process; returns (returncode, stderr tail)."""
+    if not job.job_id.endswith("_metrics"):
+        ensure_gdb(job.workspace)
+    proc = subprocess.run(job.command, cwd=HERE, capture_output=True, text=True)
+    return proc.returncode, (proc.stderr or proc.stdout)[-2000:]
+
+
+def publish(job, out_root):
+    """Copy the products of a scene job into the river store and drop its scratch."""
+    import arcpy
+    store = ensure_gdb(river_store(out_root, job.river))
+    for name in PRODUCTS:
+        arcpy.management.Copy(os.path.join(job.workspace, name),
+                              os.path.join(store, name + "_" + job.year))
+    transects = os.path.join(store, "transects")
+    if not arcpy.Exists(transects):
+        arcpy.management.Copy(os.path.join(job.workspace, "transects"), transects)
+    arcpy.management.Delete(job.workspace)
+
+
+def schedule(jobs, state, out_root, workers, memory_mb, on_done=None):
+    """Run jobs on a pool bounded by worker count and total memory."""
+    pending = [j for j in jobs if state.get(j.job_id) != "done"]
+    running = {}
+    used = 0.0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for job in list(pending):
+                fits = used + job.memory_mb <= memory_mb
+                if len(running) < workers and (fits or not running):
+                    pending.remove(job)
+                    state.set(job.job_id, "running")
+                    running[pool.submit(run_job, job)] = job
+                    used += job.memory_mb
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                used -= job.memory_mb
+                try:
+                    code, log = future.result()
+                    if code != 0:
+                        raise RuntimeError(log)
+                    if not job.job_id.endswith("_metrics"):
+                        publish(job, out_root)
+                    state.set(job.job_id, "done")
+                    print("done   " + job.job_id)
+                except Exception as e:
+                    state.set(job.job_id, "failed", error=str(e)[-2000:])
+                    print("failed " + job.job_id)
+                if on_done is not None:
+                    pending.extend(on_done(job))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a manifest of river x scene jobs")
+    parser.add_argument("manifest")
+    parser.add_argument("out_root")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--memory-mb", type=float, default=16000)
+    parser.add_argument("--job-memory-mb", type=float, default=4000,
+                        help="memory of jobs without a memory_mb column")
+    parser.add_argument("--stage-workers", type=int, default=1,
+                        help="stage worker processes of every scene job")
+    parser.add_argument("--metrics", action="store_true",
+                        help="run the metric extraction per river when its scenes are done")
+    args = parser.parse_args(argv)
+
+    rows = read_manifest(args.manifest)
+    state = JobState(args.manifest + ".state.json")
+    jobs = scene_jobs(rows, args.out_root, args.job_memory_mb, args.stage_workers)
+
+    by_river = {}
+    for row, job in zip(rows, jobs):
+        by_river.setdefault(job.river, []).append((row, job))
+
+    def river_finished(job):
+        # Queue the metrics of a river once all of its scenes are done
+        if not args.metrics or job.job_id.endswith("_metrics"):
+            return []
+        entries = by_river[job.river]
+        if all(state.get(j.job_id) == "done" for _, j in entries):
+            metrics = metrics_job(job.river, [r for r, _ in entries],
+                                  args.out_root, args.job_memory_mb)
+            if state.get(metrics.job_id) != "done":
+                return [metrics]
+        return []
+
+    if args.metrics:
+        # Rivers finished in an earlier run but without their metrics
+        for river, entries in by_river.items():
+            if all(state.get(j.job_id) == "done" for _, j in entries):
+                jobs.append(metrics_job(river, [r for r, _ in entries],
+                                        args.out_root, args.job_memory_mb))
+    schedule(jobs, state, args.out_root, args.workers, args.memory_mb, river_finished)
+    failed = [k for k, v in state.jobs.items() if v.get("state") == "failed"]
+    if failed:
+        print("failed jobs: " + ", ".join(sorted(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark history and performance regression gate
+
+The stages of the pipeline are run on fixed reference inputs:
+
+    classification: channel_raster.classify of the reference bands
+    channel_extraction: tile_pipeline.extract_channels
+    unit_attributes: vectorizing the units with their attribute table
+    transect_metrics: Ww, Aw and thread counts of the reference transects
+    segmentation: E-divisive segmentation of the metrics with the R ecp
+        package, skipped when rpy2 is not available
+
+Each stage records its best time over the repeats, its peak memory over one
+more run and a checksum and summary values of its outputs. The memory run
+is done in a forked child process, and the peak is the growth of its peak
+resident set size, so shared memory and numba allocations are counted. On
+Linux the child first hands the free heap of the parent back to the system
+and resets its peak, so that neither hides the memory of the stage;
+where the resource module is missing (Windows) it falls back to the peak
+traced by tracemalloc. Runs are appended to a JSON lines history file,
+benchmark_history.jsonl next to this script unless --history is given. A
+run is compared with the baseline, the last run marked with --set-baseline
+or the given --baseline file: a stage fails when it is slower or uses more
+memory than the tolerances allow, or when its outputs drift beyond the
+relative tolerance. The report lists every stage and the command exits
+with 1 on any failure.
+
+The reference inputs are a synthetic scene made from a seed, or a .npz file
+with green, red, nir, swir and inside arrays and the cell size.
+
+The loop kernels (kernels.py) run with the backend given by --kernels;
+--kernels both runs the stages with the numpy and numba kernels and checks
+that their outputs are identical.
+
+Usage:
+    python benchmark.py [--inputs reference.npz] [--history benchmark_history.jsonl]
+        [--repeat 3] [--time-tolerance 0.25] [--memory-tolerance 0.25]
+        [--rtol 1e-6] [--set-baseline] [--baseline run.json] [--stages a,b]
+        [--kernels auto|numba|numpy|both]
+"""
+
+import argparse
+import ctypes
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import kernels
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ("classification", "channel_extraction", "unit_attributes",
+          "transect_metrics", "segmentation")
+THRESHOLDS = {"ndvi_threshold": 0.2, "mndwi_threshold": 0.0,
+              "waterArea_threshold": 90000, "barArea_threshold": 3600}
+
+
+def reference_scene(size=1024, seed=7, cell=30.0):
+    """Synthetic braided reach: two threads around bars on a diagonal valley."""
+    from scipy import ndimage
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size].astype(np.float64)
+    along = (xx + yy) / np.sqrt(2)
+    across = (yy - xx) / np.sqrt(2)
+    split = 25 * np.clip(np.sin(along / 90), 0, None)
+    thread = np.minimum(abs(across - split), abs(across + split))
+    water = thread < 12
+    sand = (abs(across) < 60) & ~water
+    noise = lambda s: ndimage.gaussian_filter(rng.random((size, size)), s)
+    green = np.where(water, 0.6, 0.2) + 0.2 * noise(2)
+    swir = np.where(water, 0.2, 0.5) + 0.2 * noise(2)
+    red = 0.3 + 0.05 * noise(2)
+    nir = np.where(water | sand, 0.3, 0.7) + 0.2 * noise(3)
+    inside = abs(across) < size / 3.0
+    return {"green": green.astype(np.float32), "red": red.astype(np.float32),
+            "nir": nir.astype(np.float32), "swir": swir.astype(np.float32),
+            "inside": inside, "cell": np.float64(cell)}
+
+
+def load_inputs(path=None):
+    if path is None:
+        return reference_scene()
+    with np.load(path) as data:
+        return dict((k, data[k]) for k in data.files)
+
+
+def reference_transects(inputs, spacing=10):
+    """Transects across the valley every spacing pixels, in map coordinates."""
+    size = inputs["inside"].shape[0]
+    cell = float(inputs["cell"])
+    t = np.arange(spacing, size - spacing, spacing, dtype=np.float64)
+    half = size / 4.0
+    a = np.column_stack((t - half / np.sqrt(2), t + half / np.sqrt(2)))
+    b = np.column_stack((t + half / np.sqrt(2), t - half / np.sqrt(2)))
+    xy = np.stack((a, b), axis=1)
+    # Pixel (col, row) to map (x, y) with the origin at the upper left corner
+    xy[..., 1] = size - xy[..., 1]
+    return np.clip(xy, 0, size) * cell
+
+
+def digest(*arrays):
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        if a.dtype.kind == "f":
+            a = np.round(a.astype(np.float64), 6)
+        h.update(str(a.dtype).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+#### Stages: each takes the inputs and the results of earlier stages and
+#### returns (outputs, checksum, summary values)
+
+def stage_classification(inputs, results):
+    import channel_raster
+    land_class = channel_raster.classify(
+        inputs["green"], inputs["red"], inputs["nir"], inputs["swir"],
+        THRESHOLDS["ndvi_threshold"], THRESHOLDS["mndwi_threshold"], inputs["inside"])
+    values = np.bincount(land_class.ravel(), minlength=256)[[0, 1, 2, 255]]
+    return land_class, digest(land_class), values.tolist()
+
+
+def stage_channel_extraction(inputs, results):
+    import tile_pipeline
+    products = tile_pipeline.extract_channels(
+        (inputs["green"], inputs["red"], inputs["nir"], inputs["swir"]),
+        inputs["inside"], float(inputs["cell"]), tile_size=256, workers=1, **THRESHOLDS)
+    values = [int(products["wet"].sum()), int(products["active"].sum()),
+              int(products["units"].max())]
+    return products, digest(products["wet"], products["active"], products["units"]), values
+
+
+def stage_unit_attributes(inputs, results):
+    import raster_vectorize
+    products = results["channel_extraction"]
+    table = products["unitTable"]
+    polys = raster_vectorize.polygons(products["units"], table["Unit_Id"], (0.0, 0.0),
+                                      float(inputs["cell"]), tile_size=256, workers=1,
+                                      components=products["units"])
+    vertices = sum(len(r) for _, rings in polys for r in rings)
+    values = [len(polys), vertices, float(table["Unit_Area"].sum()), float(table["Veg_Area"].sum())]
+    return polys, digest(table["Unit_Area"], table["Veg_Ratio"]), values
+
+
+def stage_transect_metrics(inputs, results):
+    import channel_network
+    import raster_vectorize
+    import transect_intersect
+    products = results["channel_extraction"]
+    cell = float(inputs["cell"])
+    origin = (0.0, products["wet"].shape[0] * cell)
+    xy = reference_transects(inputs)
+    metrics = []
+    for mask in (products["wet"], products["active"]):
+        polys = raster_vectorize.polygons(mask.astype(np.uint8), [1], origin, cell,
+                                          tile_size=256, workers=1)
+        edges = transect_intersect.ring_edges([r for _, rings in polys for r in rings])
+        metrics.append(transect_intersect.EdgeIndex(edges).intersect(xy).length)
+    water = (results["classification"] == 0) & products["wet"]
+    network = channel_network.build_network(water, cell, origin)
+    threads = channel_network.thread_counts(network.segments, network.segment_link, xy)
+    metrics.append(threads.astype(np.float64))
+    metrics = np.column_stack(metrics)
+    values = metrics.sum(axis=0).tolist()
+    return metrics, digest(metrics), values
+
+
+def stage_segmentation(inputs, results):
+    from rpy2.robjects.packages import importr
+    import pandas as pd
+    metrics = pd.DataFrame(results["transect_metrics"], columns=["Ww", "Aw", "Threads"])
+    seg_in = metrics.rolling(11, center=True).mean().dropna()
+    seg_in = (seg_in - seg_in.min()) / (seg_in.max() - seg_in.min()).replace(0, 1)
+    np.random.seed(0)
+    ecp = importr("ecp")
+    base = importr("base")
+    base.set_seed(0)
+    seg = ecp.e_divisive(X=np.asmatrix(seg_in.astype(np.float64)), sig_lvl=0.01, R=199,
+                         min_size=11, alpha=1)
+    estimates = np.array(seg.rx("estimates")[0]).astype(int)
+    return estimates, digest(estimates), estimates.tolist()
+
+
+def memory_kind():
+    return "traced" if resource is None else "rss"
+
+
+def _peak_rss():
+    """Peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _reset_peak():
+    """Release the free heap and reset the peak resident set size, on Linux."""
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (AttributeError, OSError):
+        pass
+
+
+def _rss_run(name, inputs, results, conn):
+    _reset_peak()
+    before = _peak_rss()
+    globals()["stage_" + name](inputs, results)
+    conn.send(_peak_rss() - before)
+    conn.close()
+
+
+def peak_memory(name, inputs, results):
+    """Peak memory of one run of a stage in bytes, as in the module docstring."""
+    if resource is None:
+        tracemalloc.start()
+        try:
+            globals()["stage_" + name](inputs, results)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=_rss_run, args=(name, inputs, results, sender))
+    child.start()
+    sender.close()
+    try:
+        peak = receiver.recv()
+    except EOFError:
+        raise RuntimeError("stage %s failed in the memory run" % name)
+    finally:
+        child.join()
+    return peak
+
+
+def run_stage(name, inputs, results, repeat, trace=True):
+    """Best time, peak memory and outputs of a stage.
+
+    The peak memory comes from one more run when trace is true.
+    """
+    fn = globals()["stage_" + name]
+    best = None
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        out = fn(inputs, results)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    peak = peak_memory(name, inputs, results) if trace else 0
+    outputs, checksum, values = out
+    results[name] = outputs
+    return {"seconds": round(best, 4), "peak_mb": round(peak / 1e6, 2),
+            "checksum": checksum, "values": values}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run(stages, inputs, repeat):
+    results = {}
+    record = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "revision": git_revision(),
+              "memory": memory_kind(), "stages": {}}
+    for name in STAGES:
+        needed = name in stages or any(
+            STAGES.index(s) > STAGES.index(name) for s in stages)
+        if not needed:
+            continue
+        try:
+            record["stages"][name] = run_stage(name, inputs, results, repeat if name in stages else 1,
+                                               trace=name in stages)
+        except ImportError as e:
+            record["stages"][name] = {"skipped": str(e)}
+        if name not in stages:
+            record["stages"].pop(name)
+    return record
+
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(run_record, baseline, time_tolerance, memory_tolerance, rtol):
+    """Per-stage comparison rows and whether any stage failed."""
+    rows, failed = [], False
+    for name, stage in run_record["stages"].items():
+        base = baseline["stages"].get(name)
+        if "skipped" in stage or base is None or "skipped" in base:
+            rows.append((name, "skipped" if "skipped" in stage else "new", ""))
+            continue
+        problems = []
+        if stage["seconds"] > base["seconds"] * (1 + time_tolerance):
+            problems.append("time %.3fs -> %.3fs (+%.0f%%)" % (
+                base["seconds"], stage["seconds"],
+                100 * (stage["seconds"] / max(base["seconds"], 1e-9) - 1)))
+        if stage["peak_mb"] > base["peak_mb"] * (1 + memory_tolerance):
+            problems.append("memory %.1fMB -> %.1fMB" % (base["peak_mb"], stage["peak_mb"]))
+        if stage["checksum"] != base["checksum"]:
+            a = np.asarray(base["values"], np.float64)
+            b = np.asarray(stage["values"], np.float64)
+            if a.shape != b.shape or not np.allclose(a, b, rtol=rtol, atol=0):
+                problems.append("outputs drifted: %s -> %s" % (base["values"], stage["values"]))
+            else:
+                problems.append("checksum changed within tolerance")
+        drift = [p for p in problems if not p.startswith("checksum")]
+        failed |= bool(drift)
+        rows.append((name, "FAIL" if drift else "ok", "; ".join(problems) or
+                     "%.3fs, %.1fMB" % (stage["seconds"], stage["peak_mb"])))
+    return rows, failed
+
+
+def check_kernels(stages, inputs):
+    """Run the stages with the numpy and numba kernels and compare the checksums.
+
+    Each backend runs once untimed first, so that the numba times do not
+    include compiling the kernels.
+    """
+    runs = {}
+    for backend in ("numpy", "numba"):
+        kernels.use(backend)
+        run(stages, inputs, 1)
+        runs[backend] = run(stages, inputs, 1)
+    failed = False
+    for name, stage in runs["numpy"]["stages"].items():
+        other = runs["numba"]["stages"][name]
+        if "skipped" in stage:
+            print("%-20s skipped" % name)
+            continue
+        same = stage["checksum"] == other["checksum"]
+        failed |= not same
+        print("%-20s %-9s numpy %.3fs, numba %.3fs" % (
+            name, "identical" if same else "DIFFERENT", stage["seconds"], other["seconds"]))
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages")
+    parser.add_argument("--inputs", help=".npz reference inputs (default: synthetic scene)")
+    parser.add_argument("--history", default=os.path.join(HERE, "benchmark_history.jsonl"))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--time-tolerance", type=float, default=0.25)
+    parser.add_argument("--memory-tolerance", type=float, default=0.25)
+    parser.add_argument("--rtol", type=float, default=1e-6)
+    parser.add_argument("--baseline", help="JSON file of a baseline run")
+    parser.add_argument("--set-baseline", action="store_true",
+                        help="mark this run as the baseline of later runs")
+    parser.add_argument("--kernels", default="auto", choices=kernels.BACKENDS + ("both",),
+                        help="backend of the loop kernels; both checks that the numba and "
+                             "numpy kernels give identical outputs")
+    args = parser.parse_args(argv)
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error("unknown stages: " + ", ".join(unknown))
+
+    inputs = load_inputs(args.inputs)
+    if args.kernels == "both":
+        return check_kernels(stages, inputs)
+    kernels.use(args.kernels)
+    record = run(stages, inputs, args.repeat)
+    record["inputs"] = args.inputs or "synthetic"
+    record["kernels"] = kernels.backend()
+    history = read_history(args.history)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        # Peaks measured another way are not comparable
+        marked = [r for r in history if r.get("baseline") and r.get("inputs") == record["inputs"]
+                  and r.get("memory", "traced") == record["memory"]]
+        baseline = marked[-1] if marked else None
+    record["baseline"] = bool(args.set_baseline)
+    with open(args.history, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    if baseline is None or args.set_baseline:
+        for name, stage in record["stages"].items():
+            print("%-20s %s" % (name, stage.get("skipped") or
+                                "%.3fs, %.1fMB, %s" % (stage["seconds"], stage["peak_mb"],
+                                                      stage["checksum"][:10])))
+        return 0
+    rows, failed = compare(record, baseline, args.time_tolerance, args.memory_tolerance, args.rtol)
+    print("baseline %s (%s)" % (baseline.get("time", ""), baseline.get("revision", "")))
+    for name, status, detail in rows:
+        print("%-20s %-8s %s" % (name, status, detail))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk writer for the vector products of a run
+
+The layers of a run are built in memory as geometries and attribute rows
+and written together at the end:
+
+    GeoPackage (.gpkg): with sqlite3 in a single transaction, geometries
+    encoded as GeoPackage WKB blobs and inserted in batches. The R-tree
+    spatial index of each layer is filled once after loading and its
+    maintenance triggers are created last. If a layer fails the
+    transaction is rolled back and the file is left as it was.
+
+    File geodatabase: with InsertCursors inside one edit session, the
+    spatial index of each feature class removed before loading and added
+    once after.
+
+Geometries are given as:
+    POLYGON: a list of rings, the exterior first, each an (n, 2) array
+    MULTIPOLYGON: a list of such polygons
+    LINESTRING: an (n, 2) array; MULTILINESTRING: a list of them
+    POINT: an (x, y) pair
+Rings need not be closed. In GeoPackages exteriors are written
+counterclockwise and holes clockwise, as in Simple Features.
+"""
+
+import os
+import sqlite3
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+# name, geometry type, [(field name, "INTEGER" | "REAL" | "TEXT")], geometries
+# and attribute rows in the order of the fields
+Layer = namedtuple("Layer", ["name", "geometry_type", "fields", "geometries", "rows"])
+
+ARCPY_TYPES = {"POINT": "POINT", "LINESTRING": "POLYLINE", "MULTILINESTRING": "POLYLINE",
+               "POLYGON": "POLYGON", "MULTIPOLYGON": "POLYGON"}
+FIELD_TYPES = {"INTEGER": "LONG", "REAL": "DOUBLE", "TEXT": "TEXT"}
+# srs_id used when the coordinate system has no EPSG code
+CUSTOM_SRS_ID = 100000
+
+
+def field_type(value):
+    """SQL type of a Python or NumPy value."""
+    if isinstance(value, (bool, int, np.integer)):
+        return "INTEGER"
+    if isinstance(value, (float, np.floating)):
+        return "REAL"
+    return "TEXT"
+
+
+def polygon_layer(name, polys, field="Class", attributes=None):
+    """Layer of (value, rings) polygons as produced by raster_vectorize.
+
+    attributes optionally maps a value to a dict of extra field values.
+    """
+    fields = [(field, "INTEGER")]
+    names = []
+    if attributes:
+        for key, v in next(iter(attributes.values())).items():
+            fields.append((key, field_type(v)))
+            names.append(key)
+    geometries, rows = [], []
+    for value, rings in polys:
+        geometries.append(rings)
+        row = [int(value)]
+        if names:
+            row.extend(attributes[value][key] for key in names)
+        rows.append(tuple(row))
+    return Layer(name, "POLYGON", fields, geometries, rows)
+
+
+def _ring(ring, clockwise):
+    ring = np.asarray(ring, np.float64)
+    if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+        ring = ring[:-1]
+    x, y = ring[:, 0], ring[:, 1]
+    area = 0.5 * (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+    if (area < 0) != clockwise:
+        ring = ring[::-1]
+    return np.vstack((ring, ring[:1]))
+
+
+def _points(xy):
+    xy = np.ascontiguousarray(xy, dtype="<f8")
+    return struct.pack("<I", len(xy)) + xy.tobytes()
+
+
+def wkb(geometry, geometry_type):
+    """Little endian WKB of a geometry."""
+    if geometry_type == "POINT":
+        return struct.pack("<BIdd", 1, 1, float(geometry[0]), float(geometry[1]))
+    if geometry_type == "LINESTRING":
+        return struct.pack("<BI", 1, 2) + _points(geometry)
+    if geometry_type == "POLYGON":
+        rings = [_ring(r, k > 0) for k, r in enumerate(geometry)]
+        return struct.pack("<BII", 1, 3, len(rings)) + b"".join(_points(r) for r in rings)
+    if geometry_type == "MULTILINESTRING":
+        return (struct.pack("<BII", 1, 5, len(geometry)) +
+                b"".join(wkb(g, "LINESTRING") for g in geometry))
+    if geometry_type == "MULTIPOLYGON":
+        return (struct.pack("<BII", 1, 6, len(geometry)) +
+                b"".join(wkb(g, "POLYGON") for g in geometry))
+    raise ValueError("Unsupported geometry type " + geometry_type)
+
+
+def envelope(geometry, geometry_type):
+    """(minx, maxx, miny, maxy) of a geometry."""
+    if geometry_type == "POINT":
+        xy = np.asarray(geometry, np.float64).reshape(1, 2)
+    elif geometry_type in ("LINESTRING", "POLYGON"):
+        xy = np.asarray(geometry if geometry_type == "LINESTRING" else geometry[0],
+                        np.float64).reshape(-1, 2)
+    else:
+        xy = np.vstack([np.asarray(g if geometry_type == "MULTILINESTRING" else g[0],
+                                   np.float64).reshape(-1, 2) for g in geometry])
+    return xy[:, 0].min(), xy[:, 0].max(), xy[:, 1].min(), xy[:, 1].max()
+
+
+def gpkg_blob(geometry, geometry_type, srs_id):
+    """GeoPackage geometry blob: header with the xy envelope, then WKB."""
+    minx, maxx, miny, maxy = envelope(geometry, geometry_type)
+    # Version 0, flags: envelope [minx, maxx, miny, maxy] and little endian
+    header = struct.pack("<2sBBi4d", b"GP", 0, 0b00000011, srs_id, minx, maxx, miny, maxy)
+    return header + wkb(geometry, geometry_type), (minx, maxx, miny, maxy)
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def create_gpkg(conn):
+    """Core GeoPackage tables of an empty database."""
+    conn.execute("PRAGMA application_id = 1196444487")
+    conn.execute("PRAGMA user_version = 10200")
+    # Statement by statement, as executescript would commit the transaction
+    for statement in """
+        CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+            srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY,
+            organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL,
+            definition TEXT NOT NULL, description TEXT);
+        CREATE TABLE IF NOT EXISTS gpkg_contents (
+            table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL,
+            identifier TEXT UNIQUE, description TEXT DEFAULT '',
+            last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+            min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+            srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id));
+        CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (
+            table_name TEXT NOT NULL, column_name TEXT NOT NULL,
+            geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL,
+            z TINYINT NOT NULL, m TINYINT NOT NULL,
+            CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name));
+        CREATE TABLE IF NOT EXISTS gpkg_extensions (
+            table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL,
+            definition TEXT NOT NULL, scope TEXT NOT NULL,
+            CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name));
+        INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES
+            ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', NULL),
+            ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', NULL);
+        """.split(";")[:-1]:
+        conn.execute(statement)
+    conn.execute("INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, 4326, 'EPSG', 4326, ?, NULL)",
+                 ("WGS 84 geodetic", 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",'
+                  '6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]'))
+
+
+def rtree_triggers(table, column):
+    """Triggers keeping the R-tree of a layer in step with later edits."""
+    t, c = table, column
+    rtree = _quote("rtree_%s_%s" % (t, c))
+    values = ("(NEW.fid, ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}), "
+              "ST_MinY(NEW.{c}), ST_MaxY(NEW.{c}))").format(c=_quote(c))
+    name = lambda suffix: _quote("rtree_%s_%s_%s" % (t, c, suffix))
+    return [
+        "CREATE TRIGGER {0} AFTER INSERT ON {1} WHEN (NEW.{2} NOT NULL AND NOT ST_IsEmpty(NEW.{2})) "
+        "BEGIN INSERT OR REPLACE INTO {3} VALUES {4}; END".format(
+            name("insert"), _quote(t), _quote(c), rtree, values),
+        "CREATE TRIGGER {0} AFTER UPDATE OF {2} ON {1} WHEN OLD.fid = NEW.fid AND "
+        "(NEW.{2} NOT NULL AND NOT ST_IsEmpty(NEW.{2})) "
+        "BEGIN INSERT OR REPLACE INTO {3} VALUES {4}; END".format(
+            name("update1"), _quote(t), _quote(c), rtree, values),
+        "CREATE TRIGGER {0} AFTER UPDATE OF {2} ON {1} WHEN OLD.fid = NEW.fid AND "
+        "(NEW.{2} IS NULL OR ST_IsEmpty(NEW.{2})) "
+        "BEGIN DELETE FROM {3} WHERE id = OLD.fid; END".format(
+            name("update2"), _quote(t), _quote(c), rtree),
+        "CREATE TRIGGER {0} AFTER DELETE ON {1} WHEN OLD.{2} NOT NULL "
+        "BEGIN DELETE FROM {3} WHERE id = OLD.fid; END".format(
+            name("delete"), _quote(t), _quote(c), rtree),
+    ]
+
+
+def write_gpkg(path, layers, srs_id=None, srs_wkt=None, srs_name="", batch=10000):
+    """Write layers to a GeoPackage in one transaction; existing layers are replaced."""
+    srs = CUSTOM_SRS_ID if srs_id is None else int(srs_id)
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        # A rollback journal, so that a failing layer leaves the file as it was
+        conn.execute("PRAGMA journal_mode = DELETE")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("BEGIN")
+        create_gpkg(conn)
+        if srs_wkt is not None:
+            conn.execute("INSERT OR REPLACE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, NULL)",
+                         (srs_name or "srs", srs, "EPSG" if srs_id else "NONE",
+                          srs if srs_id else CUSTOM_SRS_ID, srs_wkt))
+        for layer in layers:
+            table = _quote(layer.name)
+            rtree = "rtree_%s_geom" % layer.name
+            conn.execute("DROP TABLE IF EXISTS " + _quote(rtree))
+            conn.execute("DROP TABLE IF EXISTS " + table)
+            for meta in ("gpkg_contents", "gpkg_geometry_columns", "gpkg_extensions"):
+                conn.execute("DELETE FROM %s WHERE table_name = ?" % meta, (layer.name,))
+            columns = "".join(", %s %s" % (_quote(f), t) for f, t in layer.fields)
+            conn.execute("CREATE TABLE %s (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom %s%s)"
+                         % (table, layer.geometry_type, columns))
+            insert = "INSERT INTO %s (fid, geom%s) VALUES (?, ?%s)" % (
+                table, "".join(", " + _quote(f) for f, _ in layer.fields),
+                ", ?" * len(layer.fields))
+            boxes = np.zeros((len(layer.geometries), 4))
+            for b0 in range(0, len(layer.geometries), batch):
+                values = []
+                for k in range(b0, min(b0 + batch, len(layer.geometries))):
+                    blob, boxes[k] = gpkg_blob(layer.geometries[k], layer.geometry_type, srs)
+                    values.append((k + 1, blob) + tuple(
+                        v.item() if isinstance(v, np.generic) else v for v in layer.rows[k]))
+                conn.executemany(insert, values)
+            extent = ((boxes[:, 0].min(), boxes[:, 2].min(), boxes[:, 1].max(), boxes[:, 3].max())
+                      if len(boxes) else (None, None, None, None))
+            conn.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, min_x, "
+                         "min_y, max_x, max_y, srs_id) VALUES (?, 'features', ?, ?, ?, ?, ?, ?)",
+                         (layer.name, layer.name) + tuple(extent) + (srs,))
+            conn.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', ?, ?, 0, 0)",
+                         (layer.name, layer.geometry_type, srs))
+            # Spatial index filled once, after the features are loaded
+            conn.execute("CREATE VIRTUAL TABLE %s USING rtree(id, minx, maxx, miny, maxy)"
+                         % _quote(rtree))
+            conn.executemany("INSERT INTO %s VALUES (?, ?, ?, ?, ?)" % _quote(rtree),
+                             [(k + 1,) + tuple(b) for k, b in enumerate(boxes.tolist())])
+            conn.execute("INSERT INTO gpkg_extensions VALUES (?, 'geom', 'gpkg_rtree_index', "
+                         "'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')",
+                         (layer.name,))
+            for trigger in rtree_triggers(layer.name, "geom"):
+                conn.execute(trigger)
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return path
+
+
+def arcpy_geometry(geometry, geometry_type, spatial_reference):
+    """arcpy geometry of a layer geometry; exteriors clockwise as in arcpy."""
+    import arcpy
+    if geometry_type == "POINT":
+        return arcpy.PointGeometry(arcpy.Point(*geometry), spatial_reference)
+    if geometry_type in ("POLYGON", "MULTIPOLYGON"):
+        polygons = [geometry] if geometry_type == "POLYGON" else geometry
+        arrays = [arcpy.Array([arcpy.Point(x, y) for x, y in _ring(ring, k == 0)])
+                  for rings in polygons for k, ring in enumerate(rings)]
+        return arcpy.Polygon(arcpy.Array(arrays), spatial_reference)
+    lines = [geometry] if geometry_type == "LINESTRING" else geometry
+    return arcpy.Polyline(arcpy.Array([arcpy.Array([arcpy.Point(x, y) for x, y in line])
+                                       for line in lines]), spatial_reference)
+
+
+def write_geodatabase(workspace, layers, spatial_reference):
+    """Write layers to a file geodatabase in one edit session."""
+    import arcpy
+    classes = []
+    for layer in layers:
+        out = arcpy.management.CreateFeatureclass(
+            workspace, layer.name, ARCPY_TYPES[layer.geometry_type],
+            spatial_reference=spatial_reference)[0]
+        for name, ftype in layer.fields:
+            arcpy.management.AddField(out, name, FIELD_TYPES[ftype], 9, "", "", name, "NULLABLE")
+        try:
+            arcpy.management.RemoveSpatialIndex(out)
+        except arcpy.ExecuteError:
+            pass
+        classes.append(out)
+    with arcpy.da.Editor(workspace):
+        for layer, out in zip(layers, classes):
+            with arcpy.da.InsertCursor(out, ["SHAPE@"] + [f for f, _ in layer.fields]) as cursor:
+                for geometry, row in zip(layer.geometries, layer.rows):
+                    cursor.insertRow([arcpy_geometry(geometry, layer.geometry_type,
+                                                     spatial_reference)] + list(row))
+    for out in classes:
+        arcpy.management.AddSpatialIndex(out)
+    return classes
+
+
+def write_layers(workspace, layers, spatial_reference=None):
+    """Write layers to a GeoPackage or a file geodatabase by the workspace path."""
+    if os.path.splitext(workspace)[1].lower() == ".gpkg":
+        srs_id, srs_wkt, srs_name = None, None, ""
+        if spatial_reference is not None:
+            srs_id = spatial_reference.factoryCode or None
+            srs_wkt = spatial_reference.exportToString()
+            srs_name = spatial_reference.name
+        return write_gpkg(workspace, layers, srs_id, srs_wkt, srs_name)
+    return write_geodatabase(workspace, layers, spatial_reference)
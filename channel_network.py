@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+Topological graph of the wet channel threads
+
+The water inside the wet channel boundary is thinned to a one pixel wide
+skeleton, which is split into nodes and links:
+
+    Nodes: skeleton pixels with three or more branches (confluences and
+    bifurcations, adjacent ones joined into one node) and ends of threads.
+    Links: the remaining skeleton pixels, labeled 8-connected, each joining
+    the nodes it touches. A link carries its length along the skeleton and
+    its mean width from the distance transform of the water.
+
+Spurs shorter than the width of the channel they leave are pruned before
+the graph is built. Links are kept as 2-point segments in map coordinates
+so that thread counts per transect are answered with the grid index of
+transect_intersect instead of overlays.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from scipy import ndimage
+
+import transect_intersect
+
+# Offsets of the 8 neighbours in the order P2..P9 of Zhang and Suen (1984):
+# N, NE, E, SE, S, SW, W, NW
+NEIGHBOURS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+EIGHT = np.ones((3, 3), bool)
+
+Network = namedtuple("Network", ["nodes", "links", "segments", "segment_link"])
+
+
+def neighbours(mask):
+    """The 8 neighbour planes P2..P9 of a boolean array, False outside it."""
+    padded = np.pad(mask, 1)
+    rows, cols = mask.shape
+    return [padded[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols] for dr, dc in NEIGHBOURS]
+
+
+def transitions(p):
+    """Number of 0 to 1 transitions around each pixel in the order P2..P9, P2."""
+    return sum((~p[k] & p[(k + 1) % 8]).astype(np.uint8) for k in range(8))
+
+
+def branches(p):
+    """Number of 8-connected groups of neighbours around each pixel.
+
+    A diagonal neighbour is taken as set when both orthogonal neighbours
+    next to it are, since these touch each other.
+    """
+    q = [p[k] | (p[k - 1] & p[(k + 1) % 8]) if k % 2 else p[k] for k in range(8)]
+    return transitions(q)
+
+
+def thin(mask):
+    """Zhang-Suen thinning of a boolean mask to a one pixel wide skeleton."""
+    skel = mask.astype(bool).copy()
+    while True:
+        changed = False
+        for first in (True, False):
+            p = neighbours(skel)
+            count = sum(q.astype(np.uint8) for q in p)
+            if first:
+                keep = ~(p[0] & p[2] & p[4]) & ~(p[2] & p[4] & p[6])
+            else:
+                keep = ~(p[0] & p[2] & p[6]) & ~(p[0] & p[4] & p[6])
+            delete = skel & (count >= 2) & (count <= 6) & (transitions(p) == 1) & keep
+            if delete.any():
+                skel &= ~delete
+                changed = True
+        if not changed:
+            return skel
+
+
+def remove_stairs(skel):
+    """Drop the corner pixels of stair steps left by the thinning.
+
+    A pixel whose two orthogonal neighbours on one side touch each other
+    and which has no other branch is redundant for 8-connectivity.
+    """
+    skel = skel.copy()
+    for k in (0, 2, 4, 6):
+        p = neighbours(skel)
+        corner = skel & p[k] & p[(k + 2) % 8] & ~p[k + 1] & (branches(p) == 1)
+        skel &= ~corner
+    return skel
+
+
+def classify_pixels(skel):
+    """Junction and end pixels of a skeleton."""
+    p = neighbours(skel)
+    count = branches(p)
+    junction = skel & (count >= 3)
+    end = skel & (count <= 1)
+    return junction, end
+
+
+def link_segments(skel, links):
+    """Segments between adjacent pixels of a link, or a link and a node.
+
+    Diagonal steps are left out where an orthogonal neighbour of both
+    pixels is on the skeleton, so a stair step is not counted twice.
+    Returns (row, col) pairs and the link of each segment.
+    """
+    rows, cols = skel.shape
+    padded = np.pad(skel, 1)
+    labels = np.pad(links, 1)
+    pairs, owner = [], []
+    for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        a = padded[1:1 + rows, 1:1 + cols]
+        b = padded[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+        la = labels[1:1 + rows, 1:1 + cols]
+        lb = labels[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+        ok = a & b & ((la > 0) | (lb > 0)) & ((la == lb) | (la == 0) | (lb == 0))
+        if dr and dc:
+            corner = (padded[1 + dr:1 + dr + rows, 1:1 + cols] |
+                      padded[1:1 + rows, 1 + dc:1 + dc + cols])
+            ok &= ~corner
+        r, c = np.nonzero(ok)
+        pairs.append(np.stack((np.column_stack((r, c)), np.column_stack((r + dr, c + dc))), axis=1))
+        owner.append(np.maximum(la[r, c], lb[r, c]))
+    return np.concatenate(pairs), np.concatenate(owner)
+
+
+def skeleton_graph(skel, joined=None):
+    """Node and link labels of a skeleton and the nodes of each link.
+
+    Pixels of joined are taken as junction pixels, which merges the nodes
+    at both ends of a short link into one. Junction nodes are numbered
+    before end nodes.
+    """
+    junction, end = classify_pixels(skel)
+    if joined is not None:
+        junction |= joined
+    nodes, njunction = ndimage.label(junction, structure=EIGHT)
+    end_r, end_c = np.nonzero(end & ~junction)
+    nodes[end_r, end_c] = njunction + 1 + np.arange(len(end_r))
+    nnodes = njunction + len(end_r)
+    links, nlinks = ndimage.label(skel & (nodes == 0), structure=EIGHT)
+    # Nodes touching each link
+    touch = set()
+    padded_nodes = np.pad(nodes, 1)
+    rows, cols = skel.shape
+    for dr, dc in NEIGHBOURS:
+        shifted = padded_nodes[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+        hit = (links > 0) & (shifted > 0)
+        touch.update(zip(links[hit].tolist(), shifted[hit].tolist()))
+    ends = [[] for _ in range(nlinks + 1)]
+    for link, node in sorted(touch):
+        ends[link].append(node)
+    return nodes, nnodes, links, nlinks, ends
+
+
+def mean_by_label(labels, nlabels, values):
+    size = np.bincount(labels.ravel(), minlength=nlabels + 1)
+    total = np.bincount(labels.ravel(), weights=values.ravel(), minlength=nlabels + 1)
+    return size, total / np.maximum(size, 1)
+
+
+def prune_spurs(skel, width, factor=1.0):
+    """Remove links ending in a thread end and shorter than factor * width."""
+    nodes, nnodes, links, nlinks, ends = skeleton_graph(skel)
+    junction, end = classify_pixels(skel)
+    size, mean_width = mean_by_label(links, nlinks, width)
+    end_nodes = set(np.unique(nodes[end & ~junction]).tolist())
+    spur = np.zeros(nlinks + 1, bool)
+    for link in range(1, nlinks + 1):
+        attached = ends[link]
+        if (len(attached) == 2 and any(n in end_nodes for n in attached) and
+                not all(n in end_nodes for n in attached) and size[link] < factor * mean_width[link]):
+            spur[link] = True
+    if not spur.any():
+        return skel, False
+    remove = spur[links]
+    # The end pixel of a pruned spur goes with it
+    for link in np.flatnonzero(spur):
+        for n in ends[link]:
+            if n in end_nodes:
+                remove |= nodes == n
+    return skel & ~remove, True
+
+
+def thread_width(mask):
+    """Width across the thread at its centre, in pixels, from the distance transform.
+
+    On the medial axis the distance to the nearest background pixel is half
+    the width plus half a pixel.
+    """
+    return np.maximum(2 * ndimage.distance_transform_edt(np.pad(mask, 1))[1:-1, 1:-1] - 1, 0)
+
+
+def build_network(water, cell_size, origin, prune=1.0, iterations=3):
+    """Graph of the water threads of a boolean raster.
+
+    origin is the (x, y) map coordinate of the upper left corner. Returns a
+    Network of node and link record arrays, the link segments as an
+    (S, 2, 2) array in map coordinates and the link of each segment.
+    """
+    water = np.asarray(water, bool)
+    cell_size = float(cell_size)
+    width = thread_width(water)
+    skel = remove_stairs(thin(water))
+    for _ in range(iterations):
+        skel, changed = prune_spurs(skel, width, prune)
+        if not changed:
+            break
+    skel = remove_stairs(thin(skel))
+    nodes, nnodes, links, nlinks, ends = skeleton_graph(skel)
+    # Junctions split by thinning are joined across links shorter than the
+    # channel width, and such short loops are dropped
+    size, mean_width = mean_by_label(links, nlinks, width)
+    _, end = classify_pixels(skel)
+    end_nodes = set(np.unique(nodes[end]).tolist())
+    short = np.zeros(nlinks + 1, bool)
+    for link in range(1, nlinks + 1):
+        attached = ends[link]
+        if (attached and not any(n in end_nodes for n in attached) and
+                size[link] < prune * mean_width[link]):
+            short[link] = True
+    if short.any():
+        nodes, nnodes, links, nlinks, ends = skeleton_graph(skel, short[links])
+
+    pairs, owner = link_segments(skel, links)
+    step = np.hypot(*(pairs[:, 1] - pairs[:, 0]).T)
+    length = np.bincount(owner, weights=step, minlength=nlinks + 1)[1:] * cell_size
+    size = np.bincount(links.ravel(), minlength=nlinks + 1)[1:]
+    total_width = np.bincount(links.ravel(), weights=width.ravel(), minlength=nlinks + 1)[1:]
+
+    link_table = np.zeros(nlinks, dtype=[("Link_Id", np.int32), ("From_Node", np.int32),
+                                         ("To_Node", np.int32), ("Length", np.float64),
+                                         ("Width", np.float64)])
+    link_table["Link_Id"] = np.arange(1, nlinks + 1)
+    link_table["From_Node"] = [e[0] if e else 0 for e in ends[1:]]
+    link_table["To_Node"] = [e[-1] if e else 0 for e in ends[1:]]
+    link_table["Length"] = length
+    link_table["Width"] = total_width / np.maximum(size, 1) * cell_size
+
+    degree = np.zeros(nnodes + 1, np.int32)
+    for e in ends[1:]:
+        for n in e:
+            degree[n] += 1
+    index = np.arange(1, nnodes + 1)
+    r = ndimage.mean(np.indices(skel.shape)[0], nodes, index) if nnodes else np.zeros(0)
+    c = ndimage.mean(np.indices(skel.shape)[1], nodes, index) if nnodes else np.zeros(0)
+    node_table = np.zeros(nnodes, dtype=[("Node_Id", np.int32), ("X", np.float64),
+                                         ("Y", np.float64), ("Degree", np.int32)])
+    node_table["Node_Id"] = index
+    node_table["X"] = origin[0] + (np.asarray(c) + 0.5) * cell_size
+    node_table["Y"] = origin[1] - (np.asarray(r) + 0.5) * cell_size
+    node_table["Degree"] = degree[1:]
+
+    xy = np.empty(pairs.shape, np.float64)
+    xy[..., 0] = origin[0] + (pairs[..., 1] + 0.5) * cell_size
+    xy[..., 1] = origin[1] - (pairs[..., 0] + 0.5) * cell_size
+    return Network(node_table, link_table, xy, owner)
+
+
+def thread_counts(segments, segment_link, transects):
+    """Number of distinct links crossed by each (N, 2, 2) transect."""
+    transects = np.asarray(transects, np.float64).reshape(-1, 2, 2)
+    if not len(segments):
+        return np.zeros(len(transects), np.int64)
+    index = transect_intersect.EdgeIndex(segments)
+    tr, _, _, seg = index.crossings(transects)
+    link = np.asarray(segment_link)[seg]
+    pair = np.unique(tr * (int(link.max()) + 1 if len(link) else 1) + link)
+    return np.bincount(pair // (int(link.max()) + 1 if len(link) else 1),
+                       minlength=len(transects))
+
+
+def statistics(network):
+    """Link and node counts, link/node ratio, total length and mean width.
+
+    Nodes without links, the skeletons of isolated ponds, are not counted.
+    """
+    links, nodes = network.links, network.nodes[network.nodes["Degree"] > 0]
+    length = float(links["Length"].sum())
+    return {"links": len(links), "nodes": len(nodes),
+            "link_node_ratio": len(links) / float(max(len(nodes), 1)),
+            "length": length,
+            "mean_width": float((links["Width"] * links["Length"]).sum() / length) if length else 0.0}
+
+
+def length_by(segments, group):
+    """Thread length summed by group(x, y) of the segment midpoints."""
+    segments = np.asarray(segments, np.float64).reshape(-1, 2, 2)
+    if not len(segments):
+        return {}
+    mid = segments.mean(axis=1)
+    step = np.hypot(*(segments[:, 1] - segments[:, 0]).T)
+    keys = np.asarray(group(mid[:, 0], mid[:, 1]))
+    found, inverse = np.unique(keys, return_inverse=True)
+    return dict(zip(found.tolist(), np.bincount(inverse, weights=step).tolist()))
+
+
+def link_node_ratio_by(segments, segment_link, link_ends, group):
+    """Link/node ratio by group(x, y) of the segment midpoints.
+
+    A link counts in every group holding one of its segments, together with
+    the nodes at its ends; link_ends maps each Link_Id to its
+    (From_Node, To_Node).
+    """
+    segments = np.asarray(segments, np.float64).reshape(-1, 2, 2)
+    if not len(segments):
+        return {}
+    mid = segments.mean(axis=1)
+    keys = np.asarray(group(mid[:, 0], mid[:, 1]))
+    links, nodes = {}, {}
+    for key, link in set(zip(keys.tolist(), np.asarray(segment_link).tolist())):
+        links[key] = links.get(key, 0) + 1
+        nodes.setdefault(key, set()).update(n for n in link_ends.get(link, ()) if n > 0)
+    return dict((key, links[key] / float(max(len(nodes[key]), 1))) for key in links)
+
+
+def link_parts(network):
+    """Segments of each link in the order of the link table."""
+    order = np.argsort(network.segment_link, kind="stable")
+    bounds = np.searchsorted(network.segment_link[order], network.links["Link_Id"], side="left")
+    bounds = np.r_[bounds, len(order)]
+    return [network.segments[order[bounds[k]:bounds[k + 1]]] for k in range(len(network.links))]
+
+
+def network_layer(network, name):
+    """bulk_writer layer of the links as multi-linestrings of their segments."""
+    import bulk_writer
+    names = ["Link_Id", "From_Node", "To_Node", "Length", "Width"]
+    fields = [(n, "REAL" if network.links[n].dtype.kind == "f" else "INTEGER") for n in names]
+    parts = link_parts(network)
+    keep = [k for k in range(len(parts)) if len(parts[k])]
+    return bulk_writer.Layer(name, "MULTILINESTRING", fields,
+                             [list(parts[k]) for k in keep],
+                             [tuple(network.links[n][k].item() for n in names) for k in keep])
+
+
+def read_network(feature_class):
+    """Segments, their link ids and the end nodes of each link of a network layer.
+
+    The feature class is a channelNetwork layer of network_layer; the end
+    nodes are a dict of Link_Id to (From_Node, To_Node).
+    """
+    import arcpy
+    segments, owner, link_ends = [], [], {}
+    with arcpy.da.SearchCursor(feature_class, ["Link_Id", "From_Node", "To_Node", "SHAPE@"]) as cursor:
+        for link, from_node, to_node, shape in cursor:
+            link_ends[link] = (from_node or 0, to_node or 0)
+            if shape is None:
+                continue
+            for part in shape:
+                points = [(p.X, p.Y) for p in part if p is not None]
+                for a, b in zip(points[:-1], points[1:]):
+                    segments.append((a, b))
+                    owner.append(link)
+    return np.array(segments, np.float64).reshape(-1, 2, 2), np.array(owner, np.int64), link_ends
\ No newline at end of file
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy kernels for land cover classification and channel mask morphology
+
+These are the per-pixel and neighbourhood steps of Sub-tool-1 and Sub-tool-2
+of channel_planform_from_satellite.py written on arrays, so that they can run
+on tiles:
+
+    Land cover classes: 0: water; 1: sand; 2: vegetation; 255: NoData
+    MNDWI above its threshold is water, otherwise NDVI above its threshold is
+    vegetation and the rest is sand, as with the Reclassify product.
+
+Buffer distances in metres are turned into pixel radii with pixel_radius.
+
+For the coarse-to-fine mode, corridor_mask classifies a block-averaged
+overview of the bands and returns the likely active corridor (water and sand
+of the overview and the islands they enclose) dilated by a safety margin, at
+full resolution.
+"""
+
+import math
+
+import numpy as np
+from scipy import ndimage
+
+NODATA = 255
+WATER = 0
+SAND = 1
+VEGETATION = 2
+
+
+def normalized_difference(a, b):
+    """(a - b) / (a + b) as float32, NaN where the sum is zero."""
+    a = a.astype(np.float32)
+    b = b.astype(np.float32)
+    total = a + b
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total != 0, (a - b) / total, np.nan).astype(np.float32)
+
+
+def classify(green, red, nir, swir, ndvi_threshold, mndwi_threshold, inside=None):
+    """Classify band arrays into water, sand and vegetation.
+
+    inside is an optional boolean mask of the envelope; pixels outside it
+    and pixels without a valid index are NoData.
+    """
+    ndvi = normalized_difference(nir, red)
+    mndwi = normalized_difference(green, swir)
+    land_class = np.where(ndvi > float(ndvi_threshold), VEGETATION, SAND).astype(np.uint8)
+    land_class[mndwi > float(mndwi_threshold)] = WATER
+    land_class[np.isnan(ndvi) | np.isnan(mndwi)] = NODATA
+    if inside is not None:
+        land_class[~inside] = NODATA
+    return land_class
+
+
+def pixel_radius(distance, cell_size):
+    """Buffer distance in map units as a whole number of pixels."""
+    return int(math.ceil(float(distance) / float(cell_size)))
+
+
+def disk(radius):
+    """Circular structuring element of the given pixel radius."""
+    r = np.arange(-radius, radius + 1)
+    return (r[:, None] ** 2 + r[None, :] ** 2) <= radius ** 2
+
+
+def close_mask(mask, radius):
+    """Morphological closing by a disk, the raster form of a +d / -d buffer.
+
+    The mask is padded by the radius first so that shapes touching the edge
+    of the array are closed as if the plane continued with background, which
+    is also what a tile with a halo of twice the radius sees.
+    """
+    if radius <= 0:
+        return mask.copy()
+    import packed_mask
+    padded = np.pad(mask, radius)
+    closed = packed_mask.pack(padded).close(radius).unpack()
+    return closed[radius:-radius, radius:-radius]
+
+
+def structure(connectivity):
+    """Labeling structure for 4 or 8 connectivity."""
+    return ndimage.generate_binary_structure(2, 1 if connectivity == 4 else 2)
+
+
+def decimate(array, factor):
+    """Block mean over factor x factor pixels, ignoring NaN."""
+    rows, cols = array.shape
+    pad_r, pad_c = -rows % factor, -cols % factor
+    padded = np.pad(array.astype(np.float32), ((0, pad_r), (0, pad_c)),
+                    constant_values=np.nan)
+    blocks = padded.reshape(padded.shape[0] // factor, factor,
+                            padded.shape[1] // factor, factor)
+    valid = (~np.isnan(blocks)).sum(axis=(1, 3))
+    total = np.nansum(blocks, axis=(1, 3))
+    with np.errstate(invalid="ignore"):
+        return np.where(valid > 0, total / np.maximum(valid, 1), np.nan).astype(np.float32)
+
+
+def corridor_mask(bands, inside, cell_size, ndvi_threshold, mndwi_threshold,
+                  factor=8, margin=0):
+    """Likely active corridor from an overview decimated by factor.
+
+    The overview is classified with the same thresholds; its water and sand
+    blocks, with the islands they enclose, are dilated by margin (map units)
+    plus one block, brought back to the full resolution and clipped to
+    inside. Vegetated islands are kept whatever their width, so their units
+    and vegetation areas are classified.
+    """
+    green, red, nir, swir = [decimate(b, factor) for b in bands]
+    coarse_inside = decimate(inside, factor) > 0
+    land_class = classify(green, red, nir, swir, ndvi_threshold, mndwi_threshold,
+                          coarse_inside)
+    corridor = ndimage.binary_fill_holes((land_class == WATER) | (land_class == SAND))
+    import packed_mask
+    radius = pixel_radius(margin, float(cell_size) * factor) + 1
+    corridor = ndimage.binary_fill_holes(packed_mask.pack(corridor).dilate(radius).unpack())
+    full = np.repeat(np.repeat(corridor, factor, axis=0), factor, axis=1)
+    return full[:inside.shape[0], :inside.shape[1]] & inside
@@ -8,6 +8,9 @@ Created on Wed Sep 27 11:45:15 2023
 import arcpy
 import os
 
+import polygon_ring_fill
+import raster_vectorize
+
 if __name__ == '__main__':
     
     image = arcpy.GetParameterAsText(0)
@@ -38,19 +41,12 @@ if __name__ == '__main__':
         "INSIDE", 
         "")
     landClassFea = "LandClassFea" +  "_" + year 
-    arcpy.conversion.RasterToPolygon(
+    # Traced on tiles across worker processes along the pixel edges, so the
+    # classes share their boundaries and their areas are exact
+    raster_vectorize.raster_to_polygon(
         in_raster = landClassRas, 
-        out_polygon_features = landClassFea, 
-        create_multipart_features="SINGLE_OUTER_PART")
-    arcpy.management.AlterField(landClassFea,"gridcode", "Class", "Class")
-    
-    fieldsList = []
-    keep = ["Class","Shape_Area"]
-    fieldObjList = arcpy.ListFields(landClassFea)
-    for field in fieldObjList:
-        if (not field.name in keep) and (not field.required):
-            fieldsList.append(field.name)
-    arcpy.management.DeleteField(landClassFea, fieldsList)
+        out_feature_class = landClassFea, 
+        field = "Class")
     
     
     #### Wet channel boundary extraction 
@@ -61,54 +57,18 @@ if __name__ == '__main__':
         out_feature_class= water, 
         where_clause="Class = 0")
     
-    waterBuffer = "waterBuffer"
-    waterBuffer = arcpy.analysis.Buffer(
+    # Close gaps up to 80 m (twice the former 20 m + 20 m buffers) and fill
+    # holes on the polygon rings, keeping closed parts of at least 1 km2
+    wetChannel = "wetChannel" +  "_" + year
+    wetChannel = polygon_ring_fill.close_and_fill(
         in_features = water, 
-        out_feature_class = waterBuffer, 
-        buffer_distance_or_field = "20 Meters", 
-        line_end_type ="FLAT", 
-        dissolve_option="NONE", 
-        method="GEODESIC")
-    
-    waterBufferDissolve = "waterBufferDissolve" 
-    waterBufferDissolve = arcpy.gapro.DissolveBoundaries(
-        input_layer = waterBuffer, 
-        out_feature_class = waterBufferDissolve)
-
-    waterContinue = "waterContinue"
-    waterContinue  = arcpy.analysis.Select(
-        in_features = waterBufferDissolve , 
-        out_feature_class= water, 
-        where_clause="Shape_Area >= 1000000")
-    
-    waterContinueBuffer = "waterContinueBuffer"
-    waterContinueBuffer = arcpy.analysis.Buffer(
-        in_features = waterContinue, 
-        out_feature_class = waterContinueBuffer, 
-        buffer_distance_or_field = "20 Meters", 
-        line_end_type ="FLAT", 
-        dissolve_option="ALL", 
-        method="GEODESIC")
-    
-    waterContinueFilled = "waterContinueFilled"
-    waterContinueFilled  = arcpy.management.EliminatePolygonPart(
-        in_features = waterContinueBuffer, 
-        out_feature_class = waterContinue, 
+        out_feature_class = wetChannel, 
+        gap_distance = 80, 
         condition = "PERCENT", 
         part_area_percent = 99, 
-        part_option = "CONTAINED_ONLY")
-
-    wetChannel = "wetChannel" +  "_" + year
-    wetChannel  = arcpy.analysis.Buffer(
-        in_features = waterContinueFilled , 
-        out_feature_class = wetChannel , 
-        buffer_distance_or_field = "-40 Meters", 
-        line_end_type ="FLAT", 
-        dissolve_option ="ALL", 
-        method="GEODESIC")
+        min_area = 1000000)
     
-    dsets.extend((water,waterBuffer, waterBufferDissolve,waterContinue,
-                  waterContinueBuffer,waterContinueFilled))
+    dsets.append(water)
     # Delete interim datasets in workspace  
     for dset in dsets:
         arcpy.management.Delete(dset)
@@ -156,30 +116,13 @@ if __name__ == '__main__':
         out_feature_class = activeChannelPotentialArea, 
         where_clause="Shape_area >= 1000000")
 
-    activeChannelPotentialAreaBuffer = "activeChannelPotentialAreaBuffer"
-    activeChannelPotentialAreaBuffer = arcpy.analysis.Buffer(
-        in_features = activeChannelPotentialArea, 
-        out_feature_class = activeChannelPotentialAreaBuffer,
-        buffer_distance_or_field="30 Meters", 
-        line_end_type="FLAT", 
-        dissolve_option="ALL", 
-        method="GEODESIC")
-
-    activeChannelFilled = "activeChannelFilled "
-    activeChannelFilled = arcpy.management.EliminatePolygonPart(
-        in_features = activeChannelPotentialAreaBuffer, 
-        out_feature_class = activeChannelFilled, 
-        condition = "PERCENT", 
-        part_area_percent = 99, 
-        part_option = "CONTAINED_ONLY")
-
     activeChannel = "activeChannel" +  "_" + year
-    activeChannel = arcpy.analysis.Buffer(
-        in_features = activeChannelFilled , 
+    activeChannel = polygon_ring_fill.close_and_fill(
+        in_features = activeChannelPotentialArea, 
         out_feature_class = activeChannel, 
-        buffer_distance_or_field ="-30 Meters", 
-        line_end_type = "FLAT", 
-        method = "GEODESIC")
+        gap_distance = 60, 
+        condition = "PERCENT", 
+        part_area_percent = 99)
    
     arcpy.AddMessage("Extracting land within water")
     landInWater = "landInWater"
@@ -194,10 +137,10 @@ if __name__ == '__main__':
         out_feature_class = featureInWater)
 
     featureInWaterFilled = "featureInWaterFilled"
-    featureInWaterFilled = arcpy.management.EliminatePolygonPart(
-        in_features= featureInWater, 
-        out_feature_class = featureInWaterFilled , 
-        condition="PERCENT", 
+    featureInWaterFilled = polygon_ring_fill.close_and_fill(
+        in_features = featureInWater, 
+        out_feature_class = featureInWaterFilled, 
+        condition = "PERCENT", 
         part_area_percent = 99)
 
     midChannelFeature = "midChannelFeature"+ "_" + year
@@ -262,8 +205,7 @@ if __name__ == '__main__':
 
     dsets.extend((land,landOutWater,sandOutWater,sandBarOutWater,
                   activeChannelPotential,activeChannelPotentialArea,
-                  activeChannelPotentialAreaBuffer,activeChannelPotentialDissolve,
-                  activeChannelFilled,landInWater,featureInWater,
+                  activeChannelPotentialDissolve,landInWater,featureInWater,
                   featureInWaterFilled,midChannelFeatureCover,
                   summTableCover,summTableVeg))
     
@@ -7,6 +7,8 @@ Created on Wed Sep 27 20:45:09 2023
 import arcpy
 import numpy as np
 
+import linear_reference
+
 if __name__ == '__main__':
     envelope = arcpy.GetParameterAsText(0)
     startPoint = arcpy.GetParameterAsText(1)
@@ -78,6 +80,10 @@ if __name__ == '__main__':
         
     arcpy.management.DeleteField(transects, drop_field=["Distance_Max"])
     
+    # Chainage and offset along the smoothed centreline from the start point
+    linear_reference.add_chainage(
+        transects, linear_reference.from_centerline(centerLineSmooth, startPoint))
+    
     dsets.extend((centerLine,centerLineSmooth,centerLineEnds))
     for dset in dsets:
         arcpy.management.Delete(dset)
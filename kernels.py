@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the loop kernels with optional compiled implementations
+
+A few steps have no clean vectorized form and are explicit loops:
+
+    union_find: components of a graph given as edge lists, used to join the
+    labels across the tile seams (tile_pipeline.label_components)
+    follow: walking the successor links of the boundary edges into chains
+    (raster_vectorize.follow)
+    run_count: number of runs of set samples per transect, with the samples
+    in order along each transect (quick_look)
+
+Each kernel has a NumPy implementation (SciPy for union_find) and, when the
+optional numba package is installed, a compiled one giving identical
+results. The backend is chosen with use() or the CHANNEL_KERNELS environment
+variable, checked on import: "auto" (compiled when available, the
+default), "numba" or "numpy". benchmark.py --kernels runs the stages with
+either backend so their checksums can be compared.
+"""
+
+import os
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ("auto", "numba", "numpy")
+
+_registry = {}
+_backend = "auto"
+
+
+def register(name, backend):
+    """Decorator adding an implementation of a kernel."""
+    def add(fn):
+        _registry.setdefault(name, {})[backend] = fn
+        return fn
+    return add
+
+
+def use(backend):
+    """Select the backend of the kernels; returns the previous one."""
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError("unknown kernel backend %r, expected one of %s" % (backend, ", ".join(BACKENDS)))
+    if backend == "numba" and numba is None:
+        raise ImportError("the numba backend needs the numba package")
+    previous, _backend = _backend, backend
+    return previous
+
+
+use(os.environ.get("CHANNEL_KERNELS", "auto"))
+
+
+def backend():
+    """Backend in use: numba or numpy."""
+    if _backend == "auto":
+        return "numba" if numba is not None else "numpy"
+    return _backend
+
+
+def get(name):
+    implementations = _registry[name]
+    return implementations.get(backend(), implementations["numpy"])
+
+
+#### NumPy implementations
+
+@register("union_find", "numpy")
+def union_find_numpy(a, b, n):
+    """Number of components and component of each of n nodes joined by edges a-b.
+
+    Components are numbered by their smallest node.
+    """
+    graph = sparse.coo_matrix((np.ones(len(a), np.int8), (a, b)), shape=(n, n))
+    return csgraph.connected_components(graph, directed=False)
+
+
+@register("follow", "numpy")
+def follow_numpy(succ, heads, visited):
+    """Walk the successor links from each head until the chain ends or loops."""
+    chains = []
+    for h in heads:
+        if visited[h]:
+            continue
+        chain = []
+        e = h
+        while e >= 0 and not visited[e]:
+            visited[e] = True
+            chain.append(e)
+            e = succ[e]
+        chains.append(np.array(chain))
+    return chains
+
+
+@register("run_count", "numpy")
+def run_count_numpy(group, values, n):
+    """Runs of True values per group, the values of a group being contiguous."""
+    group = np.asarray(group)
+    values = np.asarray(values, bool)
+    start = values.copy()
+    start[1:] &= ~(values[:-1] & (group[1:] == group[:-1]))
+    return np.bincount(group[start], minlength=n)
+
+
+#### Compiled implementations
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _find(parent, x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    @numba.njit(cache=True)
+    def _union_find(a, b, n):
+        parent = np.arange(n)
+        for k in range(len(a)):
+            ra = _find(parent, a[k])
+            rb = _find(parent, b[k])
+            if ra != rb:
+                # The smaller root is kept, as the first node of a component
+                if ra < rb:
+                    parent[rb] = ra
+                else:
+                    parent[ra] = rb
+        label = np.full(n, -1, np.int32)
+        comp = np.empty(n, np.int32)
+        count = 0
+        for x in range(n):
+            r = _find(parent, x)
+            if label[r] < 0:
+                label[r] = count
+                count += 1
+            comp[x] = label[r]
+        return count, comp
+
+    @register("union_find", "numba")
+    def union_find_numba(a, b, n):
+        return _union_find(np.asarray(a, np.int64), np.asarray(b, np.int64), int(n))
+
+    @numba.njit(cache=True)
+    def _follow(succ, heads, visited):
+        order = np.empty(len(succ), np.int64)
+        bounds = np.empty(len(heads) + 1, np.int64)
+        bounds[0] = 0
+        nchains = 0
+        k = 0
+        for h in heads:
+            if visited[h]:
+                continue
+            e = h
+            while e >= 0 and not visited[e]:
+                visited[e] = True
+                order[k] = e
+                k += 1
+                e = succ[e]
+            nchains += 1
+            bounds[nchains] = k
+        return order[:k], bounds[:nchains + 1]
+
+    @register("follow", "numba")
+    def follow_numba(succ, heads, visited):
+        order, bounds = _follow(np.asarray(succ, np.int64), np.asarray(heads, np.int64), visited)
+        return [order[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+    @numba.njit(cache=True)
+    def _run_count(group, values, n):
+        out = np.zeros(n, np.int64)
+        for k in range(len(values)):
+            if values[k] and (k == 0 or not values[k - 1] or group[k - 1] != group[k]):
+                out[group[k]] += 1
+        return out
+
+    @register("run_count", "numba")
+    def run_count_numba(group, values, n):
+        return _run_count(np.asarray(group, np.int64), np.asarray(values, np.bool_), int(n))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Linear referencing along the smoothed river centreline
+
+The centreline is held as its vertices and their cumulative arc length.
+The vertices are densified and put in a KD-tree, so any batch of points is
+located with a nearest neighbour query and an exact projection on the few
+segments around the nearest densified vertices:
+
+    chainage: distance along the centreline from its start, in map units
+    offset: distance from the centreline, positive on the left looking
+    downstream
+
+The start is the end of the centreline nearest the start point of the
+river, as for the Distance of the transects.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class LinearReference(object):
+    """Chainage and offset of points along a polyline."""
+
+    def __init__(self, vertices, spacing=None, candidates=4):
+        xy = np.asarray(vertices, np.float64).reshape(-1, 2)
+        keep = np.r_[True, np.any(np.diff(xy, axis=0) != 0, axis=1)]
+        self.xy = xy[keep]
+        step = np.hypot(*np.diff(self.xy, axis=0).T)
+        self.cumulative = np.r_[0.0, np.cumsum(step)]
+        self.length = float(self.cumulative[-1])
+        if spacing is None:
+            spacing = np.median(step) if len(step) else 1.0
+        # Densified points and the segment each lies on
+        pieces = np.maximum(np.ceil(step / float(spacing)), 1).astype(np.int64)
+        segment = np.repeat(np.arange(len(step)), pieces)
+        k = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        f = (k / pieces[segment])[:, None]
+        points = self.xy[segment] + f * (self.xy[segment + 1] - self.xy[segment])
+        self.segment = np.r_[segment, len(step) - 1]
+        self.tree = cKDTree(np.vstack((points, self.xy[-1:])))
+        self.candidates = int(candidates)
+
+    def locate(self, points):
+        """Chainage and signed offset of (n, 2) points."""
+        points = np.asarray(points, np.float64).reshape(-1, 2)
+        k = min(self.candidates, self.tree.n)
+        _, near = self.tree.query(points, k=k)
+        near = near.reshape(len(points), k)
+        # The segments of the nearest densified points and their neighbours
+        nseg = len(self.xy) - 1
+        seg = self.segment[near]
+        seg = np.concatenate((seg, np.clip(seg - 1, 0, nseg - 1), np.clip(seg + 1, 0, nseg - 1)), axis=1)
+        a = self.xy[seg]
+        d = self.xy[seg + 1] - a
+        p = points[:, None, :] - a
+        t = np.clip((p * d).sum(axis=2) / np.maximum((d * d).sum(axis=2), 1e-300), 0, 1)
+        foot = a + t[..., None] * d
+        dist = np.hypot(*(points[:, None, :] - foot).transpose(2, 0, 1))
+        best = np.argmin(dist, axis=1)
+        rows = np.arange(len(points))
+        s = seg[rows, best]
+        chainage = self.cumulative[s] + t[rows, best] * (self.cumulative[s + 1] - self.cumulative[s])
+        cross = d[rows, best, 0] * p[rows, best, 1] - d[rows, best, 1] * p[rows, best, 0]
+        offset = np.where(cross >= 0, 1.0, -1.0) * dist[rows, best]
+        return chainage, offset
+
+    def point_at(self, chainage):
+        """(n, 2) points at the given chainages."""
+        chainage = np.clip(np.asarray(chainage, np.float64), 0, self.length)
+        s = np.clip(np.searchsorted(self.cumulative, chainage, side="right") - 1, 0, len(self.xy) - 2)
+        span = np.maximum(self.cumulative[s + 1] - self.cumulative[s], 1e-300)
+        f = ((chainage - self.cumulative[s]) / span)[:, None]
+        return self.xy[s] + f * (self.xy[s + 1] - self.xy[s])
+
+
+def line_vertices(feature_class):
+    """Vertices of the first polyline of a feature class, parts joined in order."""
+    import arcpy
+    with arcpy.da.SearchCursor(feature_class, ["SHAPE@"]) as cursor:
+        for (shape,) in cursor:
+            if shape is not None:
+                return np.array([(p.X, p.Y) for part in shape for p in part if p is not None])
+    return np.zeros((0, 2))
+
+
+def from_centerline(centerline, start_point=None, spacing=None):
+    """LinearReference of a centreline starting at the end nearest start_point."""
+    vertices = line_vertices(centerline)
+    if start_point is not None:
+        import arcpy
+        with arcpy.da.SearchCursor(start_point, ["SHAPE@XY"]) as cursor:
+            start = np.array(next(iter(cursor))[0])
+        if np.hypot(*(vertices[-1] - start)) < np.hypot(*(vertices[0] - start)):
+            vertices = vertices[::-1]
+    return LinearReference(vertices, spacing)
+
+
+def add_chainage(feature_class, reference, chainage_field="Chainage", offset_field="Offset"):
+    """Add the chainage and offset of the features (centroids for polygons)."""
+    import arcpy
+    with arcpy.da.SearchCursor(feature_class, ["OID@", "SHAPE@XY"]) as cursor:
+        rows = [row for row in cursor if row[1] is not None and row[1][0] is not None]
+    if not rows:
+        return feature_class
+    chainage, offset = reference.locate(np.array([row[1] for row in rows]))
+    values = dict(zip([row[0] for row in rows], zip(chainage.tolist(), offset.tolist())))
+    for name in (chainage_field, offset_field):
+        arcpy.management.AddField(feature_class, name, "DOUBLE", 9, "", "", name, "NULLABLE")
+    with arcpy.da.UpdateCursor(feature_class, ["OID@", chainage_field, offset_field]) as cursor:
+        for row in cursor:
+            if row[0] in values:
+                cursor.updateRow((row[0],) + values[row[0]])
+    return feature_class
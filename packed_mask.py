@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Bit-packed binary masks and morphology on the packed words
+
+A mask is held as rows of 64-bit words, bit j of word w being the pixel of
+column 64 * w + j, so a plane takes one bit per pixel instead of the byte of
+a boolean array. Masks combine with AND/OR/NOT on the words.
+
+Dilation and erosion by a disk are done on the words: the disk is split in
+its rows, each a horizontal span, so the result is the OR (AND for the
+erosion) over the rows of the disk of the mask shifted by whole columns and
+rows. The column shifts carry the bits across the words. Pixels beyond the
+mask are background, as with the binary morphology of scipy.ndimage, and
+areas are counted with a popcount of the words.
+"""
+
+import math
+
+import numpy as np
+
+WORD = 64
+_ONES = np.uint64(0xFFFFFFFFFFFFFFFF)
+# Bits set in each byte, for NumPy without bitwise_count
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+
+
+def _tail(ncols):
+    """Mask of the valid bits of the last word of a row."""
+    valid = ncols - WORD * ((ncols - 1) // WORD) if ncols else 0
+    return _ONES if valid == WORD else np.uint64((1 << valid) - 1)
+
+
+def shift_columns(words, k, ncols):
+    """Words of a mask moved by k columns (to the right for k > 0)."""
+    out = np.zeros_like(words)
+    nwords = words.shape[1]
+    q, s = divmod(abs(k), WORD)
+    if q >= nwords:
+        return out
+    s = np.uint64(s)
+    if k > 0:
+        out[:, q:] = words[:, :nwords - q] << s
+        if s:
+            out[:, q + 1:] |= words[:, :nwords - q - 1] >> (np.uint64(WORD) - s)
+        out[:, -1] &= _tail(ncols)
+    elif k < 0:
+        out[:, :nwords - q] = words[:, q:] >> s
+        if s:
+            out[:, :nwords - q - 1] |= words[:, q + 1:] << (np.uint64(WORD) - s)
+    else:
+        out[...] = words
+    return out
+
+
+def shift_rows(words, k):
+    """Words of a mask moved by k rows (down for k > 0)."""
+    out = np.zeros_like(words)
+    if abs(k) >= len(words):
+        return out
+    if k > 0:
+        out[k:] = words[:-k]
+    elif k < 0:
+        out[:k] = words[-k:]
+    else:
+        out[...] = words
+    return out
+
+
+def popcount(words):
+    """Number of set bits of an array of words."""
+    if hasattr(np, "bitwise_count"):
+        return int(np.bitwise_count(words).sum(dtype=np.int64))
+    return int(_POPCOUNT[np.ascontiguousarray(words).view(np.uint8)].sum(dtype=np.int64))
+
+
+class PackedMask(object):
+    """Binary mask of shape (rows, ncols) packed in 64-bit words."""
+
+    def __init__(self, words, ncols):
+        self.words = words
+        self.ncols = int(ncols)
+
+    @classmethod
+    def pack(cls, mask):
+        mask = np.asarray(mask, bool)
+        rows, ncols = mask.shape
+        nwords = max((ncols + WORD - 1) // WORD, 1)
+        buf = np.zeros((rows, nwords * 8), np.uint8)
+        packed = np.packbits(mask, axis=1, bitorder="little")
+        buf[:, :packed.shape[1]] = packed
+        return cls(buf.view("<u8"), ncols)
+
+    @classmethod
+    def zeros(cls, shape):
+        return cls(np.zeros((shape[0], max((shape[1] + WORD - 1) // WORD, 1)), "<u8"), shape[1])
+
+    @property
+    def shape(self):
+        return (self.words.shape[0], self.ncols)
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def unpack(self):
+        return np.unpackbits(self.words.view(np.uint8), axis=1, count=self.ncols,
+                             bitorder="little").astype(bool)
+
+    def count(self):
+        return popcount(self.words)
+
+    def area(self, cell_size):
+        return self.count() * float(cell_size) ** 2
+
+    def any(self):
+        return bool(self.words.any())
+
+    def copy(self):
+        return PackedMask(self.words.copy(), self.ncols)
+
+    def __and__(self, other):
+        return PackedMask(self.words & other.words, self.ncols)
+
+    def __or__(self, other):
+        return PackedMask(self.words | other.words, self.ncols)
+
+    def __xor__(self, other):
+        return PackedMask(self.words ^ other.words, self.ncols)
+
+    def __invert__(self):
+        words = ~self.words
+        words[:, -1] &= _tail(self.ncols)
+        return PackedMask(words, self.ncols)
+
+    def andnot(self, other):
+        return PackedMask(self.words & ~other.words, self.ncols)
+
+    def __eq__(self, other):
+        return self.ncols == other.ncols and np.array_equal(self.words, other.words)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _morph(self, radius, dilate):
+        """Dilation (OR) or erosion (AND) by a disk of the given pixel radius."""
+        if radius <= 0:
+            return self.copy()
+        op = np.bitwise_or if dilate else np.bitwise_and
+        # Half width of the disk row at each row offset, as channel_raster.disk
+        spans = {}
+        for dr in range(-radius, radius + 1):
+            spans.setdefault(math.isqrt(radius * radius - dr * dr), []).append(dr)
+        out = None
+        span = self.words.copy()
+        for w in range(0, radius + 1):
+            if w:
+                op(span, shift_columns(self.words, w, self.ncols), out=span)
+                op(span, shift_columns(self.words, -w, self.ncols), out=span)
+            for dr in spans.get(w, ()):
+                moved = shift_rows(span, dr)
+                out = moved if out is None else op(out, moved, out=out)
+        return PackedMask(out, self.ncols)
+
+    def dilate(self, radius):
+        return self._morph(radius, True)
+
+    def erode(self, radius):
+        return self._morph(radius, False)
+
+    def close(self, radius):
+        """Closing by a disk, as scipy.ndimage.binary_closing without padding."""
+        return self.dilate(radius).erode(radius)
+
+    def open(self, radius):
+        return self.erode(radius).dilate(radius)
+
+
+def pack(mask):
+    return PackedMask.pack(mask)
+
@@ -11,11 +11,23 @@ import numpy as np
 import pandas as pd
 from rpy2.robjects.packages import importr
 
+import channel_network
+import reach_builder
+import scene_prefetch
+import transect_intersect
+from warm_worker import cached, file_stamp
+
 if __name__ == '__main__': 
     
     envelope = arcpy.GetParameterAsText(0)
     transects = arcpy.GetParameterAsText(1)
     input_space = arcpy.GetParameterAsText(2)
+    # Optional list of years separated by ";", e.g. from batch_runner.py
+    years_text = arcpy.GetParameterAsText(3)
+    # Optional incremental mode: with changedTiles_<year> from tile_pipeline.py
+    # only the transects crossing changed tiles are measured and the others
+    # keep the metrics of the previous year
+    incremental = arcpy.GetParameterAsText(4).lower() in ("true", "1", "yes")
     
     arcpy.env.workspace = input_space
     arcpy.env.overwriteOutput = True
@@ -23,55 +35,92 @@ if __name__ == '__main__':
     arcpy.env.outputCoordinateSystem = arcpy.Describe(envelope).spatialReference  
     arcpy.env.overwriteOutput = True
     
-    # Create empty list for interim datasets to be deleted at end of function
-    dsets = []
-    
     years = ['1987','1989','1992','1994','1996','1999','2002','2005','2009','2013','2014','2016','2018']
+    if years_text:
+        years = [y.strip() for y in years_text.split(";") if y.strip()]
+    
+    # R and its ecp package are loaded once, and kept by a warm worker
+    ecp = cached("ecp", lambda: importr('ecp'))
+    
+    # Transects are read once into the memory workspace; when they change
+    # the copy of the previous version is deleted
+    transects_key = ("transects", transects, file_stamp(transects))
+    transects_group = transects_key[:2]
+    transects = cached(transects_key, lambda: scene_prefetch.features_to_memory(
+        scene_prefetch.read_features(transects), "transects_%d" % (abs(hash(transects_key)) % 1000000)),
+        group = transects_group, release = arcpy.management.Delete)
     
-    for year in years:
+    # The channel layers of the next years are copied into scratch
+    # geodatabases by background processes while the current year is processed
+    prefetcher = scene_prefetch.Prefetcher(
+        years, scene_prefetch.channel_layers_loader(input_space, arcpy.env.scratchFolder),
+        depth = 2, pool = "process")
     
-        wetChannelBoundary = input_space + "/wetChannelBoundary_" + year
-        activeChannel = input_space + "/activeChannel_" + year
-        channelUnit = input_space + "/channelUnit_" + year
+    entries = []
+    for i, (year, layers) in enumerate(prefetcher):
+    
+        # Create empty list for interim datasets of the year to be deleted
+        dsets = []
+        
+        # Already copied to a scratch geodatabase by the prefetch process
+        wetChannelBoundary = layers["wetChannelBoundary"]
+        activeChannel = layers["activeChannel"]
+        channelUnit = layers["channelUnit"]
         
         planMetric = "planMetric" + "_" + year
         
         planMetric = arcpy.management.CopyFeatures(transects, planMetric)
         
-        wetChannelTransects =  "wetChannelTransect"
-        wetChannelTransects =  arcpy.analysis.PairwiseIntersect(
-            in_features=[planMetric, wetChannelBoundary], 
-            out_feature_class=wetChannelTransects)
-        fieldname = "Ww" 
-        arcpy.management.AddField(wetChannelTransects, fieldname,"DOUBLE", 9,"","",fieldname,"NULLABLE")
-        #arcpy.management.CalculateField(wetChannelTransects, field= fieldname, expression="!Shape_Length!")
-        arcpy.management.CalculateGeometryAttributes(wetChannelTransects, [[fieldname, "LENGTH"]], "METERS")
+        measured = planMetric
+        previousMetric = None
+        changedTiles = "changedTiles_" + year
+        if (incremental and i > 0 and arcpy.Exists(changedTiles) and 
+                arcpy.Exists("planMetric_" + years[i - 1])):
+            previousMetric = "planMetric_" + years[i - 1]
+            measured = arcpy.management.MakeFeatureLayer(planMetric, "measured_" + year)
+            arcpy.management.SelectLayerByLocation(measured, "INTERSECT", changedTiles)
+            with arcpy.da.SearchCursor(measured, ["Distance"]) as cursor:
+                measured_ids = set(row[0] for row in cursor)
         
-        planMetric= arcpy.management.JoinField(
-            in_data = planMetric, 
-            in_field= "Distance", 
-            join_table = wetChannelTransects, 
-            join_field="Distance", 
-            fields= [fieldname])
-        
-        activeChannelTransects = "activeChannelTransect"
-        arcpy.analysis.PairwiseIntersect(in_features=[planMetric, activeChannel], 
-                                         out_feature_class=activeChannelTransects)
-        fieldname = "Aw" 
-        arcpy.management.AddField(activeChannelTransects,fieldname,"DOUBLE", 9,"","",fieldname,"NULLABLE")
-        #arcpy.management.CalculateField(activeChannelTransects, field=fieldname, expression="!Shape_Length!")
-        arcpy.management.CalculateGeometryAttributes(activeChannelTransects, [[fieldname, "LENGTH"]], "METERS")
+        # Ww and Aw: lengths of the transects inside the wet and active
+        # channel polygons, intersected on arrays
+        transect_keys, transect_xy = cached(transects_key + ("xy",), 
+                                            lambda: transect_intersect.read_transects(transects),
+                                            group = transects_group + ("xy",))
+        reference = cached(transects_key + ("reference",), lambda: reach_builder.transect_reference(
+            transect_xy[np.argsort(transect_keys)]), group = transects_group + ("reference",))
+        # In incremental mode the others are carried forward below
+        keep = np.ones(len(transect_keys), bool)
+        if previousMetric is not None:
+            keep = np.isin(transect_keys, list(measured_ids))
+        for fieldname, channel in (("Ww", wetChannelBoundary), ("Aw", activeChannel)):
+            index = transect_intersect.EdgeIndex(transect_intersect.polygon_edges(channel))
+            lengths = dict(zip(transect_keys[keep].tolist(),
+                               index.intersect(transect_xy[keep]).length.tolist()))
+            arcpy.management.AddField(planMetric, fieldname,"DOUBLE", 9,"","",fieldname,"NULLABLE")
+            with arcpy.da.UpdateCursor(planMetric, ["Distance", fieldname]) as cursor:
+                for row in cursor:
+                    # Null where the transect misses the channel, as with the join
+                    length = lengths.get(row[0], 0)
+                    cursor.updateRow((row[0], length if length > 0 else None))
         
-        planMetric = arcpy.management.JoinField(
-            in_data = planMetric, 
-            in_field = "Distance", 
-            join_table = activeChannelTransects, 
-            join_field = "Distance", 
-            fields = [fieldname])
+        # Threads: wet channel links crossed by each transect, when the
+        # network of the year was built by tile_pipeline.py
+        channelNetwork = "channelNetwork_" + year
+        network = None
+        if arcpy.Exists(channelNetwork):
+            network = channel_network.read_network(channelNetwork)
+            segments, segment_link, link_ends = network
+            threads = dict(zip(transect_keys.tolist(), channel_network.thread_counts(
+                segments, segment_link, transect_xy).tolist()))
+            arcpy.management.AddField(planMetric, "Threads","LONG", 9,"","","Threads","NULLABLE")
+            with arcpy.da.UpdateCursor(planMetric, ["Distance", "Threads"]) as cursor:
+                for row in cursor:
+                    cursor.updateRow((row[0], threads.get(row[0], 0)))
         
         channelUnitTransect = "channelUnitTransect"
         channelUnitTransect = arcpy.analysis.SpatialJoin(
-            target_features = planMetric, 
+            target_features = measured, 
             join_features = channelUnit, 
             out_feature_class = channelUnitTransect, 
             join_operation ="JOIN_ONE_TO_MANY", 
@@ -123,7 +172,19 @@ if __name__ == '__main__':
                                         expression="!COUNT_Unit_Type!+1 if !COUNT_Unit_Type! is not None else 1")
         arcpy.management.DeleteField(planMetric, ["COUNT_Unit_Type"])
         
-        dsets.extend((wetChannelTransects, activeChannelTransects,channelUnitTransect, 
+        if previousMetric is not None:
+            # Carry forward the metrics of the transects outside the changed tiles
+            fields = ["Distance", "Ww", "Aw", "Bi", "Ai"]
+            with arcpy.da.SearchCursor(previousMetric, fields) as cursor:
+                carried = dict((row[0], row) for row in cursor)
+            with arcpy.da.UpdateCursor(planMetric, fields) as cursor:
+                for row in cursor:
+                    if row[0] not in measured_ids and row[0] in carried:
+                        cursor.updateRow(carried[row[0]])
+            arcpy.AddMessage("Measured {0} of {1} transects".format(len(measured_ids), len(carried)))
+            dsets.append(measured)
+        
+        dsets.extend((channelUnitTransect, 
                       summTableUnit, summTable_BI_Active,summTable_AI))
         for dset in dsets:
             arcpy.management.Delete(dset)
@@ -140,10 +201,21 @@ if __name__ == '__main__':
         plan_arr = arcpy.da.TableToNumPyArray(planMetric, fields)
         plan_st_arr = np.sort(plan_arr, order = ['Distance'])
         plan_df = pd.DataFrame(plan_st_arr)
-        plan_df['AW'] = plan_df['Aw'].rolling(11, center = True).mean()
-        plan_df['WW'] = plan_df['Ww'].rolling(11, center = True).mean()
-        plan_df['BI'] = plan_df['Bi'].rolling(11, center = True).mean()
-        plan_df['AI'] = plan_df['Ai'].rolling(11, center = True).mean()
+        # Transects from adaptive_transects.py are weighted by the length of
+        # centreline they stand for and the rolling means span 11 coarse
+        # spacings of their Chainage, which keeps them unbiased where the
+        # transects are denser; fixed transects are 11 to a window
+        weight = pd.Series(1.0, index = plan_df.index)
+        position = np.arange(len(plan_df), dtype = np.float64)
+        spacing = 1.0
+        if "Weight" in [f.name for f in arcpy.ListFields(planMetric)]:
+            weight_arr = np.sort(arcpy.da.TableToNumPyArray(planMetric, ('Distance','Chainage','Weight')), order = ['Distance'])
+            weight = pd.Series(weight_arr['Weight'].astype(np.float64), index = plan_df.index)
+            position = weight_arr['Chainage'].astype(np.float64)
+            spacing = reach_builder.coarse_spacing(position, weight_arr['Weight'])
+        for column in ('Aw','Ww','Bi','Ai'):
+            plan_df[column.upper()] = reach_builder.rolling_mean(
+                position, plan_df[column].to_numpy(np.float64), weight.to_numpy(), spacing, 11)
         
         plan_seg = plan_df[['Ai','Bi','AW','WW']].dropna().astype(np.float64)
         
@@ -152,59 +224,63 @@ if __name__ == '__main__':
     
         plan_seg_m = np.asmatrix(plan_seg)
      
-        ecp = importr('ecp')
         seg = ecp.e_divisive(X=plan_seg_m, sig_lvl=0.01,R=599,min_size=11,alpha=1)
         
-        seg_id = (seg.rx('estimates')[0].astype(int)+4).tolist()[1:-1]
-        
-        label_id = (seg.rx('estimates')[0].astype(int)+6).tolist()[1:-1]
-        
-        for i in seg_id:
-           plan_st_arr[i][5] = 1
-        
-        plan_st_arr[2][7] = 1  
-        
-        for l in label_id:
-           plan_st_arr[l][7] = 1    
-           
-        reach_id = np.concatenate((np.repeat(np.array([1]), 5),seg.rx('cluster')[0].astype(int),np.repeat(seg.rx('k.hat')[0].astype(int),5)))
-        
-        j = 0
-        while j < len(reach_id):
-            plan_st_arr[j][6] = reach_id[j]
-            j = j+1
+        # Reaches start at the break transects and are looked up along the
+        # chainage of the transect midpoints, for the transects and the units
+        estimates = seg.rx('estimates')[0].astype(int)
+        order = np.argsort(transect_keys)
+        rows = order[np.searchsorted(transect_keys[order], plan_st_arr['Distance'])]
+        chainage = reference.locate(transect_xy[rows].mean(axis = 1))[0]
+        # The segmented series starts at the first full window
+        lag = int(plan_seg.index[0])
+        starts = reach_builder.break_rows(estimates, lag)
+        breaks = chainage[starts]
+        plan_st_arr['Break'][starts] = 1
+        labels = reach_builder.label_rows(estimates, lag)
+        plan_st_arr['Label'][labels] = 1
+        plan_st_arr['Reach'] = reach_builder.assign(chainage, breaks)
        
         arcpy.da.ExtendTable(planMetric, "Distance",plan_st_arr,"Distance", append_only = False)
     
-        planMetric_break = "planMetric_break"
-        planMetric_break = arcpy.analysis.Select(
-            in_features = planMetric, 
-            out_feature_class = planMetric_break, 
-            where_clause = "Break = 1")
-    
-        envelope_reach = "envelope_reach "
-        envelope_reach  = arcpy.management.FeatureToPolygon(
-            in_features = [planMetric_break, envelope], 
-            out_feature_class = envelope_reach)
-    
-        planMetric_label = "planMetric_label"
-        planMetric_label = arcpy.analysis.Select(
-            in_features = planMetric, 
-            out_feature_class = planMetric_label, 
-            where_clause = "Label = 1")
-        
-        envelope_reach_label = "envelope_reach_label" + "_" +year
-        envelope_reach_label = arcpy.analysis.SpatialJoin(
-            target_features = envelope_reach, 
-            join_features = planMetric_label, 
-            out_feature_class = envelope_reach_label, 
-            field_mapping="")
-    
+        unit_id, unit_xy, unit_type, unit_area = reach_builder.read_units(channelUnit)
+        unit_reach = reach_builder.assign(reference.locate(unit_xy)[0], breaks)
         channelUnitReach = "channelUnitReach" + "_" +year
-        channelUnitReach = arcpy.analysis.Intersect(
-            in_features =[[envelope_reach_label, ""], [channelUnit, ""]], 
-            out_feature_class = channelUnitReach)
+        arcpy.management.CopyFeatures(channelUnit, channelUnitReach)
+        unit_table = np.zeros(len(unit_id), dtype = [("Unit_Id", np.int32), ("Reach", np.int32)])
+        unit_table["Unit_Id"] = unit_id
+        unit_table["Reach"] = unit_reach
+        arcpy.da.ExtendTable(channelUnitReach, "Unit_Id", unit_table, "Unit_Id", append_only = False)
         
-        dsets.extend((planMetric_break, envelope_reach, planMetric_label))
-        for dset in dsets:
-            arcpy.management.Delete(dset)
\ No newline at end of file
+        pieces = reach_builder.slice_envelope(envelope, transect_xy[rows[starts]], reference, breaks,
+                                              transect_xy[rows[labels]].mean(axis = 1))
+        
+        # Thread length and link/node ratio of the network within each reach,
+        # by the chainage of the segment midpoints
+        thread_length = link_node_ratio = None
+        if network is not None:
+            def segment_reach(x, y):
+                return reach_builder.assign(reference.locate(np.column_stack((x, y)))[0], breaks)
+            thread_length = channel_network.length_by(segments, segment_reach)
+            link_node_ratio = channel_network.link_node_ratio_by(
+                segments, segment_link, link_ends, segment_reach)
+        entries.append(reach_builder.YearReaches(
+            year, plan_st_arr['Reach'], chainage, weight.to_numpy(), plan_st_arr,
+            unit_reach, unit_type, unit_area, pieces, thread_length, link_node_ratio))
+        
+        # Scratch geodatabase of the channel layers of the year
+        arcpy.management.Delete(layers["workspace"])
+    
+    arcpy.AddMessage("Waited {0:.1f} s for the prefetched layers".format(prefetcher.waited))
+    
+    # Aggregate metrics of the reaches of all years, then the reach polygons
+    # of each year with the aggregates of their reach
+    reachMetrics = reach_builder.reach_statistics(entries)
+    if arcpy.Exists("reachMetrics"):
+        arcpy.management.Delete("reachMetrics")
+    arcpy.da.NumPyArrayToTable(reachMetrics, "reachMetrics")
+    sr = arcpy.Describe(envelope).spatialReference
+    for entry in entries:
+        reach_builder.write_reaches(
+            entry.pieces, "envelope_reach_label" + "_" + entry.year, sr,
+            reachMetrics[reachMetrics["Year"] == int(entry.year)])
\ No newline at end of file
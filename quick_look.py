@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Progressive quick-look of the planform metrics
+
+Before the full channel_planform_from_satellite.py run, this tool gives the
+approximate wet width (Ww), active width (Aw) and braiding index (Bi) along
+the transects within seconds, to check the thresholds and the envelope:
+
+    1) The bands are block averaged by a coarse factor, classified and the
+       channels extracted with tile_pipeline.extract_channels on the
+       overview; the metrics are sampled along every stride-th transect
+    2) Each pass halves the factor and the stride, and its metrics are
+       compared with the previous pass on the transects both measured
+    3) It stops after the full resolution pass, or as soon as a pass changes
+       the metrics by less than the tolerance (mean absolute change over
+       mean value, for each metric)
+
+Ww and Aw are the lengths of the transect inside the wet and active
+channels, Bi one plus the number of mid-channel bars (MB units) crossed, as
+in planform_metric_extraction_V4.py, all sampled every half pixel along the
+transects. Threads, the runs of wet samples along a transect, is reported
+too. After each pass the metrics are written to the output table.
+"""
+
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import channel_raster
+import kernels
+import tile_pipeline
+from transect_intersect import sample_transects
+
+METRICS = ("Ww", "Aw", "Bi")
+# MB in the unit type codes of tile_pipeline.unit_class
+MID_CHANNEL_BAR = 2
+
+Pass = namedtuple("Pass", ["factor", "stride", "index", "metrics", "change", "seconds"])
+
+
+def sampled_metrics(products, xy, origin, cell):
+    """Ww, Aw, Bi and Threads of transects sampled on the extraction products."""
+    shape = products["wet"].shape
+    tr, row, col, count = sample_transects(xy, origin, cell, shape)
+    valid = row >= 0
+    tr, row, col = tr[valid], row[valid], col[valid]
+    length = np.hypot(*(xy[:, 1] - xy[:, 0]).T)
+    out = {}
+    for name, mask in (("Ww", products["wet"]), ("Aw", products["active"])):
+        inside = np.bincount(tr, weights=mask[row, col], minlength=len(xy))
+        out[name] = length * inside / count
+    out["Threads"] = kernels.get("run_count")(tr, products["wet"][row, col], len(xy))
+    units = products["units"][row, col].astype(np.int64)
+    bar = products["unitClass"][row, col] == MID_CHANNEL_BAR
+    pairs = np.unique(tr[bar] * (int(units.max(initial=0)) + 1) + units[bar])
+    out["Bi"] = 1.0 + np.bincount(pairs // (int(units.max(initial=0)) + 1), minlength=len(xy))
+    return out
+
+
+def overview(bands, inside, factor):
+    """Bands and envelope mask block averaged by factor."""
+    if factor <= 1:
+        return bands, inside
+    return ([channel_raster.decimate(b, factor) for b in bands],
+            channel_raster.decimate(inside, factor) >= 0.5)
+
+
+def change(previous, current):
+    """Largest relative change of the metrics between two passes."""
+    worst = 0.0
+    for name in METRICS:
+        a, b = previous[name], current[name]
+        scale = np.nanmean(np.abs(b))
+        if scale > 0:
+            worst = max(worst, float(np.nanmean(np.abs(b - a)) / scale))
+    return worst
+
+
+def progressive(bands, inside, grid, transects, ndvi_threshold, mndwi_threshold,
+                waterArea_threshold, barArea_threshold, factor=16, stride=None,
+                tolerance=0.02, workers=1):
+    """Passes of the quick-look from the coarsest to the full resolution.
+
+    grid is the raster_io.Grid of the band window and transects the
+    (N, 2, 2) transect end points. stride is the transect decimation of the
+    first pass, factor by default. Yields a Pass per refinement with the
+    transect indices measured and their metrics.
+    """
+    xy = np.asarray(transects, np.float64).reshape(-1, 2, 2)
+    factor = max(int(factor), 1)
+    stride = max(int(stride or factor), 1)
+    previous = None
+    while True:
+        start = time.perf_counter()
+        coarse_bands, coarse_inside = overview(bands, inside, factor)
+        cell = grid.cell * factor
+        products = tile_pipeline.extract_channels(
+            coarse_bands, coarse_inside, cell, ndvi_threshold, mndwi_threshold,
+            waterArea_threshold, barArea_threshold, workers=workers)
+        index = np.arange(0, len(xy), stride)
+        metrics = sampled_metrics(products, xy[index], (grid.x0, grid.y0), cell)
+        delta = None
+        if previous is not None:
+            # Transects of the previous pass are every other one of this pass
+            common = np.isin(index, previous.index)
+            delta = change(dict((k, v[np.isin(previous.index, index)]) for k, v in previous.metrics.items()),
+                           dict((k, v[common]) for k, v in metrics.items()))
+        current = Pass(factor, stride, index, metrics, delta, time.perf_counter() - start)
+        yield current
+        if factor == 1 and stride == 1:
+            return
+        if delta is not None and delta < tolerance:
+            return
+        previous = current
+        factor = max(factor // 2, 1)
+        stride = max(stride // 2, 1)
+
+
+def write_table(table, keys, result):
+    """Write the Distance and metrics of a pass to a table, replacing it."""
+    import arcpy
+    rows = np.zeros(len(result.index), dtype=[("Distance", np.float64), ("Ww", np.float64),
+                                              ("Aw", np.float64), ("Bi", np.float64),
+                                              ("Threads", np.int32), ("Factor", np.int32)])
+    rows["Distance"] = keys[result.index]
+    for name in METRICS + ("Threads",):
+        rows[name] = result.metrics[name]
+    rows["Factor"] = result.factor
+    if arcpy.Exists(table):
+        arcpy.management.Delete(table)
+    arcpy.da.NumPyArrayToTable(rows, table)
+
+
+if __name__ == '__main__':
+
+    import arcpy
+
+    import scene_prefetch
+    import transect_intersect
+
+    image = arcpy.GetParameterAsText(0)
+    envelope = arcpy.GetParameterAsText(1)
+    transects = arcpy.GetParameterAsText(2)
+    out_table = arcpy.GetParameterAsText(3)
+    green_band = arcpy.GetParameterAsText(4)
+    red_band = arcpy.GetParameterAsText(5)
+    nir_band = arcpy.GetParameterAsText(6)
+    swir_band = arcpy.GetParameterAsText(7)
+    ndvi_threshold = arcpy.GetParameterAsText(8)
+    mndwi_threshold = arcpy.GetParameterAsText(9)
+    waterArea_threshold = arcpy.GetParameterAsText(10)
+    barArea_threshold = arcpy.GetParameterAsText(11)
+    factor = int(arcpy.GetParameterAsText(12) or 16)
+    tolerance = float(arcpy.GetParameterAsText(13) or 0.02)
+
+    arcpy.env.overwriteOutput = True
+
+    arcpy.AddMessage("Reading the band window")
+    grid, bands, inside = scene_prefetch.band_window_loader(
+        envelope, (green_band, red_band, nir_band, swir_band))(image)
+    keys, xy = transect_intersect.read_transects(transects, "Distance")
+    order = np.argsort(keys)
+    keys, xy = keys[order], xy[order]
+
+    for result in progressive(bands, inside, grid, xy, ndvi_threshold, mndwi_threshold,
+                              waterArea_threshold, barArea_threshold, factor,
+                              tolerance=tolerance, workers=None):
+        write_table(out_table, keys, result)
+        arcpy.AddMessage("Pass at {0:.0f} m cells, every {1} transects ({2} measured) in {3:.1f} s: "
+                         "mean Ww {4:.0f} m, Aw {5:.0f} m, Bi {6:.2f}{7}".format(
+                             grid.cell * result.factor, result.stride, len(result.index),
+                             result.seconds, np.nanmean(result.metrics["Ww"]),
+                             np.nanmean(result.metrics["Aw"]), np.nanmean(result.metrics["Bi"]),
+                             "" if result.change is None else
+                             ", changed {0:.1%}".format(result.change)))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Reading and writing NumPy arrays for the raster tools
+
+The processing window is the envelope extent snapped to the image cells.
+Bands are read only for that window and the envelope polygon is burnt into a
+boolean mask with a scanline even-odd fill, so no intermediate rasters are
+written to the workspace.
+"""
+
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+
+# Upper left corner, cell size and shape of a processing window
+Grid = namedtuple("Grid", ["x0", "y0", "cell", "rows", "cols"])
+
+
+def snap_grid(extent, cell, x_origin, y_origin):
+    """Grid covering an (xmin, ymin, xmax, ymax) extent on a cell lattice."""
+    xmin, ymin, xmax, ymax = extent
+    x0 = x_origin + math.floor((xmin - x_origin) / cell) * cell
+    y0 = y_origin - math.floor((y_origin - ymax) / cell) * cell
+    cols = int(math.ceil((xmax - x0) / cell))
+    rows = int(math.ceil((y0 - ymin) / cell))
+    return Grid(x0, y0, cell, rows, cols)
+
+
+def subgrid(grid, row0, row1, col0, col1):
+    """Grid of a window of another grid."""
+    return Grid(grid.x0 + col0 * grid.cell, grid.y0 - row0 * grid.cell,
+                grid.cell, row1 - row0, col1 - col0)
+
+
+def rasterize_rings(rings, grid):
+    """Burn polygon rings into a boolean mask of pixel centres (even-odd rule)."""
+    toggles = np.zeros((grid.rows, grid.cols + 1), np.int32)
+    for ring in rings:
+        x1, y1 = ring[:, 0], ring[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        # Rows whose pixel centre lies in [min y, max y) of each edge
+        lo = np.ceil((grid.y0 - np.maximum(y1, y2)) / grid.cell - 0.5)
+        hi = np.ceil((grid.y0 - np.minimum(y1, y2)) / grid.cell - 0.5)
+        lo = np.clip(lo, 0, grid.rows).astype(np.int64)
+        hi = np.clip(hi, 0, grid.rows).astype(np.int64)
+        count = hi - lo
+        edge = np.repeat(np.arange(len(x1)), count)
+        row = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + lo[edge]
+        yc = grid.y0 - (row + 0.5) * grid.cell
+        x = x1[edge] + (yc - y1[edge]) * (x2[edge] - x1[edge]) / (y2[edge] - y1[edge])
+        col = np.clip(np.ceil((x - grid.x0) / grid.cell - 0.5), 0, grid.cols).astype(np.int64)
+        np.add.at(toggles, (row, col), 1)
+    return (np.cumsum(toggles, axis=1)[:, :-1] % 2).astype(bool)
+
+
+def feature_rings(features):
+    """All rings of a polygon feature class as (n, 2) arrays."""
+    import arcpy
+    from polygon_ring_fill import geometry_rings
+    rings = []
+    with arcpy.da.SearchCursor(features, ["SHAPE@"]) as cursor:
+        for row in cursor:
+            if row[0] is not None:
+                for part in geometry_rings(row[0]):
+                    rings.extend(part)
+    return rings
+
+
+def envelope_grid(envelope, image):
+    """Processing window of the envelope extent on the image cells."""
+    import arcpy
+    ext = arcpy.Describe(envelope).extent
+    ras = arcpy.Raster(image)
+    return snap_grid((ext.XMin, ext.YMin, ext.XMax, ext.YMax),
+                     ras.meanCellWidth, ras.extent.XMin, ras.extent.YMax)
+
+
+def read_band(image, band, grid, nodata=0):
+    """Read one band of an image for a window as float32, NoData as NaN."""
+    import arcpy
+    lower_left = arcpy.Point(grid.x0, grid.y0 - grid.rows * grid.cell)
+    arr = arcpy.RasterToNumPyArray(os.path.join(image, "Band_" + str(band)),
+                                   lower_left, grid.cols, grid.rows,
+                                   nodata_to_value=nodata).astype(np.float32)
+    arr[arr == nodata] = np.nan
+    return arr
+
+
+def write_raster(array, grid, out_raster, spatial_reference, nodata=None):
+    """Save an array as a raster of the given window."""
+    import arcpy
+    lower_left = arcpy.Point(grid.x0, grid.y0 - grid.rows * grid.cell)
+    ras = arcpy.NumPyArrayToRaster(array, lower_left, grid.cell, grid.cell, nodata)
+    arcpy.management.DefineProjection(ras, spatial_reference)
+    ras.save(out_raster)
+    return out_raster
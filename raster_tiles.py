@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Tiling helpers shared by the NumPy raster tools
+
+A raster window (rows x cols) is split into square tiles. Every tile has a
+core, which it owns, and a halo of extra pixels read around the core so that
+neighbourhood operations give the same answer as on the whole window. Halo
+pixels outside the window are padded with a fill value.
+"""
+
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+Tile = namedtuple("Tile", ["index", "row0", "row1", "col0", "col1", "halo"])
+
+
+def tile_windows(shape, tile_size=1024, halo=0):
+    """Split a (rows, cols) shape into tiles of tile_size with the given halo."""
+    rows, cols = shape
+    tiles = []
+    for row0 in range(0, rows, tile_size):
+        for col0 in range(0, cols, tile_size):
+            tiles.append(Tile(len(tiles), row0, min(row0 + tile_size, rows),
+                              col0, min(col0 + tile_size, cols), halo))
+    return tiles
+
+
+def read_tile(array, tile, fill=0):
+    """Return the tile core plus halo, padded with fill outside the array."""
+    h = tile.halo
+    rows, cols = array.shape[:2]
+    r0, r1 = tile.row0 - h, tile.row1 + h
+    c0, c1 = tile.col0 - h, tile.col1 + h
+    out = np.full((r1 - r0, c1 - c0) + array.shape[2:], fill, dtype=array.dtype)
+    sr0, sr1 = max(r0, 0), min(r1, rows)
+    sc0, sc1 = max(c0, 0), min(c1, cols)
+    out[sr0 - r0:sr1 - r0, sc0 - c0:sc1 - c0] = array[sr0:sr1, sc0:sc1]
+    return out
+
+
+def core(tile_array, tile):
+    """Strip the halo from an array read with read_tile."""
+    h = tile.halo
+    return tile_array[h:tile_array.shape[0] - h, h:tile_array.shape[1] - h]
+
+
+def process_pool(workers=None, initializer=None, initargs=()):
+    """Process pool that also works from inside an ArcGIS script tool.
+
+    Script tools run in ArcGISPro.exe, so child processes have to be started
+    with the python.exe of the same environment. initializer(*initargs) runs
+    once in every worker.
+    """
+    if os.name == "nt" and os.path.basename(sys.executable).lower() not in ("python.exe", "pythonw.exe"):
+        import multiprocessing
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "python.exe"))
+    return ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled raster-to-polygon vectorizer
+
+This tool replaces RasterToPolygon for the classified land cover and the
+final channel masks. The raster is split into tiles which are traced on a
+process pool:
+
+    1) Every tile emits the pixel edges between inside and outside pixels of
+       its core, oriented with the inside on the right so that exterior rings
+       are clockwise and interior rings anticlockwise (the ArcGIS convention)
+    2) Edges are chained into rings inside the tile; chains leaving the tile
+       are returned open and stitched across the tile seams afterwards
+    3) Collinear vertices are dropped, which keeps the traced polygons a
+       coverage with the exact pixel areas; optionally, for display, stair
+       steps are collapsed by tracing the edge midpoints instead of the
+       pixel corners
+    4) Rings are grouped into polygons with the 4-connected component label
+       of the pixel on their right, so no point-in-polygon test is needed
+
+Only the values or masks asked for are traced.
+"""
+
+import numpy as np
+from scipy import ndimage
+
+import kernels
+import raster_tiles
+import shared_arena
+
+# Edge directions in (row, col) steps, clockwise on the map: E, S, W, N
+STEPS = np.array([[0, 1], [1, 0], [0, -1], [-1, 0]])
+# Offset from the start vertex of an edge to the pixel on its right
+OWNER = np.array([[0, 0], [0, -1], [-1, -1], [-1, 0]])
+
+PRODUCTS = ("landClass", "wetChannelBoundary", "activeChannel", "channelUnit")
+
+
+def boundary_edges(raster, traced, row0, col0):
+    """Directed boundary edges of the traced pixels of a padded raster.
+
+    An edge is emitted wherever a traced pixel borders a pixel of another
+    value. raster carries one pixel of padding on every side; edges are
+    returned for the unpadded pixels as (start row, start col, direction) in
+    the global vertex grid, with row0 and col0 the global position of
+    raster[1, 1].
+    """
+    inside = traced[1:-1, 1:-1]
+    v = raster[1:-1, 1:-1]
+    sides = (inside & (raster[:-2, 1:-1] != v),
+             inside & (raster[1:-1, 2:] != v),
+             inside & (raster[2:, 1:-1] != v),
+             inside & (raster[1:-1, :-2] != v))
+    rows, cols, dirs = [], [], []
+    for d, side in enumerate(sides):
+        r, c = np.nonzero(side)
+        rows.append(r - OWNER[d, 0] + row0)
+        cols.append(c - OWNER[d, 1] + col0)
+        dirs.append(np.full(len(r), d))
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(dirs)
+
+
+def successors(keys, ends, dirs):
+    """Index of the edge following each edge, or -1 when it is not present.
+
+    keys are the (group, start vertex, direction) keys of the edges and ends
+    the (group, end vertex) keys, so that rings of different values never
+    link up. At a saddle vertex the right-hand turn is taken, which keeps
+    diagonal pixels apart (4-connectivity).
+    """
+    succ = np.full(len(keys), -1)
+    if len(keys) == 0:
+        return succ
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    # Left, straight then right: later turns overwrite earlier ones
+    for turn in (3, 0, 1):
+        want = ends * 4 + (dirs + turn) % 4
+        pos = np.minimum(np.searchsorted(sorted_keys, want), len(keys) - 1)
+        succ = np.where(sorted_keys[pos] == want, order[pos], succ)
+    return succ
+
+
+def follow(succ, heads, visited):
+    """Walk the successor links from each head until the chain ends or loops."""
+    return kernels.get("follow")(succ, heads, visited)
+
+
+def trace_tile(padded, values, row0, col0, ncols):
+    """Trace the boundaries of all the given values in one tile.
+
+    The tile is read with a halo of 2 pixels. Returns the closed rings as
+    (value, global vertex ids, owning pixel of the first edge) and the open
+    chains as (value, vertex ids, first direction, last direction, owning
+    pixel).
+    """
+    values = np.sort(np.asarray(values, dtype=padded.dtype))
+    traced = np.isin(padded, values)
+    # Edges of the first halo ring are traced too so that turns at the
+    # tile seams are decided with the full neighbourhood
+    r, c, d = boundary_edges(padded, traced, row0 - 1, col0 - 1)
+    owner_r = r + OWNER[d, 0]
+    owner_c = c + OWNER[d, 1]
+    value = padded[owner_r - row0 + 2, owner_c - col0 + 2]
+    group = np.searchsorted(values, value).astype(np.int64)
+    nvertex = (r.max() + 2) * (ncols + 1) if len(r) else 0
+    vertex = r * (ncols + 1) + c
+    end = vertex + STEPS[d, 0] * (ncols + 1) + STEPS[d, 1]
+    succ = successors((group * nvertex + vertex) * 4 + d, group * nvertex + end, d)
+    rows = padded.shape[0] - 4
+    cols = padded.shape[1] - 4
+    owned = ((owner_r >= row0) & (owner_r < row0 + rows) &
+             (owner_c >= col0) & (owner_c < col0 + cols))
+    succ[~owned] = -1
+    succ = np.where((succ >= 0) & owned[np.maximum(succ, 0)], succ, -1)
+    idx = np.flatnonzero(owned)
+    has_pred = np.zeros(len(vertex), bool)
+    has_pred[succ[succ >= 0]] = True
+    visited = ~owned
+    open_chains = follow(succ, idx[~has_pred[idx]], visited)
+    closed = follow(succ, idx, visited)
+    return ([(value[e[0]], vertex[e], (owner_r[e[0]], owner_c[e[0]]))
+             for e in closed],
+            [(value[e[0]], np.append(vertex[e], end[e[-1]]), d[e[0]], d[e[-1]],
+              (owner_r[e[0]], owner_c[e[0]])) for e in open_chains])
+
+
+def _trace_tile_job(args):
+    raster, tile, fill, values, ncols = args
+    if isinstance(raster, tuple):
+        # Shared block spec: the tile is read from the mapped raster
+        raster = shared_arena.attach(raster)
+    return trace_tile(raster_tiles.read_tile(raster, tile, fill), values, tile.row0, tile.col0, ncols)
+
+
+def stitch(chains, ncols):
+    """Join open chains from different tiles into closed rings."""
+    if not chains:
+        return []
+    values = np.unique([c[0] for c in chains])
+    group = np.searchsorted(values, [c[0] for c in chains]).astype(np.int64)
+    starts = np.array([c[1][0] for c in chains])
+    ends = np.array([c[1][-1] for c in chains])
+    first = np.array([c[2] for c in chains])
+    last = np.array([c[3] for c in chains])
+    nvertex = max(starts.max(), ends.max()) + 1
+    # Chains behave like single edges from start to end for the turn rule
+    succ = successors((group * nvertex + starts) * 4 + first,
+                      group * nvertex + ends, last)
+    rings = []
+    for ring in follow(succ, range(len(chains)), np.zeros(len(chains), bool)):
+        vertex = np.concatenate([chains[k][1][:-1] for k in ring])
+        rings.append((chains[ring[0]][0], vertex, chains[ring[0]][4]))
+    return rings
+
+
+def trace(raster, values, tile_size=1024, workers=None):
+    """Trace the boundaries of the given values of a raster on a process pool.
+
+    Returns a list of (value, vertex ids, owning pixel) rings.
+    """
+    ncols = raster.shape[1]
+    tiles = raster_tiles.tile_windows(raster.shape, tile_size, halo=2)
+    fill = np.array(-1).astype(raster.dtype) if raster.dtype != bool else False
+    if workers == 1 or len(tiles) == 1:
+        results = map(_trace_tile_job, [(raster, t, fill, values, ncols) for t in tiles])
+    else:
+        # The workers read their tiles from shared memory, without a copy
+        # when the raster is already in a shared_arena.Arena
+        spec = shared_arena.find(raster)
+        arena = shared_arena.Arena()
+        if spec is None:
+            spec = arena.publish("raster", raster)
+        try:
+            with raster_tiles.process_pool(workers) as pool:
+                results = list(pool.map(_trace_tile_job, [(spec, t, fill, values, ncols)
+                                                          for t in tiles]))
+        finally:
+            arena.close()
+    rings = []
+    chains = []
+    for closed, open_chains in results:
+        rings.extend(closed)
+        chains.extend(open_chains)
+    rings.extend(stitch(chains, ncols))
+    return rings
+
+
+def ring_coordinates(vertex, ncols, simplify=False):
+    """Convert vertex ids to (col, row) corner coordinates without redundancy.
+
+    With simplify the ring runs through the edge midpoints, so one-pixel
+    stair steps become straight diagonal lines. Each ring is simplified on
+    its own, so neighbouring polygons no longer share their boundaries and
+    corners are cut off their areas: for display only, not for layers whose
+    areas or overlays feed the metrics.
+    """
+    xy = np.column_stack((vertex % (ncols + 1), vertex // (ncols + 1))).astype(np.float64)
+    if simplify:
+        xy = 0.5 * (xy + np.roll(xy, -1, axis=0))
+    prev = xy - np.roll(xy, 1, axis=0)
+    nxt = np.roll(xy, -1, axis=0) - xy
+    turn = prev[:, 0] * nxt[:, 1] - prev[:, 1] * nxt[:, 0]
+    return xy[turn != 0]
+
+
+def polygons(raster, values, origin, cell_size, tile_size=1024, workers=None,
+             simplify=False, components=None):
+    """Vectorize the given values of a raster.
+
+    origin is the map (x, y) of the upper left corner. components is a
+    raster of 4-connected component ids; it is derived from the values when
+    not given, and a label raster can be passed as its own components.
+    Returns a list of (value, rings) with rings[0] the exterior ring and the
+    rest its interior rings, all as (n, 2) map coordinate arrays.
+    """
+    ncols = raster.shape[1]
+    x0, y0 = origin
+    if components is None:
+        components = np.zeros(raster.shape, np.int64)
+        offset = 0
+        for value in values:
+            labels, n = ndimage.label(raster == value)
+            components[labels > 0] = labels[labels > 0] + offset
+            offset += n
+    parts = {}
+    for value, vertex, (r, c) in trace(raster, values, tile_size, workers):
+        xy = ring_coordinates(vertex, ncols, simplify)
+        xy[:, 0] = x0 + xy[:, 0] * cell_size
+        xy[:, 1] = y0 - xy[:, 1] * cell_size
+        parts.setdefault(components[r, c], (value, []))[1].append(xy)
+    out = []
+    for label in sorted(parts):
+        value, rings = parts[label]
+        # Exterior rings are clockwise, which is a negative shoelace area
+        out.append((value, sorted(rings, key=_signed_area)))
+    return out
+
+
+def _signed_area(xy):
+    x = xy[:, 0]
+    y = xy[:, 1]
+    return 0.5 * (np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def vectorize_masks(masks, products, origin, cell_size, tile_size=1024,
+                    workers=None, simplify=False):
+    """Vectorize only the requested products.
+
+    masks maps a product name to a boolean mask, or to a class raster for
+    landClass. Returns product name -> list of (value, rings).
+    """
+    out = {}
+    for name in products:
+        raster = masks[name]
+        if raster.dtype == bool:
+            values = [True]
+        else:
+            values = [v for v in np.unique(raster) if v >= 0 and v != 255]
+        out[name] = polygons(raster, values, origin, cell_size, tile_size,
+                             workers, simplify)
+    return out
+
+
+def write_feature_class(polys, out_feature_class, spatial_reference, field="Class",
+                        attributes=None):
+    """Write (value, rings) polygons to a new feature class with a value field.
+
+    attributes optionally maps a value to a dict of extra field values; the
+    field types are taken from the first entry.
+    """
+    import arcpy
+    from polygon_ring_fill import rings_geometry
+    out = arcpy.management.CreateFeatureclass(
+        arcpy.env.workspace, out_feature_class, "POLYGON",
+        spatial_reference=spatial_reference)[0]
+    arcpy.management.AddField(out, field, "LONG", 9, "", "", field, "NULLABLE")
+    extra = []
+    if attributes:
+        for name, v in next(iter(attributes.values())).items():
+            ftype = "TEXT" if isinstance(v, str) else "DOUBLE"
+            arcpy.management.AddField(out, name, ftype, 9, "", "", name, "NULLABLE")
+            extra.append(name)
+    with arcpy.da.InsertCursor(out, ["SHAPE@", field] + extra) as cursor:
+        for value, rings in polys:
+            row = [rings_geometry(rings, spatial_reference), int(value)]
+            if extra:
+                row.extend(attributes[value][name] for name in extra)
+            cursor.insertRow(row)
+    return out
+
+
+def raster_to_polygon(in_raster, out_feature_class, field="Class", nodata=255,
+                      tile_size=1024, workers=None, simplify=False):
+    """Drop-in for RasterToPolygon with SINGLE_OUTER_PART on an integer raster."""
+    import arcpy
+    ras = arcpy.Raster(in_raster) if isinstance(in_raster, str) else in_raster
+    arr = arcpy.RasterToNumPyArray(ras, nodata_to_value=nodata)
+    values = [v for v in np.unique(arr) if v != nodata]
+    polys = polygons(arr, values, (ras.extent.XMin, ras.extent.YMax),
+                     ras.meanCellWidth, tile_size, workers, simplify)
+    return write_feature_class(polys, out_feature_class,
+                               ras.spatialReference, field)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Reaches from the segmentation breaks along the transect chainage
+
+The change points of the segmentation are transects where a new reach
+starts. Reaches are built without overlaying polygons:
+
+    1) The midpoints of the transects in Distance order make a line, and
+       the chainage along it (linear_reference) orders the transects, the
+       breaks, the channel units and any part of the envelope
+    2) Reach ids are interval lookups of those chainages between the break
+       chainages (searchsorted), so every transect and unit gets the reach
+       it lies in at once
+    3) The envelope is cut at the break transects in chainage order and
+       every single part goes to the reach of the label transect whose
+       midpoint it contains, or else to the reach of its own label point,
+       the parts of a reach being merged into one polygon
+
+The metrics are smoothed before the segmentation by rolling_mean, weighted
+means over a window of chainage, so that adaptive transects crowded in a
+stretch do not shorten the window there.
+
+reach_statistics gathers the transects and units of all years and sums
+them per (year, reach) with bincount in one pass, giving the weighted mean
+metrics of every reach together with the number and area of its units and
+the length and link/node ratio of the channel threads in it.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from linear_reference import LinearReference
+
+UNIT_TYPES = ("MB", "IS", "SB")
+
+# Transects and units of one year with their reaches; unit_type holds the
+# Unit_Type text of each unit, thread_length and link_node_ratio map each
+# reach to the measures of the channel network, None without a network
+YearReaches = namedtuple("YearReaches", ["year", "reach", "chainage", "weight", "metrics",
+                                         "unit_reach", "unit_type", "unit_area", "pieces",
+                                         "thread_length", "link_node_ratio"])
+
+
+def transect_reference(xy):
+    """LinearReference through the midpoints of (N, 2, 2) transects in order."""
+    return LinearReference(np.asarray(xy, np.float64).reshape(-1, 2, 2).mean(axis=1))
+
+
+def coarse_spacing(chainage, weight):
+    """Coarse spacing of adaptive transects from their Chainage and Weight.
+
+    Each transect stands for half the gaps to its neighbours, which over
+    its weight is the coarse spacing.
+    """
+    chainage = np.asarray(chainage, np.float64)
+    weight = np.asarray(weight, np.float64)
+    if len(chainage) < 3:
+        return float(np.ptp(chainage)) or 1.0
+    return float(np.median((chainage[2:] - chainage[:-2]) / 2 / weight[1:-1]))
+
+
+def rolling_mean(chainage, values, weight, spacing=1.0, window=11):
+    """Weighted mean of values over window coarse spacings of chainage.
+
+    The window is centred on each transect and holds window transects at
+    the coarse spacing, more where the transects are denser. NaN where the
+    window runs past either end of the transects or holds a NaN value.
+    """
+    chainage = np.asarray(chainage, np.float64)
+    values = np.asarray(values, np.float64)
+    weight = np.asarray(weight, np.float64)
+    half = window * spacing / 2.0
+    tol = 1e-9 * max(half, 1.0)
+    lo = np.searchsorted(chainage, chainage - half - tol, side="left")
+    hi = np.searchsorted(chainage, chainage + half + tol, side="right")
+    valid = np.isfinite(values)
+    total = np.r_[0.0, np.cumsum(np.where(valid, values * weight, 0.0))]
+    norm = np.r_[0.0, np.cumsum(weight)]
+    missing = np.r_[0, np.cumsum(~valid)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = (total[hi] - total[lo]) / (norm[hi] - norm[lo])
+    if len(chainage):
+        # Transects at the ends stand for half a spacing beyond them
+        complete = ((chainage - half >= chainage[0] - spacing / 2.0 - tol) &
+                    (chainage + half <= chainage[-1] + spacing / 2.0 + tol))
+        out[~complete | (missing[hi] > missing[lo])] = np.nan
+    return out
+
+
+def break_rows(estimates, lag=5):
+    """Rows of the transects starting a reach, from e.divisive estimates.
+
+    The estimates are 1-based rows of the segmented series, which starts
+    lag rows into the transects because of the centred rolling means.
+    """
+    estimates = np.asarray(estimates, np.int64)
+    return estimates[1:-1] + lag - 1
+
+
+def label_rows(estimates, lag=5):
+    """Rows of one transect inside each reach, two after its start."""
+    return np.r_[2, break_rows(estimates, lag) + 2]
+
+
+def assign(chainage, breaks):
+    """Reach of each chainage, 1 before the first break."""
+    return np.searchsorted(np.sort(np.asarray(breaks, np.float64)),
+                           np.asarray(chainage, np.float64), side="right") + 1
+
+
+def slice_envelope(envelope, cutters, reference, breaks, labels=()):
+    """Envelope cut at the break transects; returns (reach, polygon) pairs.
+
+    cutters are the (K, 2, 2) end points of the break transects in chainage
+    order. Transects not crossing the envelope leave it whole, joining the
+    reaches on both sides. labels are the (M, 2) midpoints of transects
+    inside the reaches: a part containing one takes its reach. Parts without
+    any, such as slivers, take the reach of their label point projected on
+    the reference, which can be off in tight bends where the projection
+    jumps to the other limb.
+    """
+    import arcpy
+    sr = arcpy.Describe(envelope).spatialReference
+    with arcpy.da.SearchCursor(envelope, ["SHAPE@"]) as cursor:
+        pieces = [row[0] for row in cursor if row[0] is not None]
+    for a, b in np.asarray(cutters, np.float64).reshape(-1, 2, 2):
+        line = arcpy.Polyline(arcpy.Array([arcpy.Point(*a), arcpy.Point(*b)]), sr)
+        cut = []
+        for piece in pieces:
+            parts = []
+            if not piece.disjoint(line):
+                try:
+                    parts = [p for p in piece.cut(line) if p is not None and p.area > 0]
+                except RuntimeError:
+                    parts = []
+            cut.extend(parts if len(parts) > 1 else [piece])
+        pieces = cut
+    parts = [arcpy.Polygon(piece.getPart(k), sr) for piece in pieces
+             for k in range(piece.partCount)]
+    if not parts:
+        return []
+    label = np.array([(p.labelPoint.X, p.labelPoint.Y) for p in parts])
+    reach = assign(reference.locate(label)[0], breaks)
+    labels = np.asarray(labels, np.float64).reshape(-1, 2)
+    if len(labels):
+        label_reach = assign(reference.locate(labels)[0], breaks)
+        points = [arcpy.PointGeometry(arcpy.Point(*xy), sr) for xy in labels]
+        for k, part in enumerate(parts):
+            inside = [r for r, point in zip(label_reach.tolist(), points) if part.contains(point)]
+            if inside:
+                reach[k] = inside[0]
+    merged = {}
+    for r, part in zip(reach.tolist(), parts):
+        merged[r] = merged[r].union(part) if r in merged else part
+    return sorted(merged.items())
+
+
+def read_units(channel_unit):
+    """Unit_Id, label points, Unit_Type and area of the channel units."""
+    import arcpy
+    rows = []
+    with arcpy.da.SearchCursor(channel_unit, ["Unit_Id", "SHAPE@", "Unit_Type"]) as cursor:
+        for unit_id, shape, unit_type in cursor:
+            if shape is None:
+                continue
+            rows.append((unit_id, shape.labelPoint.X, shape.labelPoint.Y, unit_type, shape.area))
+    if not rows:
+        return np.zeros(0, np.int64), np.zeros((0, 2)), np.zeros(0, "U2"), np.zeros(0)
+    unit_id, x, y, unit_type, area = zip(*rows)
+    return (np.array(unit_id, np.int64), np.column_stack((x, y)),
+            np.array(unit_type, "U2"), np.array(area, np.float64))
+
+
+def reach_statistics(entries, fields=("Ww", "Aw", "Bi", "Ai")):
+    """Per-reach aggregates of every year as a record array.
+
+    entries is a list of YearReaches. Fields: Year, Reach, Start and End
+    (chainage of the first and last transects), Transects, the weighted mean
+    of each metric field over its transects with a value, the number of units
+    of each type, UnitArea, their total area, and ChannelLength and
+    LinkNodeRatio of the channel network, NaN for years without a network.
+    """
+    nreach = max([int(e.reach.max(initial=0)) for e in entries] + [1])
+    groups = len(entries) * nreach
+    group = np.concatenate([k * nreach + e.reach - 1 for k, e in enumerate(entries)] or [[]]).astype(np.int64)
+    chainage = np.concatenate([e.chainage for e in entries] or [[]])
+    weight = np.concatenate([e.weight for e in entries] or [[]])
+    unit_group = np.concatenate([k * nreach + e.unit_reach - 1 for k, e in enumerate(entries)]
+                                or [[]]).astype(np.int64)
+    unit_type = np.concatenate([e.unit_type for e in entries] or [[]])
+    unit_area = np.concatenate([e.unit_area for e in entries] or [[]])
+
+    dtype = ([("Year", np.int32), ("Reach", np.int32), ("Start", np.float64), ("End", np.float64),
+              ("Transects", np.int32)] + [(f, np.float64) for f in fields]
+             + [(t, np.int32) for t in UNIT_TYPES] + [("UnitArea", np.float64),
+                                                      ("ChannelLength", np.float64),
+                                                      ("LinkNodeRatio", np.float64)])
+    out = np.zeros(groups, dtype=dtype)
+    out["Year"] = np.repeat([int(e.year) for e in entries], nreach)
+    out["Reach"] = np.tile(np.arange(1, nreach + 1), len(entries))
+    start = np.full(groups, np.inf)
+    end = np.full(groups, -np.inf)
+    np.minimum.at(start, group, chainage)
+    np.maximum.at(end, group, chainage)
+    out["Start"] = start
+    out["End"] = end
+    out["Transects"] = np.bincount(group, minlength=groups)
+    for f in fields:
+        values = np.concatenate([np.asarray(e.metrics[f], np.float64) for e in entries] or [[]])
+        valid = np.isfinite(values)
+        w = np.where(valid, weight, 0.0)
+        total = np.bincount(group, weights=w, minlength=groups)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[f] = np.bincount(group, weights=w * np.where(valid, values, 0.0),
+                                 minlength=groups) / total
+    for t in UNIT_TYPES:
+        out[t] = np.bincount(unit_group, weights=unit_type == t, minlength=groups)
+    out["UnitArea"] = np.bincount(unit_group, weights=unit_area, minlength=groups)
+    out["ChannelLength"] = np.nan
+    out["LinkNodeRatio"] = np.nan
+    for k, e in enumerate(entries):
+        for name, by_reach in (("ChannelLength", e.thread_length), ("LinkNodeRatio", e.link_node_ratio)):
+            if by_reach is None:
+                continue
+            # Reaches without a segment of the network have no threads
+            out[name][k * nreach:(k + 1) * nreach] = 0.0
+            for reach, value in by_reach.items():
+                if 1 <= reach <= nreach:
+                    out[name][k * nreach + reach - 1] = value
+    return out[out["Transects"] > 0]
+
+
+def write_reaches(pieces, out_feature_class, spatial_reference, statistics):
+    """Reach polygons with the aggregates of their reach for one year."""
+    import arcpy
+    out = arcpy.management.CreateFeatureclass(
+        arcpy.env.workspace, out_feature_class, "POLYGON",
+        spatial_reference=spatial_reference)[0]
+    names = [n for n in statistics.dtype.names if n != "Year"]
+    for name in names:
+        kind = "LONG" if statistics.dtype[name].kind == "i" else "DOUBLE"
+        arcpy.management.AddField(out, name, kind, 9, "", "", name, "NULLABLE")
+    by_reach = dict((int(r["Reach"]), r) for r in statistics)
+    with arcpy.da.InsertCursor(out, ["SHAPE@"] + names) as cursor:
+        for reach, polygon in pieces:
+            if reach not in by_reach:
+                continue
+            values = [by_reach[reach][n].item() for n in names]
+            # A NaN mean has no value and is written as Null
+            cursor.insertRow([polygon] + [None if v != v else v for v in values])
+    return out
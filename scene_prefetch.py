@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Prefetching loader for multi-year runs
+
+While one year is processed, the inputs of the next years are read and
+decoded on background threads into a bounded buffer:
+
+    Prefetcher(keys, loader, depth, max_bytes) yields (key, data) in order.
+    At most depth loads are in flight or waiting, and no new load starts
+    while the loaded but unconsumed data is above max_bytes, so memory stays
+    bounded when processing is slower than reading. max_bytes counts the
+    arrays and FeatureData of the loads; loads returning dataset paths take
+    no memory and are bounded by depth alone.
+
+Loaders are provided for the channel layers read by
+planform_metric_extraction_V4.py, copied by background processes into a
+scratch geodatabase per year, as arcpy geoprocessing is not thread safe and
+the main process keeps running its own tools, and for the band windows of
+the time-series mode of tile_pipeline.py. waited holds the time the consumer
+spent waiting for loads, the part of the I/O that did not overlap with the
+processing.
+"""
+
+import functools
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import raster_tiles
+
+# Rows of a feature class read into memory
+FeatureData = namedtuple("FeatureData", ["shape_type", "spatial_reference",
+                                         "fields", "rows", "nbytes"])
+
+
+def nbytes(data):
+    """Approximate size of loaded data: arrays, FeatureData or containers of them."""
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, FeatureData):
+        return data.nbytes
+    if isinstance(data, dict):
+        return sum(nbytes(v) for v in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(nbytes(v) for v in data)
+    return 0
+
+
+class Prefetcher(object):
+    """Iterate over keys with loader(key) running ahead in the background.
+
+    pool is "thread" or "process"; with processes the loader and its
+    results must pickle.
+    """
+
+    def __init__(self, keys, loader, depth=2, max_bytes=None, workers=None, size=nbytes,
+                 pool="thread"):
+        self.keys = list(keys)
+        self.loader = loader
+        self.depth = max(1, int(depth))
+        self.max_bytes = max_bytes
+        self.size = size
+        if pool == "process":
+            self.pool = raster_tiles.process_pool(workers or self.depth)
+        elif pool == "thread":
+            self.pool = ThreadPoolExecutor(max_workers=workers or self.depth)
+        else:
+            raise ValueError("unknown pool %r, expected thread or process" % pool)
+        self.futures = []
+        self.next_key = 0
+        self.waited = 0.0
+
+    def buffered_bytes(self):
+        return sum(self.size(f.result()) for f in self.futures
+                   if f.done() and f.exception() is None)
+
+    def _fill(self):
+        while (self.next_key < len(self.keys) and len(self.futures) < self.depth and
+               (not self.futures or self.max_bytes is None or
+                self.buffered_bytes() < self.max_bytes)):
+            key = self.keys[self.next_key]
+            self.futures.append(self.pool.submit(self.loader, key))
+            self.next_key += 1
+
+    def __iter__(self):
+        try:
+            for key in self.keys:
+                self._fill()
+                future = self.futures.pop(0)
+                start = time.perf_counter()
+                data = future.result()
+                self.waited += time.perf_counter() - start
+                # Start the next loads before handing this one over
+                self._fill()
+                yield key, data
+        finally:
+            self.close()
+
+    def close(self):
+        for f in self.futures:
+            f.cancel()
+        self.futures = []
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_features(feature_class, fields=None):
+    """Read the geometry and attributes of a feature class into memory."""
+    import arcpy
+    desc = arcpy.Describe(feature_class)
+    if fields is None:
+        fields = [f for f in arcpy.ListFields(feature_class)
+                  if not f.required and f.type not in ("Geometry", "OID")]
+    else:
+        fields = [f for f in arcpy.ListFields(feature_class) if f.name in fields]
+    rows = []
+    size = 0
+    with arcpy.da.SearchCursor(feature_class, ["SHAPE@"] + [f.name for f in fields]) as cursor:
+        for row in cursor:
+            rows.append(row)
+            if row[0] is not None:
+                size += 16 * row[0].pointCount
+    specs = [(f.name, f.type, f.length) for f in fields]
+    return FeatureData(desc.shapeType, desc.spatialReference, specs, rows, size)
+
+
+def features_to_memory(data, name):
+    """Write FeatureData to the memory workspace and return its path."""
+    import arcpy
+    field_types = {"String": "TEXT", "Integer": "LONG", "SmallInteger": "SHORT",
+                   "Double": "DOUBLE", "Single": "FLOAT", "Date": "DATE"}
+    out = arcpy.management.CreateFeatureclass(
+        "memory", name, data.shape_type.upper(),
+        spatial_reference=data.spatial_reference)[0]
+    for field, ftype, length in data.fields:
+        arcpy.management.AddField(out, field, field_types.get(ftype, "TEXT"),
+                                  field_length=length)
+    with arcpy.da.InsertCursor(out, ["SHAPE@"] + [f[0] for f in data.fields]) as cursor:
+        for row in data.rows:
+            cursor.insertRow(row)
+    return out
+
+
+def copy_channel_layers(input_space, scratch_folder, names, year):
+    """Copy the <name>_<year> channel layers into scratch_folder/prefetch_<year>.gdb.
+
+    Returns name -> path of each copy, and "workspace" -> the geodatabase,
+    which the caller deletes once done with the layers.
+    """
+    import arcpy
+    arcpy.env.overwriteOutput = True
+    workspace = arcpy.management.CreateFileGDB(scratch_folder, "prefetch_" + year + ".gdb")[0]
+    layers = dict((name, arcpy.management.CopyFeatures(
+                       input_space + "/" + name + "_" + year, workspace + "/" + name + "_" + year)[0])
+                  for name in names)
+    layers["workspace"] = workspace
+    return layers
+
+
+def channel_layers_loader(input_space, scratch_folder,
+                          names=("wetChannelBoundary", "activeChannel", "channelUnit")):
+    """Loader of copy_channel_layers, for a Prefetcher with a process pool."""
+    return functools.partial(copy_channel_layers, input_space, scratch_folder, tuple(names))
+
+
+def band_window_loader(envelope, bands, tile_size=2048):
+    """Loader reading the band window and envelope mask of an image.
+
+    An image given as "mosaic:" and scene paths separated by "|" is read as
+    a virtual_mosaic, window by window; the bands are expected in the order
+    green, red, nir, swir.
+    """
+    import raster_io
+    import virtual_mosaic
+
+    def load(image):
+        if virtual_mosaic.is_mosaic(image):
+            mosaic = virtual_mosaic.open_image(image)
+            grid = virtual_mosaic.mosaic_grid(envelope, mosaic)
+            out = [np.empty((grid.rows, grid.cols), np.float32) for _ in bands]
+            for tile, parts in mosaic.windows([int(b) for b in bands], grid, tile_size):
+                for band, part in zip(out, parts):
+                    band[tile.row0:tile.row1, tile.col0:tile.col1] = part
+        else:
+            grid = raster_io.envelope_grid(envelope, image)
+            out = [raster_io.read_band(image, int(b), grid) for b in bands]
+        inside = raster_io.rasterize_rings(raster_io.feature_rings(envelope), grid)
+        return grid, out, inside
+    return load
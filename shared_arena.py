@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory arena of the arrays of a run
+
+The arrays that several worker processes read, such as the land cover of a
+year or a stack of years, the unit label rasters and the band windows, are
+published once in named shared memory blocks:
+
+    arena = Arena()
+    spec = arena.publish("landClass", land_class)
+    ... pool.map(partial(job, spec), tiles)      # workers: attach(spec)
+    arena.release("landClass")
+
+A block starts with a small header holding the shape, dtype and fill value
+of its array, so a process can attach it zero-copy from its name alone; the
+spec (name, shape, dtype, fill) is the picklable handle passed to the jobs.
+A process attaches a block once and keeps it mapped until detach.
+
+Blocks are reference counted in the arena: publish and create take one
+reference, retain another, and a block is unlinked when its last reference
+is released or when the arena is closed, so consumers added to a run share
+the same memory and the last one to finish frees it.
+"""
+
+import json
+import os
+import uuid
+from multiprocessing import shared_memory
+
+import numpy as np
+
+HEADER = 256
+MAGIC = b"CPSA"
+
+# Blocks attached by this process, by name: [block, array, count]
+_attached = {}
+
+
+def _open(name):
+    try:
+        # Attached blocks are owned by the arena that created them
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def _write_header(buf, shape, dtype, fill):
+    text = json.dumps({"shape": list(shape), "dtype": dtype.str,
+                       "fill": fill.item() if hasattr(fill, "item") else fill}).encode()
+    if len(text) > HEADER - 8:
+        raise ValueError("shared array header too long")
+    buf[:4] = MAGIC
+    buf[4:8] = np.uint32(len(text)).tobytes()
+    buf[8:8 + len(text)] = text
+
+
+def _read_header(buf):
+    if bytes(buf[:4]) != MAGIC:
+        raise ValueError("not a shared arena block")
+    size = int(np.frombuffer(bytes(buf[4:8]), np.uint32)[0])
+    header = json.loads(bytes(buf[8:8 + size]).decode())
+    return tuple(header["shape"]), np.dtype(header["dtype"]), header["fill"]
+
+
+def _array(shm, shape, dtype):
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=HEADER)
+
+
+def attach(spec):
+    """Array of a shared block from its spec or its name, mapped once per process."""
+    name = spec if isinstance(spec, str) else spec[0]
+    if name not in _attached:
+        shm = _open(name)
+        shape, dtype, _ = _read_header(shm.buf)
+        _attached[name] = [shm, _array(shm, shape, dtype), 0]
+    entry = _attached[name]
+    entry[2] += 1
+    return entry[1]
+
+
+def spec_of(name):
+    """(name, shape, dtype, fill) of a shared block."""
+    if name in _attached:
+        shm = _attached[name][0]
+        shape, dtype, fill = _read_header(shm.buf)
+    else:
+        shm = _open(name)
+        shape, dtype, fill = _read_header(shm.buf)
+        shm.close()
+    return (name, shape, dtype.str, fill)
+
+
+def find(array):
+    """Spec of the shared block holding an array, or None if it is not shared."""
+    array = np.asarray(array)
+    address = array.__array_interface__["data"][0]
+    for name, (shm, arr, _) in _attached.items():
+        if (arr is not None and arr.__array_interface__["data"][0] == address and
+                arr.shape == array.shape and arr.dtype == array.dtype):
+            return spec_of(name)
+    return None
+
+
+def detach(spec, force=False):
+    """Drop one attachment of a block, unmapping it with the last one."""
+    name = spec if isinstance(spec, str) else spec[0]
+    entry = _attached.get(name)
+    if entry is None:
+        return
+    entry[2] -= 1
+    if entry[2] <= 0 or force:
+        del _attached[name]
+        entry[1] = None
+        try:
+            entry[0].close()
+        except BufferError:
+            # Views of the array are still alive in this process
+            pass
+
+
+def detach_all():
+    for name in list(_attached):
+        detach(name, force=True)
+
+
+class Arena(object):
+    """Named shared arrays of a run with reference-counted cleanup."""
+
+    def __init__(self, name=None):
+        # Short names: POSIX shared memory names are limited on some systems
+        self.name = name or "cp%d_%s" % (os.getpid(), uuid.uuid4().hex[:6])
+        self.blocks = {}
+        self.specs = {}
+        self.refs = {}
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self.specs
+
+    def __getitem__(self, key):
+        return self.array(key)
+
+    def create(self, key, shape, dtype, fill=0):
+        """New shared array filled with fill; returns its spec."""
+        if key in self.specs:
+            self.release(key, all=True)
+        dtype = np.dtype(dtype)
+        shape = tuple(int(n) for n in shape)
+        size = HEADER + max(int(np.prod(shape)) * dtype.itemsize, 1)
+        self.count += 1
+        shm = shared_memory.SharedMemory(name="%s_%d" % (self.name, self.count),
+                                         create=True, size=size)
+        _write_header(shm.buf, shape, dtype, fill)
+        arr = _array(shm, shape, dtype)
+        arr[...] = fill
+        _attached[shm.name] = [shm, arr, 1]
+        self.blocks[key] = shm
+        self.specs[key] = (shm.name, shape, dtype.str, fill)
+        self.refs[key] = 1
+        return self.specs[key]
+
+    def publish(self, key, array, fill=0):
+        """Copy an array into the arena once; returns its spec."""
+        array = np.asarray(array)
+        spec = self.create(key, array.shape, array.dtype, fill)
+        self.array(key)[...] = array
+        return spec
+
+    def publish_stack(self, key, arrays, fill=0):
+        """Stack equally shaped arrays, e.g. the land cover of several years."""
+        arrays = list(arrays)
+        spec = self.create(key, (len(arrays),) + arrays[0].shape, arrays[0].dtype, fill)
+        stack = self.array(key)
+        for i, array in enumerate(arrays):
+            stack[i] = array
+        return spec
+
+    def array(self, key):
+        return _attached[self.specs[key][0]][1]
+
+    def spec(self, key):
+        return self.specs[key]
+
+    def transfer(self, key, other, new_key=None):
+        """Hand a block and its references over to another arena, without copying."""
+        new_key = key if new_key is None else new_key
+        other.release(new_key, all=True)
+        other.blocks[new_key] = self.blocks.pop(key)
+        other.specs[new_key] = self.specs.pop(key)
+        other.refs[new_key] = self.refs.pop(key)
+        return other.specs[new_key]
+
+    def retain(self, key):
+        self.refs[key] += 1
+        return self.specs[key]
+
+    def release(self, key, all=False):
+        """Drop a reference to a block; the last one unlinks it."""
+        if key not in self.refs:
+            return
+        self.refs[key] = 0 if all else self.refs[key] - 1
+        if self.refs[key] > 0:
+            return
+        shm = self.blocks.pop(key)
+        name = self.specs.pop(key)[0]
+        del self.refs[key]
+        entry = _attached.pop(name, None)
+        if entry is not None:
+            entry[1] = None
+        try:
+            shm.close()
+        except BufferError:
+            pass
+        shm.unlink()
+
+    def close(self):
+        for key in list(self.refs):
+            self.release(key, all=True)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Sub-pixel water and vegetation fractions by spectral unmixing
+
+The hard classification gives each pixel one class, so widths are counted in
+whole pixels and wet threads narrower than about two pixels are lost on 30 m
+imagery. Here every pixel is taken as a mix of three endmembers, water, bare
+sand and vegetation, placed in the (MNDWI, NDVI) plane:
+
+    1) The endmembers are the median indices of the pure pixels of each
+       class of the hard classification, the pixels of a class whose whole
+       3 x 3 neighbourhood is of the same class; defaults are used for a
+       class with too few pure pixels, and for all three when they fall on
+       a line of the plane, where the fractions are undetermined
+    2) The fractions f of each pixel solve, for all pixels at once,
+           MNDWI = sum(f * MNDWI of the endmembers)
+           NDVI = sum(f * NDVI of the endmembers)
+           sum(f) = 1
+       negative fractions are set to zero and the rest rescaled to one
+    3) The fractions are integrated along the transects: Ww is the sum of
+       the water fraction of the samples times their spacing and Aw that of
+       water plus sand, both within the active channel of the hard
+       extraction grown by one pixel so that its mixed edge pixels count.
+       Threads are the runs of samples with a water fraction of at least
+       min_fraction, so a thread covering a third of a pixel still counts;
+       the threshold does not apply to Ww.
+
+The indices are ratios of the reflectances and do not mix exactly linearly,
+but the error is small against the gain in width resolution. Widths come out
+to a fraction of a pixel on the inputs of the hard classification.
+"""
+
+import numpy as np
+from scipy import ndimage
+
+import channel_raster
+import kernels
+from transect_intersect import sample_transects
+
+# (MNDWI, NDVI) of water, sand and vegetation when the image has too few
+# pure pixels of a class
+ENDMEMBERS = np.array([[0.6, -0.2],
+                       [-0.2, 0.1],
+                       [-0.5, 0.7]])
+CLASSES = (channel_raster.WATER, channel_raster.SAND, channel_raster.VEGETATION)
+
+
+def indices(green, red, nir, swir):
+    """MNDWI and NDVI of the band arrays."""
+    return (channel_raster.normalized_difference(green, swir),
+            channel_raster.normalized_difference(nir, red))
+
+
+def collinear(members, tol=1e-3):
+    """True when the (3, 2) endmembers are close to a line of the index plane.
+
+    tol is the least area of their triangle relative to that of a triangle
+    with the same longest side.
+    """
+    m = np.asarray(members, np.float64)
+    u, v = m[1] - m[0], m[2] - m[0]
+    area = abs(u[0] * v[1] - u[1] * v[0])
+    side = max(np.sum(u ** 2), np.sum(v ** 2), np.sum((m[2] - m[1]) ** 2))
+    return not np.isfinite(area) or area <= tol * side
+
+
+def endmembers(mndwi, ndvi, land_class, min_pixels=50):
+    """(3, 2) MNDWI and NDVI of water, sand and vegetation from pure pixels."""
+    out = ENDMEMBERS.copy()
+    valid = np.isfinite(mndwi) & np.isfinite(ndvi)
+    for k, value in enumerate(CLASSES):
+        pure = ndimage.binary_erosion(land_class == value, np.ones((3, 3), bool)) & valid
+        if pure.sum() >= min_pixels:
+            out[k] = np.median(mndwi[pure]), np.median(ndvi[pure])
+    if collinear(out):
+        return ENDMEMBERS.copy()
+    return out
+
+
+def unmix(mndwi, ndvi, members=ENDMEMBERS):
+    """Water, sand and vegetation fractions, (3, rows, cols) float32.
+
+    NaN where an index is NaN. Collinear members are replaced by the
+    defaults.
+    """
+    members = np.asarray(members, np.float64)
+    if collinear(members):
+        members = ENDMEMBERS
+    system = np.vstack((members.T, np.ones(3)))
+    inverse = np.linalg.inv(system)
+    b = np.stack((mndwi, ndvi, np.ones_like(mndwi))).astype(np.float32)
+    f = np.tensordot(inverse.astype(np.float32), b, axes=1)
+    np.maximum(f, 0, out=f)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        f /= f.sum(axis=0)
+    f[:, ~(np.isfinite(mndwi) & np.isfinite(ndvi))] = np.nan
+    return f
+
+
+def fractional_metrics(fractions, active, xy, origin, cell, min_fraction=0.25, step=0.25):
+    """Sub-pixel Ww, Aw and Threads of (N, 2, 2) transects.
+
+    fractions is the result of unmix and active the boolean active channel
+    mask of the hard extraction on the same grid.
+    """
+    xy = np.asarray(xy, np.float64).reshape(-1, 2, 2)
+    n = len(xy)
+    water, sand = np.nan_to_num(fractions[0]), np.nan_to_num(fractions[1])
+    corridor = ndimage.binary_dilation(active, np.ones((3, 3), bool))
+    tr, row, col, count = sample_transects(xy, origin, cell, active.shape, step)
+    valid = row >= 0
+    tr, row, col = tr[valid], row[valid], col[valid]
+    spacing = np.hypot(*(xy[:, 1] - xy[:, 0]).T) / count
+    inside = corridor[row, col]
+    w = np.where(inside, water[row, col], 0.0)
+    a = np.where(inside, water[row, col] + sand[row, col], 0.0)
+    return {"Ww": np.bincount(tr, weights=w, minlength=n) * spacing,
+            "Aw": np.bincount(tr, weights=a, minlength=n) * spacing,
+            "Threads": kernels.get("run_count")(tr, w >= min_fraction, n)}
+
+
+if __name__ == '__main__':
+
+    import arcpy
+
+    import quick_look
+    import scene_prefetch
+    import tile_pipeline
+    import transect_intersect
+
+    image = arcpy.GetParameterAsText(0)
+    envelope = arcpy.GetParameterAsText(1)
+    transects = arcpy.GetParameterAsText(2)
+    out_table = arcpy.GetParameterAsText(3)
+    green_band = arcpy.GetParameterAsText(4)
+    red_band = arcpy.GetParameterAsText(5)
+    nir_band = arcpy.GetParameterAsText(6)
+    swir_band = arcpy.GetParameterAsText(7)
+    ndvi_threshold = arcpy.GetParameterAsText(8)
+    mndwi_threshold = arcpy.GetParameterAsText(9)
+    waterArea_threshold = arcpy.GetParameterAsText(10)
+    barArea_threshold = arcpy.GetParameterAsText(11)
+    min_fraction = float(arcpy.GetParameterAsText(12) or 0.25)
+
+    arcpy.env.overwriteOutput = True
+
+    arcpy.AddMessage("Reading the band window")
+    grid, bands, inside = scene_prefetch.band_window_loader(
+        envelope, (green_band, red_band, nir_band, swir_band))(image)
+    keys, xy = transect_intersect.read_transects(transects, "Distance")
+    order = np.argsort(keys)
+    keys, xy = keys[order], xy[order]
+    origin = (grid.x0, grid.y0)
+
+    arcpy.AddMessage("Extracting the channels")
+    products = tile_pipeline.extract_channels(
+        bands, inside, grid.cell, ndvi_threshold, mndwi_threshold,
+        waterArea_threshold, barArea_threshold)
+    hard = quick_look.sampled_metrics(products, xy, origin, grid.cell)
+
+    arcpy.AddMessage("Unmixing")
+    mndwi, ndvi = indices(*bands)
+    members = endmembers(mndwi, ndvi, products["landClass"])
+    fractions = unmix(mndwi, ndvi, members)
+    fractions[:, ~inside] = np.nan
+    metrics = fractional_metrics(fractions, products["active"], xy, origin, grid.cell, min_fraction)
+
+    rows = np.zeros(len(keys), dtype=[("Distance", np.float64), ("Ww", np.float64),
+                                      ("Aw", np.float64), ("Threads", np.int32),
+                                      ("Ww_Hard", np.float64), ("Aw_Hard", np.float64)])
+    rows["Distance"] = keys
+    for name in ("Ww", "Aw", "Threads"):
+        rows[name] = metrics[name]
+    rows["Ww_Hard"] = hard["Ww"]
+    rows["Aw_Hard"] = hard["Aw"]
+    if arcpy.Exists(out_table):
+        arcpy.management.Delete(out_table)
+    arcpy.da.NumPyArrayToTable(rows, out_table)
+    arcpy.AddMessage("Endmembers (MNDWI, NDVI): water {0}, sand {1}, vegetation {2}".format(
+        *[tuple(np.round(m, 2)) for m in members]))
+    arcpy.AddMessage("Mean Ww {0:.1f} m ({1:.1f} m hard), Aw {2:.1f} m ({3:.1f} m hard)".format(
+        np.mean(rows["Ww"]), np.mean(rows["Ww_Hard"]), np.mean(rows["Aw"]), np.mean(rows["Aw_Hard"])))
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Stage graph scheduler for the pipeline scripts
+
+A pipeline is declared as stages, each a function with named inputs and
+outputs:
+
+    graph = StageGraph()
+    graph.add("wet_channel", wet_channel, ["landClass", "waterArea_threshold"],
+              ["wetChannelBoundary"])
+
+A stage is called with the values of its inputs as positional arguments and
+returns the value of its single output, or a tuple with one value per
+output. The initial values (parameters, input datasets) are given to run().
+A stage is ready once all of its inputs exist, and the ready stages run
+concurrently on a thread or a process pool, so branches that do not depend
+on each other overlap. With a process pool the functions must be defined at
+module level and the values must pickle, which holds for dataset names.
+
+Each run returns the timing of every stage. critical_path finds the chain
+of dependent stages that took the longest, which bounds the wall time of the
+run whatever the number of workers, and report formats both.
+"""
+
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import raster_tiles
+
+Stage = namedtuple("Stage", ["name", "fn", "inputs", "outputs"])
+Timing = namedtuple("Timing", ["name", "start", "end"])
+
+
+def _call(fn, args):
+    start = time.time()
+    result = fn(*args)
+    return result, start, time.time()
+
+
+class StageGraph(object):
+    """Stages with declared inputs and outputs, run in dependency order."""
+
+    def __init__(self):
+        self.stages = []
+
+    def add(self, name, fn, inputs=(), outputs=()):
+        if any(s.name == name for s in self.stages):
+            raise ValueError("duplicate stage %r" % name)
+        produced = set(o for s in self.stages for o in s.outputs)
+        for output in outputs:
+            if output in produced:
+                raise ValueError("%r of stage %r is already the output of another stage" % (output, name))
+        stage = Stage(name, fn, tuple(inputs), tuple(outputs))
+        self.stages.append(stage)
+        return stage
+
+    def producers(self):
+        """Stage producing each output."""
+        return dict((o, s) for s in self.stages for o in s.outputs)
+
+    def upstream(self, stage):
+        """Stages whose outputs the stage reads."""
+        producers = self.producers()
+        names = []
+        for i in stage.inputs:
+            if i in producers and producers[i].name not in names:
+                names.append(producers[i].name)
+        return names
+
+    def check(self, values):
+        """Raise ValueError on inputs nobody provides or on cycles."""
+        available = set(values)
+        done = set()
+        while len(done) < len(self.stages):
+            ready = [s for s in self.stages if s.name not in done
+                     and all(i in available for i in s.inputs)]
+            if not ready:
+                missing = sorted(set(i for s in self.stages if s.name not in done
+                                     for i in s.inputs) - available - set(self.producers()))
+                if missing:
+                    raise ValueError("no value or stage for " + ", ".join(missing))
+                raise ValueError("cycle between stages " + ", ".join(
+                    s.name for s in self.stages if s.name not in done))
+            for s in ready:
+                done.add(s.name)
+                available.update(s.outputs)
+
+    def run(self, values, workers=1, pool="thread", initializer=None, initargs=(), log=None):
+        """Run the stages from the initial values.
+
+        workers=1 runs the stages one at a time in declaration order of the
+        ready ones, in this process. pool is "thread" or "process";
+        initializer(*initargs) is called once in every pool worker, e.g. to
+        set arcpy.env. Returns (values, timings).
+        """
+        self.check(values)
+        values = dict(values)
+        pending = list(self.stages)
+        timings = []
+        running = {}
+
+        def ready():
+            return [s for s in pending if all(i in values for i in s.inputs)]
+
+        def finish(stage, result, start, end):
+            if len(stage.outputs) == 1:
+                result = (result,)
+            elif not stage.outputs:
+                result = ()
+            if len(result) != len(stage.outputs):
+                raise ValueError("stage %r returned %d values for %d outputs"
+                                 % (stage.name, len(result), len(stage.outputs)))
+            values.update(zip(stage.outputs, result))
+            timings.append(Timing(stage.name, start, end))
+            if log is not None:
+                log("{0} done in {1:.1f} s".format(stage.name, end - start))
+
+        if workers == 1:
+            while pending:
+                stage = ready()[0]
+                pending.remove(stage)
+                if log is not None:
+                    log("Running " + stage.name)
+                finish(stage, *_call(stage.fn, [values[i] for i in stage.inputs]))
+            return values, timings
+
+        if pool == "process":
+            executor = raster_tiles.process_pool(workers, initializer, initargs)
+        elif pool == "thread":
+            if initializer is not None:
+                initializer(*initargs)
+            executor = ThreadPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError("unknown pool %r, expected thread or process" % pool)
+        with executor:
+            while pending or running:
+                for stage in ready():
+                    pending.remove(stage)
+                    if log is not None:
+                        log("Running " + stage.name)
+                    future = executor.submit(_call, stage.fn, [values[i] for i in stage.inputs])
+                    running[future] = stage
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        for other in running:
+                            other.cancel()
+                        raise
+                    finish(stage, *result)
+        return values, timings
+
+
+def critical_path(graph, timings):
+    """Names of the chain of dependent stages with the longest total time."""
+    seconds = dict((t.name, t.end - t.start) for t in timings)
+    best = {}
+    for t in sorted(timings, key=lambda t: t.end):
+        stage = [s for s in graph.stages if s.name == t.name][0]
+        before = [best[u] for u in graph.upstream(stage) if u in best]
+        length, chain = max(before) if before else (0.0, [])
+        best[t.name] = (length + seconds[t.name], chain + [t.name])
+    if not best:
+        return []
+    return max(best.values())[1]
+
+
+def report(graph, timings):
+    """Lines with the wall time, the critical path and the time of each stage."""
+    if not timings:
+        return []
+    t0 = min(t.start for t in timings)
+    wall = max(t.end for t in timings) - t0
+    busy = sum(t.end - t.start for t in timings)
+    path = critical_path(graph, timings)
+    seconds = dict((t.name, t.end - t.start) for t in timings)
+    lines = ["wall {0:.1f} s, stages {1:.1f} s, critical path {2:.1f} s".format(
+                 wall, busy, sum(seconds[n] for n in path)),
+             "critical path: " + " > ".join(path)]
+    for t in sorted(timings, key=lambda t: t.start):
+        lines.append("{0}{1:<24} {2:8.1f} {3:8.1f} {4:8.1f} s".format(
+            "*" if t.name in path else " ", t.name, t.start - t0, t.end - t0, t.end - t.start))
+    return lines
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the GeoPackage writer of bulk_writer
+"""
+
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bulk_writer  # noqa: E402
+
+SQUARE = [np.array([[0.0, 0.0], [10.0, 0.0], [10.0, 10.0], [0.0, 10.0]])]
+
+
+def square_layer(name, count=3):
+    geometries = [[ring + 20.0 * k for ring in SQUARE] for k in range(count)]
+    rows = [(k, float(k) / 2) for k in range(count)]
+    return bulk_writer.Layer(name, "POLYGON", [("Class", "INTEGER"), ("Area", "REAL")],
+                             geometries, rows)
+
+
+def test_write_gpkg(tmp_path):
+    path = str(tmp_path / "out.gpkg")
+    bulk_writer.write_gpkg(path, [square_layer("units"), square_layer("reaches", 2)])
+    conn = sqlite3.connect(path)
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM units").fetchone()[0] == 3
+        assert conn.execute("SELECT COUNT(*) FROM reaches").fetchone()[0] == 2
+        assert conn.execute("SELECT COUNT(*) FROM rtree_units_geom").fetchone()[0] == 3
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    finally:
+        conn.close()
+
+
+def test_failing_layer_leaves_file_unchanged(tmp_path):
+    path = str(tmp_path / "out.gpkg")
+    bulk_writer.write_gpkg(path, [square_layer("units")])
+    with open(path, "rb") as f:
+        before = f.read()
+    # The second layer fails after the first has replaced the existing units
+    broken = bulk_writer.Layer("reaches", "CURVE", [], [SQUARE], [()])
+    with pytest.raises(ValueError):
+        bulk_writer.write_gpkg(path, [square_layer("units", 5), broken])
+    with open(path, "rb") as f:
+        assert f.read() == before
+    assert not os.path.exists(path + "-journal")
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the packed morphology of packed_mask against scipy.ndimage
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import channel_raster  # noqa: E402
+import packed_mask  # noqa: E402
+
+
+def random_mask(rows, cols, seed):
+    rng = np.random.default_rng(seed)
+    # Blobs rather than noise, so the closings have gaps to close
+    noise = ndimage.uniform_filter(rng.random((rows, cols)), 5)
+    return noise > 0.5
+
+
+@pytest.mark.parametrize("cols", [1, 63, 64, 65, 130, 200])
+@pytest.mark.parametrize("radius", [0, 1, 3, 7])
+def test_dilate_erode_close_match_scipy(cols, radius):
+    mask = random_mask(40, cols, cols * 10 + radius)
+    packed = packed_mask.pack(mask)
+    assert np.array_equal(packed.unpack(), mask)
+    if radius == 0:
+        assert np.array_equal(packed.dilate(0).unpack(), mask)
+        return
+    disk = channel_raster.disk(radius)
+    assert np.array_equal(packed.dilate(radius).unpack(),
+                          ndimage.binary_dilation(mask, disk))
+    assert np.array_equal(packed.erode(radius).unpack(),
+                          ndimage.binary_erosion(mask, disk))
+    assert np.array_equal(packed.close(radius).unpack(),
+                          ndimage.binary_closing(mask, disk))
+
+
+@pytest.mark.parametrize("cols", [1, 64, 100, 257])
+def test_popcount_and_invert(cols):
+    mask = random_mask(30, cols, cols)
+    packed = packed_mask.pack(mask)
+    assert packed.count() == int(mask.sum())
+    assert (~packed).count() == int((~mask).sum())
+    assert np.array_equal((~packed).unpack(), ~mask)
+    assert packed.area(2.5) == pytest.approx(mask.sum() * 6.25)
+    other = random_mask(30, cols, cols + 1)
+    assert np.array_equal(packed.andnot(packed_mask.pack(other)).unpack(), mask & ~other)
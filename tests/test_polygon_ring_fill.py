@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the gap bridges of polygon_ring_fill
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import polygon_ring_fill  # noqa: E402
+
+
+def covered(points, bridges):
+    """Points inside any of the bridge quadrilaterals, by ray casting."""
+    out = np.zeros(len(points), bool)
+    x, y = points[:, 0], points[:, 1]
+    for _, quad in bridges:
+        inside = np.zeros(len(points), bool)
+        for (x1, y1), (x2, y2) in zip(quad, np.roll(quad, -1, axis=0)):
+            if y1 == y2:
+                continue
+            inside ^= ((y1 > y) != (y2 > y)) & (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+        out |= inside
+    return out
+
+
+def box(x0, y0, x1, y1):
+    return np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], np.float64)
+
+
+def test_long_gap_is_bridged_along_its_length():
+    bridges = polygon_ring_fill.gap_bridges([box(0, 0, 100, 10), box(0, 15, 100, 25)], 10.0)
+    gap = np.mgrid[0.5:100:1, 10.25:15:0.5].reshape(2, -1).T
+    assert covered(gap, bridges).all()
+    assert polygon_ring_fill.gap_bridges([box(0, 0, 100, 10), box(0, 15, 100, 25)], 4.0) == []
+
+
+def test_inlet_is_closed_and_inside_is_not_bridged():
+    inlet = np.array([[0, 0], [30, 0], [30, 60], [17, 60], [17, 10],
+                      [13, 10], [13, 60], [0, 60]], np.float64)
+    bridges = polygon_ring_fill.gap_bridges([inlet], 10.0)
+    points = np.mgrid[13.25:17:0.5, 15.5:60:1].reshape(2, -1).T
+    assert covered(points, bridges).all()
+    # A strip narrower than the gap has no gap of its own to close
+    assert polygon_ring_fill.gap_bridges([box(0, 0, 100, 10)], 20.0) == []
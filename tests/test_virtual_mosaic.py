@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the scene choice of virtual_mosaic
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import virtual_mosaic  # noqa: E402
+
+LAND = 0.10
+WATER = 0.04
+CLOUD = 0.45
+SHADOW = 0.01
+
+
+def scenes(*values):
+    """Green and red (scenes, rows, cols) stacks of constant scenes with land around."""
+    stacks = []
+    for _ in range(2):
+        stack = np.full((len(values), 20, 20), LAND, np.float32)
+        for k, v in enumerate(values):
+            if v is not None:
+                stack[k, 5:15, 5:15] = v
+        stacks.append(stack)
+    return stacks
+
+
+def river(choice):
+    return np.unique(choice[5:15, 5:15]).tolist()
+
+
+def test_water_under_cloud_takes_the_clear_scene():
+    assert river(virtual_mosaic.select(scenes(WATER, CLOUD))) == [0]
+    assert river(virtual_mosaic.select(scenes(CLOUD, WATER))) == [1]
+
+
+def test_shadow_takes_the_clear_scene():
+    assert river(virtual_mosaic.select(scenes(SHADOW, LAND))) == [1]
+    assert river(virtual_mosaic.select(scenes(WATER, SHADOW, WATER))) in ([0], [2])
+
+
+def test_water_in_every_scene_stays_water():
+    stacks = scenes(WATER, WATER * 1.2, CLOUD)
+    choice = virtual_mosaic.select(stacks)
+    assert river(choice) == [0]
+    out = virtual_mosaic.compose(stacks, choice)
+    assert np.allclose(out[0][5:15, 5:15], WATER)
+
+
+def test_cloud_threshold_and_no_data():
+    stacks = scenes(WATER, CLOUD)
+    stacks[0][0, 5:15, 5:15] = np.nan
+    stacks[1][0, 5:15, 5:15] = np.nan
+    assert river(virtual_mosaic.select(stacks)) == [1]
+    assert river(virtual_mosaic.select(scenes(0.2, 0.3), cloud=0.25)) == [0]
+    stacks = scenes(WATER, CLOUD)
+    for stack in stacks:
+        stack[:, 0, 0] = np.nan
+    assert virtual_mosaic.select(stacks)[0, 0] == -1
+
+
+def test_mosaic_prefix():
+    assert virtual_mosaic.is_mosaic("mosaic:a.tif|b.tif")
+    assert not virtual_mosaic.is_mosaic("/data/a+b.tif")
@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+"""
+Tile-parallel raster pipeline for land cover classification and channel extraction
+
+It takes the band arrays of the envelope window and produces the land cover,
+wet channel, active channel and geomorphic unit rasters, following the steps
+of Sub-tool-1 and Sub-tool-2 of channel_planform_from_satellite.py:
+
+    1) Classify the land cover
+    2) Wet channel: close the water by half the gap distance, keep the
+       components above the water area threshold and fill their holes
+    3) Active channel: join the sand to the wet channel, keep the components
+       above the water area threshold, close them and fill their holes
+    4) Mid-channel units: land within the wet channel with its holes filled;
+       side units: active channel outside the wet channel. Both are kept
+       above the bar area threshold and typed by their vegetation ratio
+
+The window is split into tiles with a halo of twice the largest closing
+radius, so the closings of a tile equal those of the whole window. Steps run
+tile by tile on a process pool and read and write arrays in shared memory.
+The closings run on bit-packed masks (packed_mask).
+Steps that need whole components (area thresholds and hole filling) label
+each tile, join the labels across the tile seams and sum the areas over the
+tiles, so the thresholds are applied to the exact component areas.
+
+The script tool writes landClass, wetChannelBoundary, activeChannel and
+channelUnit to the output workspace with the fields of the main tool, and
+the thread network of the wet channel to channelNetwork. The layers of an
+image are written together with bulk_writer, to a file geodatabase or, when
+the output workspace is a .gpkg file, to a GeoPackage. Given
+several images it runs as a time series and suffixes the outputs with the
+year, reading the bands of the next images while the current one runs. An
+image can be several overlapping scenes, "mosaic:" and their paths
+separated by "|", read as a virtual_mosaic without writing a mosaic. With
+an overview factor it runs coarse-to-fine: the active corridor found on the
+decimated overview, dilated by a margin, is the only part classified at full
+resolution, and the skipped fraction of the pixels is reported. In
+incremental mode each image reuses the closings of the previous one where
+their input did not change and writes the changed tiles to changedTiles.
+"""
+
+import os
+from functools import partial
+
+import numpy as np
+from scipy import ndimage
+
+import channel_raster
+import kernels
+import packed_mask
+import raster_tiles
+import shared_arena
+from shared_arena import attach
+
+# Rasters returned by extract_channels
+RESULTS = ("landClass", "wet", "active", "units")
+
+def reader(specs, tile):
+    """Accessor get(name, halo=0) for the arrays of one tile."""
+    def get(name, halo=0):
+        spec = specs[name]
+        return raster_tiles.read_tile(attach(spec), tile._replace(halo=halo), spec[3])
+    return get
+
+
+def write(specs, name, tile, values):
+    attach(specs[name])[tile.row0:tile.row1, tile.col0:tile.col1] = values
+
+
+#### Masks derived from the shared arrays; get is a tile accessor
+
+def water_mask(get, halo=0):
+    return get("landClass", halo) == channel_raster.WATER
+
+
+def vegetation_mask(get, halo=0):
+    return get("landClass", halo) == channel_raster.VEGETATION
+
+
+def array_mask(name, get, halo=0):
+    return get(name, halo).astype(bool)
+
+
+def background_mask(name, get, halo=0):
+    return ~get(name, halo).astype(bool)
+
+
+def active_potential_mask(get, halo=0):
+    return get("wet", halo) | (get("landClass", halo) == channel_raster.SAND)
+
+
+def land_in_wet_mask(get, halo=0):
+    land_class = get("landClass", halo)
+    land = (land_class == channel_raster.SAND) | (land_class == channel_raster.VEGETATION)
+    return get("wet", halo) & land
+
+
+def side_mask(get, halo=0):
+    return get("active", halo) & ~get("wet", halo)
+
+
+#### Tile jobs
+
+def classify_job(specs, ndvi_threshold, mndwi_threshold, tile):
+    get = reader(specs, tile)
+    inside = get("inside")
+    if not inside.any():
+        # Left as NoData, as outside the envelope or the corridor
+        return
+    land_class = channel_raster.classify(
+        get("green"), get("red"), get("nir"), get("swir"),
+        ndvi_threshold, mndwi_threshold, inside)
+    write(specs, "landClass", tile, land_class)
+
+
+def close_job(specs, mask_fn, dst, radius, tile, step=None):
+    """Close a mask on a tile; returns 1 if the closing was computed.
+
+    With a step name the input and output of the tile are also kept in
+    <step>_in and <step>_out. When the previous year's arrays of the step
+    are given as prev_<step>_in and prev_<step>_out and the input of the
+    tile with its halo is unchanged, the previous output is carried forward.
+    """
+    get = reader(specs, tile)
+    halo = 2 * radius
+    mask = mask_fn(get, halo)
+    core = mask[halo:mask.shape[0] - halo, halo:mask.shape[1] - halo]
+    if step is not None:
+        write(specs, step + "_in", tile, core)
+        if "prev_" + step + "_in" in specs and np.array_equal(mask, get("prev_" + step + "_in", halo)):
+            closed = get("prev_" + step + "_out")
+            write(specs, step + "_out", tile, closed)
+            write(specs, dst, tile, closed)
+            return 0
+    if radius > 0 and mask.any():
+        mask = packed_mask.pack(mask).close(radius).unpack()
+    closed = mask[halo:mask.shape[0] - halo, halo:mask.shape[1] - halo]
+    if step is not None:
+        write(specs, step + "_out", tile, closed)
+    write(specs, dst, tile, closed)
+    return 1
+
+
+def label_job(specs, mask_fn, dst, connectivity, count_fn, tile):
+    """Label the components of a tile core.
+
+    Returns the number of labels, their pixel areas, their first pixel in
+    the window (row-major), the labels touching the window border and, with
+    count_fn, the count of its pixels per label.
+    """
+    get = reader(specs, tile)
+    labels, n = ndimage.label(mask_fn(get), structure=channel_raster.structure(connectivity))
+    write(specs, dst, tile, labels)
+    areas = np.bincount(labels.ravel(), minlength=n + 1)[1:]
+    rows, cols = specs[dst][1]
+    found, index = np.unique(labels.ravel(), return_index=True)
+    r, c = np.divmod(index[found > 0], labels.shape[1])
+    first = (r + tile.row0) * cols + c + tile.col0
+    edges = []
+    if tile.row0 == 0:
+        edges.append(labels[0])
+    if tile.row1 == rows:
+        edges.append(labels[-1])
+    if tile.col0 == 0:
+        edges.append(labels[:, 0])
+    if tile.col1 == cols:
+        edges.append(labels[:, -1])
+    border = np.unique(np.concatenate(edges)) if edges else np.zeros(0, np.int32)
+    counts = None
+    if count_fn is not None:
+        counts = np.bincount(labels[count_fn(get)], minlength=n + 1)[1:]
+    return n, areas, first, border[border > 0], counts
+
+
+def apply_job(specs, src, offsets, lut, dst, base_fn, merge, tile):
+    """Write lut[global label] for a tile, optionally or-ed with a base mask.
+
+    With merge the existing values of dst are kept where the lookup gives 0,
+    so several label sets can be written to one raster.
+    """
+    get = reader(specs, tile)
+    local = get(src)
+    value = attach(specs[lut])[np.where(local > 0, local + offsets[tile.index], 0)]
+    if base_fn is not None:
+        value = base_fn(get) | value.astype(bool)
+    if merge:
+        value = np.where(value != 0, value, get(dst))
+    write(specs, dst, tile, value)
+
+
+class Components(object):
+    """Components of a mask joined across tiles.
+
+    comp maps a global tile label to its component, and area, first,
+    border and count are indexed by component. first is the row-major index
+    of the first pixel, which orders components independently of the tiling.
+    """
+
+    def __init__(self, offsets, comp, area, first, border, count):
+        self.offsets = offsets
+        self.comp = comp
+        self.area = area
+        self.first = first
+        self.border = border
+        self.count = count
+
+
+def seam_pairs(labels, offsets, tile_size, connectivity):
+    """Pairs of global labels of neighbouring pixels across the tile seams."""
+    rows, cols = labels.shape
+    ntile_cols = (cols + tile_size - 1) // tile_size
+    pairs = []
+
+    def to_global(line, r, c):
+        ids = offsets[(r // tile_size) * ntile_cols + c // tile_size]
+        return np.where(line > 0, line + ids, 0)
+
+    r = np.arange(rows)
+    for cb in range(tile_size, cols, tile_size):
+        left = to_global(labels[:, cb - 1], r, cb - 1)
+        right = to_global(labels[:, cb], r, cb)
+        pairs.append((left, right))
+        if connectivity == 8:
+            pairs.append((left[:-1], right[1:]))
+            pairs.append((left[1:], right[:-1]))
+    c = np.arange(cols)
+    for rb in range(tile_size, rows, tile_size):
+        top = to_global(labels[rb - 1], rb - 1, c)
+        bottom = to_global(labels[rb], rb, c)
+        pairs.append((top, bottom))
+        if connectivity == 8:
+            pairs.append((top[:-1], bottom[1:]))
+            pairs.append((top[1:], bottom[:-1]))
+    if not pairs:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    a = np.concatenate([p[0] for p in pairs])
+    b = np.concatenate([p[1] for p in pairs])
+    keep = (a > 0) & (b > 0)
+    return a[keep], b[keep]
+
+
+def label_components(run, tiles, tile_size, specs, mask_fn, dst="labels",
+                     connectivity=4, count_fn=None):
+    """Label a mask tile by tile and reconcile the labels across seams."""
+    results = run(partial(label_job, specs, mask_fn, dst, connectivity, count_fn), tiles)
+    n = np.array([r[0] for r in results], np.int64)
+    offsets = np.concatenate(([0], np.cumsum(n)[:-1]))
+    total = int(n.sum()) + 1
+    area = np.zeros(total, np.int64)
+    first = np.full(total, np.iinfo(np.int64).max)
+    border = np.zeros(total, bool)
+    count = np.zeros(total, np.int64)
+    for t, (k, a, f, b, c) in enumerate(results):
+        area[offsets[t] + 1:offsets[t] + k + 1] = a
+        first[offsets[t] + 1:offsets[t] + k + 1] = f
+        border[b + offsets[t]] = True
+        if c is not None:
+            count[offsets[t] + 1:offsets[t] + k + 1] = c
+    a, b = seam_pairs(attach(specs[dst]), offsets, tile_size, connectivity)
+    ncomp, comp = kernels.get("union_find")(a, b, total)
+    first_pixel = np.full(ncomp, np.iinfo(np.int64).max)
+    np.minimum.at(first_pixel, comp, first)
+    return Components(offsets, comp,
+                      np.bincount(comp, weights=area, minlength=ncomp),
+                      first_pixel,
+                      np.bincount(comp, weights=border, minlength=ncomp) > 0,
+                      np.bincount(comp, weights=count, minlength=ncomp))
+
+
+def unit_class(units, table):
+    """Raster of unit types, 0: none, 1: SB, 2: MB, 3: IS."""
+    codes = np.zeros(len(table) + 1, np.uint8)
+    for code, name in enumerate(("SB", "MB", "IS"), 1):
+        codes[table["Unit_Id"][table["Unit_Type"] == name]] = code
+    return codes[units]
+
+
+def changed_tiles(tiles, previous, current, names=("wet", "active", "unitClass")):
+    """Indices of the tiles whose core differs between two sets of products."""
+    changed = []
+    for tile in tiles:
+        window = (slice(tile.row0, tile.row1), slice(tile.col0, tile.col1))
+        for name in names:
+            if not np.array_equal(previous[name][window], current[name][window]):
+                changed.append(tile.index)
+                break
+    return changed
+
+
+def extract_channels(bands, inside, cell_size, ndvi_threshold, mndwi_threshold,
+                     waterArea_threshold, barArea_threshold, wet_gap=60,
+                     active_gap=60, tile_size=1024, workers=None, corridor=None,
+                     previous=None, arena=None, key=""):
+    """Run the classification and channel extraction on tiles.
+
+    bands is a (green, red, nir, swir) tuple of arrays of the window and
+    inside the envelope mask. Gaps are the closing diameters in map units.
+    With a corridor mask only its pixels are classified, the rest of the
+    window is NoData and tiles without corridor pixels are skipped.
+    Returns a dict with landClass (uint8), wet and active (bool), units
+    (int32 Unit_Id raster), unitClass (uint8 unit type raster), unitTable
+    (Unit_Id, Unit_Area, Veg_Area, Veg_Ratio, Unit_Type), steps (input and
+    output masks of the closings) and skipped, the fraction of the window
+    pixels that were not classified.
+
+    Incremental mode: previous is the result of the previous year on the
+    same window. The closings, the costly steps, are then only computed on
+    the tiles whose input mask changed within the halo and carried forward
+    elsewhere, which gives the same result as a full run; labeling, area
+    thresholds and hole filling still run on the whole window since a
+    change can join or split components anywhere. The result then also has
+    changedTiles, the tiles whose channel masks or units changed, and
+    recomputed, the fraction of closings that were computed.
+
+    Given a shared_arena.Arena, landClass, wet, active and units are left in
+    it under key + name instead of being copied out, so later stages on a
+    process pool attach them without a copy.
+    """
+    if corridor is not None:
+        inside = inside & corridor
+    shape = inside.shape
+    pixel_area = float(cell_size) ** 2
+    r_wet = channel_raster.pixel_radius(float(wet_gap) / 2, cell_size)
+    r_active = channel_raster.pixel_radius(float(active_gap) / 2, cell_size)
+    water_pixels = float(waterArea_threshold) / pixel_area
+    bar_pixels = float(barArea_threshold) / pixel_area
+    tiles = raster_tiles.tile_windows(shape, tile_size, halo=2 * max(r_wet, r_active))
+
+    work = shared_arena.Arena()
+    specs = work.specs
+    layout = [("green", np.float32, np.nan), ("red", np.float32, np.nan),
+              ("nir", np.float32, np.nan), ("swir", np.float32, np.nan),
+              ("inside", bool, False), ("landClass", np.uint8, channel_raster.NODATA),
+              ("closed", bool, False), ("labels", np.int32, 0), ("wet", bool, False),
+              ("active", bool, False), ("units", np.int32, 0)]
+    steps = ("wet", "active")
+    layout += [(step + suffix, bool, False) for step in steps for suffix in ("_in", "_out")]
+    if previous is not None and previous["landClass"].shape != shape:
+        previous = None
+    if previous is not None:
+        layout += [("prev_" + step + suffix, bool, False)
+                   for step in steps for suffix in ("_in", "_out")]
+    for name, dtype, fill in layout:
+        work.create(name, shape, dtype, fill)
+    for name, band in zip(("green", "red", "nir", "swir"), bands):
+        attach(specs[name])[...] = band
+    attach(specs["inside"])[...] = inside
+    if previous is not None:
+        for step in steps:
+            for suffix, array in zip(("_in", "_out"), previous["steps"][step]):
+                attach(specs["prev_" + step + suffix])[...] = array
+
+    def label(run, mask_fn, connectivity=4, count_fn=None):
+        return label_components(run, tiles, tile_size, specs, mask_fn,
+                                connectivity=connectivity, count_fn=count_fn)
+
+    def apply(run, comps, values, dst, base_fn=None, merge=False):
+        work.publish("lut", values[comps.comp])
+        run(partial(apply_job, specs, "labels", comps.offsets, "lut", dst,
+                    base_fn, merge), tiles)
+        work.release("lut")
+
+    def fill_holes(run, name):
+        comps = label(run, partial(background_mask, name), connectivity=8)
+        apply(run, comps, ~comps.border, name, partial(array_mask, name))
+
+    def units(run, mask_fn, first_id):
+        comps = label(run, mask_fn, count_fn=vegetation_mask)
+        kept = np.flatnonzero(comps.area >= max(bar_pixels, 1))
+        kept = kept[np.argsort(comps.first[kept])]
+        ids = np.zeros(len(comps.area), np.int32)
+        ids[kept] = np.arange(first_id, first_id + len(kept))
+        apply(run, comps, ids, "units", merge=True)
+        return comps.area[kept] * pixel_area, comps.count[kept] * pixel_area
+
+    pool = None
+    try:
+        if workers == 1 or len(tiles) == 1:
+            run = lambda f, items: list(map(f, items))
+        else:
+            pool = raster_tiles.process_pool(workers)
+            run = lambda f, items: list(pool.map(f, items))
+
+        run(partial(classify_job, specs, ndvi_threshold, mndwi_threshold), tiles)
+
+        closings = run(partial(close_job, specs, water_mask, "closed", r_wet, step="wet"), tiles)
+        comps = label(run, partial(array_mask, "closed"))
+        apply(run, comps, comps.area >= water_pixels, "wet")
+        fill_holes(run, "wet")
+
+        comps = label(run, active_potential_mask)
+        apply(run, comps, comps.area >= water_pixels, "closed")
+        closings += run(partial(close_job, specs, partial(array_mask, "closed"), "active",
+                                r_active, step="active"), tiles)
+        fill_holes(run, "active")
+
+        side_area, side_veg = units(run, side_mask, 1)
+        run(partial(close_job, specs, land_in_wet_mask, "closed", 0), tiles)
+        fill_holes(run, "closed")
+        mid_area, mid_veg = units(run, partial(array_mask, "closed"), len(side_area) + 1)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if arena is not None:
+        # The results stay in shared memory for the later stages
+        for name in RESULTS:
+            work.transfer(name, arena, key + name)
+        out = dict((name, arena[key + name]) for name in RESULTS)
+    else:
+        out = dict((name, work[name].copy()) for name in RESULTS)
+    out["steps"] = dict((step, (work[step + "_in"].copy(), work[step + "_out"].copy()))
+                        for step in steps)
+    work.close()
+    out["recomputed"] = sum(closings) / float(max(len(closings), 1))
+
+    area = np.concatenate((side_area, mid_area))
+    veg = np.concatenate((side_veg, mid_veg))
+    table = np.zeros(len(area), dtype=[("Unit_Id", np.int32), ("Unit_Area", np.float64),
+                                       ("Veg_Area", np.float64), ("Veg_Ratio", np.float64),
+                                       ("Unit_Type", "U2")])
+    table["Unit_Id"] = np.arange(1, len(area) + 1)
+    table["Unit_Area"] = area
+    table["Veg_Area"] = veg
+    table["Veg_Ratio"] = veg / np.maximum(area, pixel_area)
+    table["Unit_Type"] = np.where(table["Veg_Ratio"] <= 0.75, "MB", "IS")
+    table["Unit_Type"][:len(side_area)] = "SB"
+    out["unitTable"] = table
+    out["unitClass"] = unit_class(out["units"], table)
+    if previous is not None:
+        out["changedTiles"] = [tiles[i] for i in changed_tiles(tiles, previous, out)]
+    out["skipped"] = 1.0 - np.count_nonzero(inside) / float(max(inside.size, 1))
+    return out
+
+
+if __name__ == '__main__':
+
+    import arcpy
+
+    import bulk_writer
+    import channel_network
+    import raster_vectorize
+    import scene_prefetch
+
+    # One image, or several separated by ";" for a time series
+    images = [i.strip("'\"") for i in arcpy.GetParameterAsText(0).split(";") if i]
+    envelope = arcpy.GetParameterAsText(1)
+    Out_Space = arcpy.GetParameterAsText(2)
+
+    arcpy.env.workspace = Out_Space
+    arcpy.env.overwriteOutput = True
+    arcpy.env.extent = arcpy.Describe(envelope).Extent
+    arcpy.env.outputCoordinateSystem = arcpy.Describe(envelope).spatialReference
+    arcpy.env.overwriteOutput = True
+
+    green_band = arcpy.GetParameterAsText(3)
+    red_band = arcpy.GetParameterAsText(4)
+    nir_band = arcpy.GetParameterAsText(5)
+    swir_band = arcpy.GetParameterAsText(6)
+    ndvi_threshold = arcpy.GetParameterAsText(7)
+    mndwi_threshold = arcpy.GetParameterAsText(8)
+    waterArea_threshold = arcpy.GetParameterAsText(9)
+    barArea_threshold = arcpy.GetParameterAsText(10)
+    tile_size = int(arcpy.GetParameterAsText(11) or 1024)
+    workers = int(arcpy.GetParameterAsText(12) or 0) or None
+    # Coarse-to-fine mode: overview decimation factor (0 or 1 for off) and
+    # safety margin of the corridor in map units
+    overview_factor = int(arcpy.GetParameterAsText(13) or 0)
+    corridor_margin = float(arcpy.GetParameterAsText(14) or 300)
+    # Incremental mode for time series: closings carried forward from the
+    # previous image where their input is unchanged, and the changed tiles
+    # written to changedTiles_<year> for planform_metric_extraction_V4.py
+    incremental = arcpy.GetParameterAsText(15).lower() in ("true", "1", "yes")
+
+    sr = arcpy.Describe(envelope).spatialReference
+
+    # Bands of the next images are read on background threads while the
+    # current one is processed
+    prefetcher = scene_prefetch.Prefetcher(
+        images, scene_prefetch.band_window_loader(
+            envelope, (green_band, red_band, nir_band, swir_band)), depth=2)
+
+    # The rasters of an image stay in shared memory, where the vectorizing
+    # workers attach them
+    arena = shared_arena.Arena()
+    previous = None
+    previous_suffix = None
+    for image, (grid, bands, inside) in prefetcher:
+        suffix = ""
+        if len(images) > 1:
+            # Year taken from the image name as in the detection tool
+            suffix = "_" + os.path.splitext(os.path.basename(image))[0][3:7]
+
+        corridor = None
+        if overview_factor > 1:
+            arcpy.AddMessage("Finding the active corridor on the overview")
+            corridor = channel_raster.corridor_mask(bands, inside, grid.cell, ndvi_threshold,
+                                                    mndwi_threshold, overview_factor,
+                                                    corridor_margin)
+
+        arcpy.AddMessage("Classifying land cover and extracting channels on tiles " + suffix)
+        products = extract_channels(bands, inside, grid.cell, ndvi_threshold,
+                                    mndwi_threshold, waterArea_threshold,
+                                    barArea_threshold, tile_size=tile_size,
+                                    workers=workers, corridor=corridor,
+                                    previous=previous if incremental else None,
+                                    arena=arena, key=suffix)
+        del bands
+        if incremental:
+            previous = products
+            if previous_suffix is not None:
+                for name in RESULTS:
+                    arena.release(previous_suffix + name)
+            previous_suffix = suffix
+            arcpy.AddMessage("Computed {0:.1%} of the closings".format(products["recomputed"]))
+        if corridor is not None:
+            envelope_pixels = max(np.count_nonzero(inside), 1)
+            arcpy.AddMessage("Skipped {0:.1%} of the window and {1:.1%} of the envelope pixels".format(
+                products["skipped"], 1.0 - np.count_nonzero(corridor) / float(envelope_pixels)))
+
+        arcpy.AddMessage("Vectorizing channel features")
+        origin = (grid.x0, grid.y0)
+        polys = raster_vectorize.vectorize_masks(
+            {"landClass": products["landClass"],
+             "wetChannelBoundary": products["wet"],
+             "activeChannel": products["active"]},
+            ["landClass", "wetChannelBoundary", "activeChannel"],
+            origin, grid.cell, tile_size, workers)
+        # All layers of the image are built in memory and written at once
+        layers = [bulk_writer.polygon_layer("landClass" + suffix, polys["landClass"], "Class"),
+                  bulk_writer.polygon_layer("wetChannelBoundary" + suffix, polys["wetChannelBoundary"], "Wet"),
+                  bulk_writer.polygon_layer("activeChannel" + suffix, polys["activeChannel"], "Active")]
+
+        table = products["unitTable"]
+        attributes = dict((int(row["Unit_Id"]), {"Unit_Area": float(row["Unit_Area"]),
+                                                 "Unit_Type": str(row["Unit_Type"]),
+                                                 "Veg_Area": float(row["Veg_Area"]),
+                                                 "Veg_Ratio": float(row["Veg_Ratio"])})
+                          for row in table)
+        unit_polys = raster_vectorize.polygons(
+            products["units"], table["Unit_Id"], origin, grid.cell, tile_size,
+            workers, components=products["units"])
+        layers.append(bulk_writer.polygon_layer("channelUnit" + suffix, unit_polys, "Unit_Id", attributes))
+
+        # Thread network of the water within the wet channel
+        network = channel_network.build_network(
+            (products["landClass"] == channel_raster.WATER) & products["wet"], grid.cell, origin)
+        layers.append(channel_network.network_layer(network, "channelNetwork" + suffix))
+        stats = channel_network.statistics(network)
+        arcpy.AddMessage("Channel network: {0} links, {1} nodes, link/node ratio {2:.2f}".format(
+            stats["links"], stats["nodes"], stats["link_node_ratio"]))
+
+        if "changedTiles" in products:
+            tile_polys = []
+            for tile in products["changedTiles"]:
+                x0, y0 = grid.x0 + tile.col0 * grid.cell, grid.y0 - tile.row0 * grid.cell
+                x1, y1 = grid.x0 + tile.col1 * grid.cell, grid.y0 - tile.row1 * grid.cell
+                tile_polys.append((tile.index, [np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]])]))
+            layers.append(bulk_writer.polygon_layer("changedTiles" + suffix, tile_polys, "Tile"))
+            arcpy.AddMessage("{0} of {1} tiles changed".format(
+                len(tile_polys), len(raster_tiles.tile_windows(inside.shape, tile_size, 0))))
+
+        arcpy.AddMessage("Writing the layers to " + Out_Space)
+        bulk_writer.write_layers(Out_Space, layers, sr)
+        if not incremental:
+            del products
+            for name in RESULTS:
+                arena.release(suffix + name)
+
+    previous = products = None
+    arena.close()
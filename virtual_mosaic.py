@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Virtual mosaic of overlapping scenes
+
+Rivers longer than a scene are read from several overlapping scenes of the
+same date range without building a mosaic on disk. A window of the output
+grid is resolved on the fly:
+
+    1) The scenes whose extent overlaps the window are found and the part of
+       each band they cover is read, the scenes concurrently on a thread
+       pool
+    2) Each pixel takes its bands from one scene chosen by the rule:
+       first: the first scene of the list with valid data
+       latest: the last scene of the list with valid data, so scenes given
+       in date order give the latest acquisition
+       least_cloudy: the darkest of the clear scenes of the pixel, by the
+       brightness of its visible bands, the smallest of green and red
+
+least_cloudy judges every pixel against the same pixel in the other scenes,
+as a global cut cannot tell clear water from shadow:
+
+    cloud: brighter than the cloud threshold when one is given, else more
+    than cloud_ratio times the darkest scene of the pixel and brighter than
+    the median of the window, so water under a cloud still has its clear
+    scene chosen
+    shadow: among the scenes that are not cloud, darker than shadow_ratio
+    times their median for the pixel
+
+The darkest of the remaining scenes is chosen, as haze brightens the visible
+bands; where every scene is cloud the darkest of them. With only two scenes
+a shadow can only be told from the clear one by the other being no cloud,
+and bright sand next to water in another scene passes for a cloud, so the
+rule still leans towards dark surfaces. Where the scenes have a QA band,
+masking the clouds and shadows with it before the mosaic is more reliable.
+
+Scenes are expected on the same cell lattice and coordinate system, as the
+tiles of one path or of one Sentinel-2 zone. A mosaic is given to the tools
+in place of an image as "mosaic:" followed by the scene paths separated by
+"|", see open_image; ";" already separates the images of a time series.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import warnings
+
+import numpy as np
+
+import raster_io
+import raster_tiles
+
+RULES = ("first", "latest", "least_cloudy")
+PREFIX = "mosaic:"
+
+
+class Scene(object):
+    """Extent and cell size of one scene."""
+
+    def __init__(self, path, extent, cell):
+        self.path = path
+        self.extent = tuple(float(v) for v in extent)
+        self.cell = float(cell)
+
+    @classmethod
+    def describe(cls, path):
+        import arcpy
+        ras = arcpy.Raster(path)
+        ext = ras.extent
+        return cls(path, (ext.XMin, ext.YMin, ext.XMax, ext.YMax), ras.meanCellWidth)
+
+    def window(self, grid):
+        """Rows and columns of the grid covered by the scene, or None."""
+        xmin, ymin, xmax, ymax = self.extent
+        col0 = max(int(np.ceil((xmin - grid.x0) / grid.cell - 1e-9)), 0)
+        col1 = min(int(np.floor((xmax - grid.x0) / grid.cell + 1e-9)), grid.cols)
+        row0 = max(int(np.ceil((grid.y0 - ymax) / grid.cell - 1e-9)), 0)
+        row1 = min(int(np.floor((grid.y0 - ymin) / grid.cell + 1e-9)), grid.rows)
+        if row0 >= row1 or col0 >= col1:
+            return None
+        return row0, row1, col0, col1
+
+
+def select(stacks, rule="least_cloudy", green=0, red=1, cloud=None, cloud_ratio=3.0,
+           shadow_ratio=0.5):
+    """Index of the scene chosen for each pixel, -1 where none is valid.
+
+    stacks is a list of (scenes, rows, cols) band arrays in the order of the
+    bands, NaN where a scene has no data. cloud, in the units of the bands,
+    cloud_ratio and shadow_ratio are the least_cloudy tests of the module
+    docstring.
+    """
+    valid = np.all([~np.isnan(s) for s in stacks], axis=0)
+    n = valid.shape[0]
+    if rule == "first":
+        choice = np.argmax(valid, axis=0)
+    elif rule == "latest":
+        choice = n - 1 - np.argmax(valid[::-1], axis=0)
+    elif rule == "least_cloudy":
+        brightness = np.where(valid, np.fmin(stacks[green], stacks[red]), np.inf)
+        if cloud is None:
+            floor = np.median(brightness[valid]) if valid.any() else 0.0
+            cloudy = valid & (brightness > cloud_ratio * brightness.min(axis=0)) & (brightness > floor)
+        else:
+            cloudy = valid & (brightness > cloud)
+        clear = valid & ~cloudy
+        with warnings.catch_warnings():
+            # All-NaN pixels have no median and are handled by the fallback
+            warnings.simplefilter("ignore", RuntimeWarning)
+            median = np.nanmedian(np.where(clear, brightness, np.nan), axis=0)
+        shaded = clear & (brightness < shadow_ratio * median)
+        good = clear & ~shaded
+        choice = np.argmin(np.where(good, brightness, np.inf), axis=0)
+        choice = np.where(good.any(axis=0), choice, np.argmin(brightness, axis=0))
+    else:
+        raise ValueError("unknown mosaic rule %r, expected one of %s" % (rule, ", ".join(RULES)))
+    return np.where(valid.any(axis=0), choice, -1)
+
+
+def compose(stacks, choice):
+    """Bands of the chosen scene of each pixel, NaN where there is none."""
+    index = np.maximum(choice, 0)[None]
+    out = []
+    for stack in stacks:
+        band = np.take_along_axis(stack, index, axis=0)[0]
+        band[choice < 0] = np.nan
+        out.append(band)
+    return out
+
+
+class VirtualMosaic(object):
+    """Bands of a list of scenes read as one image, window by window."""
+
+    def __init__(self, scenes, rule="least_cloudy", workers=4, reader=None, cloud=None):
+        self.scenes = [s if isinstance(s, Scene) else Scene.describe(s) for s in scenes]
+        if rule not in RULES:
+            raise ValueError("unknown mosaic rule %r, expected one of %s" % (rule, ", ".join(RULES)))
+        self.rule = rule
+        self.workers = workers
+        self.cloud = cloud
+        # reader(path, band, grid) -> float32 array with NaN as NoData
+        self.reader = reader or raster_io.read_band
+
+    @property
+    def cell(self):
+        return self.scenes[0].cell
+
+    @property
+    def extent(self):
+        ext = np.array([s.extent for s in self.scenes])
+        return (ext[:, 0].min(), ext[:, 1].min(), ext[:, 2].max(), ext[:, 3].max())
+
+    def _read_scene(self, scene, bands, grid):
+        window = scene.window(grid)
+        out = np.full((len(bands), grid.rows, grid.cols), np.nan, np.float32)
+        if window is not None:
+            row0, row1, col0, col1 = window
+            sub = raster_io.subgrid(grid, row0, row1, col0, col1)
+            for k, band in enumerate(bands):
+                out[k, row0:row1, col0:col1] = self.reader(scene.path, band, sub)
+        return out
+
+    def read(self, bands, grid, green=0, red=1):
+        """Mosaicked band arrays of a window; green and red index the bands."""
+        scenes = [s for s in self.scenes if s.window(grid) is not None]
+        if not scenes:
+            return [np.full((grid.rows, grid.cols), np.nan, np.float32) for _ in bands]
+        if len(scenes) == 1:
+            return list(self._read_scene(scenes[0], bands, grid))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            parts = list(pool.map(lambda s: self._read_scene(s, bands, grid), scenes))
+        stacks = [np.stack([p[k] for p in parts]) for k in range(len(bands))]
+        return compose(stacks, select(stacks, self.rule, green, red, self.cloud))
+
+    def windows(self, bands, grid, tile_size=1024, green=0, red=1):
+        """Stream the mosaic of a grid in tiles; yields (tile, bands)."""
+        for tile in raster_tiles.tile_windows((grid.rows, grid.cols), tile_size):
+            sub = raster_io.subgrid(grid, tile.row0, tile.row1, tile.col0, tile.col1)
+            yield tile, self.read(bands, sub, green, red)
+
+
+def is_mosaic(image):
+    return image.strip("'\"").lower().startswith(PREFIX)
+
+
+def open_image(image, rule="least_cloudy", workers=4, cloud=None):
+    """VirtualMosaic of "mosaic:" followed by scene paths separated by "|"."""
+    paths = image.strip("'\"")[len(PREFIX):].split("|")
+    return VirtualMosaic([p.strip() for p in paths if p.strip()], rule, workers, cloud=cloud)
+
+
+def mosaic_grid(envelope, mosaic):
+    """Processing window of the envelope extent on the cells of the mosaic."""
+    import arcpy
+    ext = arcpy.Describe(envelope).extent
+    first = mosaic.scenes[0]
+    return raster_io.snap_grid((ext.XMin, ext.YMin, ext.XMax, ext.YMax),
+                               first.cell, first.extent[0], first.extent[3])
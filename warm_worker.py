@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Long-lived local worker for the script tools
+
+A run of a script tool from the command line pays for importing arcpy, NumPy
+and pandas and for starting R through rpy2 before any work is done. The
+worker keeps one interpreter alive and runs the scripts in it, so these are
+loaded once:
+
+    python warm_worker.py serve [--port 6071] [--queue DIR] [--preload]
+        Waits for jobs on a local socket, or with --queue on a folder of
+        <name>.job.json files, and runs them one at a time. Imports are
+        lazy: a module is loaded by the first job that needs it, or at
+        start with --preload.
+
+    python warm_worker.py submit [--port 6071] script.py arg1 arg2 ...
+        Sends a job to the worker and prints its messages.
+
+    python warm_worker.py stop [--port 6071]
+
+A job is a script path and its parameters, given to the script as sys.argv
+as in a standalone run, so arcpy.GetParameterAsText reads them unchanged.
+Scripts keep expensive objects between jobs with cached(key, factory), e.g.
+the R ecp package or transects read into the memory workspace; within a
+single standalone run it is a plain memo.
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import runpy
+import struct
+import sys
+import time
+import traceback
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PORT = 6071
+AUTHKEY = b"channel-planform"
+PRELOAD = ("arcpy", "numpy", "pandas", "rpy2.robjects.packages")
+
+# Objects kept for the life of the process, by key
+_cache = {}
+# Key and release function of the value kept for each group
+_groups = {}
+
+
+def cached(key, factory, group=None, release=None):
+    """Value of factory() kept in the process under key.
+
+    A group keeps one key at a time: a new key of the group, e.g. of a
+    dataset that has changed, drops the value kept under the previous one
+    and calls release on it, e.g. to delete a superseded memory copy.
+    """
+    if group is not None and group in _groups and _groups[group][0] != key:
+        old, old_release = _groups.pop(group)
+        value = _cache.pop(old, None)
+        if old_release is not None and value is not None:
+            old_release(value)
+    if key not in _cache:
+        _cache[key] = factory()
+    if group is not None:
+        _groups[group] = (key, release)
+    return _cache[key]
+
+
+def gdb_table_id(gdb, name):
+    """Number of the aXXXXXXXX.gdbtable file of a table of a file geodatabase.
+
+    Looked up in the catalog table a00000001, the row holding the name being
+    the number; None when it cannot be found.
+    """
+    try:
+        with open(os.path.join(gdb, "a00000001.gdbtable"), "rb") as f:
+            data = f.read()
+        with open(os.path.join(gdb, "a00000001.gdbtablx"), "rb") as f:
+            index = f.read()
+    except (IOError, OSError):
+        return None
+    blocks, _, size = struct.unpack("<iii", index[4:16])
+    offsets = [int.from_bytes(index[16 + k * size:16 + (k + 1) * size], "little")
+               for k in range(min(blocks * 1024, (len(index) - 16) // size))]
+    # Names are UTF-16 after their length in characters
+    needle = name.lower().encode("utf-16-le")
+    lowered = data.lower()
+    start = lowered.find(needle)
+    while start > 0:
+        if data[start - 1] == len(name):
+            rows = [k for k, offset in enumerate(offsets) if 0 < offset < start]
+            if rows:
+                return max(rows, key=lambda k: offsets[k]) + 1
+        start = lowered.find(needle, start + 1)
+    return None
+
+
+def file_stamp(path):
+    """Newest modification time of the files holding a dataset.
+
+    For a table or feature class of a file geodatabase these are its own
+    aXXXXXXXX files, so that writing other datasets of the geodatabase
+    leaves the stamp alone; when its number cannot be found, the files of
+    the whole geodatabase. For a file, such as a shapefile, its sidecar
+    files.
+    """
+    name = None
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        name = name or os.path.basename(path)
+        path = parent
+    if not path:
+        return None
+    if os.path.isdir(path):
+        table = gdb_table_id(path, name) if name and path.lower().endswith(".gdb") else None
+        if table is not None:
+            files = glob.glob(os.path.join(glob.escape(path), "a%08x.*" % table))
+        else:
+            files = [e.path for e in os.scandir(path) if e.is_file()]
+    else:
+        files = glob.glob(glob.escape(os.path.splitext(path)[0]) + ".*")
+    return max([os.path.getmtime(f) for f in files] or [os.path.getmtime(path)])
+
+
+def preload(modules=PRELOAD):
+    for name in modules:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+
+
+def run_script(script, args):
+    """Run a script as __main__ with the given parameters in this process.
+
+    Returns a dict with returncode, messages (captured output) and seconds.
+    """
+    if not os.path.isabs(script):
+        script = os.path.join(HERE, script)
+    out = io.StringIO()
+    argv, path, cwd = sys.argv, list(sys.path), os.getcwd()
+    sys.argv = [script] + [str(a) for a in args]
+    sys.path.insert(0, os.path.dirname(script))
+    start = time.time()
+    code = 0
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        out.write(traceback.format_exc())
+        code = 1
+    finally:
+        sys.argv = argv
+        sys.path[:] = path
+        os.chdir(cwd)
+    return {"returncode": code, "messages": out.getvalue(),
+            "seconds": round(time.time() - start, 3)}
+
+
+def serve_socket(port):
+    from multiprocessing.connection import Listener
+    with Listener(("127.0.0.1", port), authkey=AUTHKEY) as listener:
+        print("warm worker listening on 127.0.0.1:%d" % port)
+        while True:
+            with listener.accept() as conn:
+                job = conn.recv()
+                if job.get("stop"):
+                    conn.send({"returncode": 0, "messages": "stopped", "seconds": 0})
+                    return
+                conn.send(run_script(job["script"], job.get("args", [])))
+
+
+def serve_queue(folder, poll=0.5):
+    """Run <name>.job.json files of a folder and write <name>.result.json."""
+    os.makedirs(folder, exist_ok=True)
+    print("warm worker watching " + folder)
+    while True:
+        jobs = sorted(glob.glob(os.path.join(folder, "*.job.json")), key=os.path.getmtime)
+        if not jobs:
+            time.sleep(poll)
+            continue
+        path = jobs[0]
+        running = path[:-len(".job.json")] + ".running.json"
+        try:
+            os.replace(path, running)
+        except OSError:
+            continue
+        with open(running) as f:
+            job = json.load(f)
+        if job.get("stop"):
+            os.remove(running)
+            return
+        result = run_script(job["script"], job.get("args", []))
+        tmp = running[:-len(".running.json")] + ".result.tmp"
+        with open(tmp, "w") as f:
+            json.dump(result, f, indent=1)
+        os.replace(tmp, running[:-len(".running.json")] + ".result.json")
+        os.remove(running)
+
+
+def submit(script, args, port=PORT):
+    """Send a job to a worker on the local socket and wait for its result."""
+    from multiprocessing.connection import Client
+    with Client(("127.0.0.1", port), authkey=AUTHKEY) as conn:
+        conn.send({"script": script, "args": list(args)})
+        return conn.recv()
+
+
+def stop(port=PORT):
+    from multiprocessing.connection import Client
+    with Client(("127.0.0.1", port), authkey=AUTHKEY) as conn:
+        conn.send({"stop": True})
+        return conn.recv()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Warm worker for the script tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("serve")
+    p.add_argument("--port", type=int, default=PORT)
+    p.add_argument("--queue", help="folder of job files instead of the socket")
+    p.add_argument("--preload", action="store_true", help="import arcpy, pandas and rpy2 at start")
+    p = sub.add_parser("submit")
+    p.add_argument("script")
+    p.add_argument("args", nargs=argparse.REMAINDER)
+    p.add_argument("--port", type=int, default=PORT)
+    p = sub.add_parser("stop")
+    p.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        if args.preload:
+            preload()
+        if args.queue:
+            serve_queue(args.queue)
+        else:
+            serve_socket(args.port)
+        return 0
+    if args.command == "stop":
+        stop(args.port)
+        return 0
+    result = submit(args.script, args.args, args.port)
+    sys.stdout.write(result["messages"])
+    print("finished in %.3f s" % result["seconds"])
+    return result["returncode"]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
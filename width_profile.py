@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous width profile along the centreline chainage
+
+Widths are measured along the medial axis of the wet and active channel
+masks instead of on the transects only:
+
+    1) The mask is skeletonized and pruned as for the thread network
+       (channel_network.build_network)
+    2) The width at every skeleton pixel is twice its distance transform
+       value (channel_network.thread_width)
+    3) The skeleton segments are projected on the centreline with
+       linear_reference, each covering the chainage between its ends
+
+The profile is a record array of the segments sorted by chainage. The total
+width over any window is the sum of width times covered chainage of the
+segments in it divided by the window, so braided threads add up, and the
+covered chainage over the window is the number of threads. Profiles are
+sampled at any spacing and window afterwards with cumulative sums, without
+any further geometry.
+"""
+
+import numpy as np
+
+import channel_network
+
+
+def profile(mask, cell_size, origin, reference, prune=1.0):
+    """Width profile of a channel mask along a LinearReference.
+
+    origin is the (x, y) map coordinate of the upper left corner. Returns a
+    record array of Chainage, Offset, Width, Step (chainage covered) and
+    Link, sorted by Chainage.
+    """
+    mask = np.asarray(mask, bool)
+    cell_size = float(cell_size)
+    network = channel_network.build_network(mask, cell_size, origin, prune)
+    segments = network.segments
+    out = np.zeros(len(segments), dtype=[("Chainage", np.float64), ("Offset", np.float64),
+                                         ("Width", np.float64), ("Step", np.float64),
+                                         ("Link", np.int32)])
+    if not len(segments):
+        return out
+    # Width at the segment ends, from their pixel centres
+    width = channel_network.thread_width(mask)
+    col = np.round((segments[..., 0] - origin[0]) / cell_size - 0.5).astype(np.int64)
+    row = np.round((origin[1] - segments[..., 1]) / cell_size - 0.5).astype(np.int64)
+    chainage, offset = reference.locate(segments.reshape(-1, 2))
+    chainage = chainage.reshape(-1, 2)
+    out["Chainage"] = chainage.mean(axis=1)
+    out["Offset"] = reference.locate(segments.mean(axis=1))[1]
+    out["Width"] = width[row, col].mean(axis=1) * cell_size
+    out["Step"] = np.abs(chainage[:, 1] - chainage[:, 0])
+    out["Link"] = network.segment_link
+    return np.sort(out, order="Chainage")
+
+
+def sample(profile, stations, window):
+    """Total width and number of threads over windows centred on stations."""
+    stations = np.asarray(stations, np.float64)
+    window = float(window)
+    area = np.r_[0.0, np.cumsum(profile["Width"] * profile["Step"])]
+    covered = np.r_[0.0, np.cumsum(profile["Step"])]
+    lo = np.searchsorted(profile["Chainage"], stations - window / 2, side="left")
+    hi = np.searchsorted(profile["Chainage"], stations + window / 2, side="left")
+    return (area[hi] - area[lo]) / window, (covered[hi] - covered[lo]) / window
+
+
+def stations(reference, spacing):
+    """Chainages every spacing along the centreline, from spacing / 2."""
+    return np.arange(float(spacing) / 2, reference.length, float(spacing))
+
+
+if __name__ == '__main__':
+
+    import arcpy
+
+    import linear_reference
+    import raster_io
+
+    envelope = arcpy.GetParameterAsText(0)
+    centerline = arcpy.GetParameterAsText(1)
+    startPoint = arcpy.GetParameterAsText(2)
+    input_space = arcpy.GetParameterAsText(3)
+    years = [y.strip() for y in arcpy.GetParameterAsText(4).split(";") if y.strip()]
+    cell_size = float(arcpy.GetParameterAsText(5) or 10)
+    spacing = float(arcpy.GetParameterAsText(6) or 25)
+    window = float(arcpy.GetParameterAsText(7) or spacing)
+
+    arcpy.env.workspace = input_space
+    arcpy.env.overwriteOutput = True
+
+    ext = arcpy.Describe(envelope).extent
+    grid = raster_io.snap_grid((ext.XMin, ext.YMin, ext.XMax, ext.YMax),
+                               cell_size, ext.XMin, ext.YMax)
+    origin = (grid.x0, grid.y0)
+    reference = linear_reference.from_centerline(centerline, startPoint)
+    at = stations(reference, spacing)
+
+    for year in years:
+        rows = np.zeros(len(at), dtype=[("Distance", np.float64), ("Ww", np.float64),
+                                        ("Aw", np.float64), ("Threads", np.float64)])
+        rows["Distance"] = at
+        for product, field in (("wetChannelBoundary", "Ww"), ("activeChannel", "Aw")):
+            arcpy.AddMessage("Width profile of " + product + "_" + year)
+            mask = raster_io.rasterize_rings(raster_io.feature_rings(product + "_" + year), grid)
+            width, threads = sample(profile(mask, grid.cell, origin, reference), at, window)
+            rows[field] = width
+            if field == "Ww":
+                rows["Threads"] = threads
+        table = "widthProfile_" + year
+        if arcpy.Exists(table):
+            arcpy.management.Delete(table)
+        arcpy.da.NumPyArrayToTable(rows, table)